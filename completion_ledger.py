@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""
+Completion ledger: skip jobs whose inputs and configuration have not changed.
+
+Each completed unit of work (e.g. one first-level subject and task) gets one
+small JSON entry in a ledger directory:
+
+    {
+      "key": "sub_N101",
+      "fingerprint": "<sha256 of inputs + parameters>",
+      "inputs": {"bold": {"path": ..., "size": ..., "mtime_ns": ..., "sha256": ...}, ...},
+      "params": {...},
+      "outputs": [{"path": ..., "size": ...}, ...],
+      "completed": "2026-01-01T12:00:00"
+    }
+
+The fingerprint covers the content of the input files and the parameters
+(workflow configuration, contrast list, ...). Content digests are cached in
+the entry by path, size and modification time, so unchanged inputs (BOLD
+series of several GB) are only read once. An entry is up to date when its
+fingerprint matches and every recorded output still exists with its
+recorded size.
+
+One file per key keeps concurrent SLURM jobs from contending for a shared
+ledger; entries are written atomically.
+
+Author: Xiaoqian Xiao (xiao.xiaoqian.320@gmail.com)
+"""
+
+import os
+import json
+import hashlib
+import logging
+from datetime import datetime
+
+from result_promotion import sha256_file
+
+logger = logging.getLogger(__name__)
+
+# =============================================================================
+# CONSTANTS
+# =============================================================================
+
+LEDGER_VERSION = 1
+
+# =============================================================================
+# FINGERPRINTS
+# =============================================================================
+
+def file_digest(path, previous=None):
+    """
+    Content record of a file, reusing a previous digest if the file is unchanged.
+
+    Args:
+        path (str): File path
+        previous (dict): Earlier record of the same input (from a ledger entry)
+
+    Returns:
+        dict: path, size, mtime_ns and sha256
+    """
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    if (previous and previous.get('path') == path and previous.get('size') == st.st_size
+            and previous.get('mtime_ns') == st.st_mtime_ns and previous.get('sha256')):
+        return dict(previous)
+    return {'path': path, 'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'sha256': sha256_file(path)}
+
+
+def compute_fingerprint(files, params, previous=None):
+    """
+    Fingerprint of a unit of work from its input files and parameters.
+
+    Only file contents enter the fingerprint (not paths or timestamps), so
+    touching or moving an input does not invalidate completed work.
+
+    Args:
+        files (dict): Input name -> file path
+        params (dict): JSON-serialisable parameters (configuration, contrasts, ...)
+        previous (dict): Previous ledger entry, whose digests are reused when possible
+
+    Returns:
+        tuple: (fingerprint, input records)
+    """
+    previous_inputs = (previous or {}).get('inputs', {})
+    records = {name: file_digest(path, previous_inputs.get(name)) for name, path in sorted(files.items())}
+    payload = {
+        'version': LEDGER_VERSION,
+        'inputs': {name: record['sha256'] for name, record in records.items()},
+        'params': params,
+    }
+    fingerprint = hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+    return fingerprint, records
+
+# =============================================================================
+# LEDGER ENTRIES
+# =============================================================================
+
+def entry_path(ledger_dir, key):
+    """Ledger file of one unit of work."""
+    return os.path.join(ledger_dir, f'{key}.json')
+
+
+def read_entry(ledger_dir, key):
+    """Ledger entry of a unit of work, or None if missing or unreadable."""
+    path = entry_path(ledger_dir, key)
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.warning(f"Ignoring unreadable ledger entry {path}: {e}")
+        return None
+
+
+def write_entry(ledger_dir, key, fingerprint, inputs, params, outputs):
+    """
+    Record a completed unit of work.
+
+    Args:
+        ledger_dir (str): Ledger directory
+        key (str): Unit of work (e.g. 'sub_N101')
+        fingerprint (str): Fingerprint from compute_fingerprint
+        inputs (dict): Input records from compute_fingerprint
+        params (dict): Parameters that entered the fingerprint
+        outputs (list): Output files produced by the work
+
+    Returns:
+        str: Ledger file
+    """
+    os.makedirs(ledger_dir, exist_ok=True)
+    entry = {
+        'key': key,
+        'fingerprint': fingerprint,
+        'inputs': inputs,
+        'params': params,
+        'outputs': [{'path': os.path.abspath(p), 'size': os.path.getsize(p)} for p in sorted(outputs)],
+        'completed': datetime.now().isoformat(timespec='seconds'),
+    }
+    path = entry_path(ledger_dir, key)
+    tmp = f'{path}.{os.getpid()}.partial'
+    with open(tmp, 'w') as f:
+        json.dump(entry, f, indent=2, default=str)
+    os.replace(tmp, path)
+    logger.info(f"Recorded {key} as complete in {path}")
+    return path
+
+
+def is_up_to_date(entry, fingerprint):
+    """
+    Whether a ledger entry records complete, unchanged work for a fingerprint.
+
+    Args:
+        entry (dict): Ledger entry (read_entry) or None
+        fingerprint (str): Current fingerprint
+
+    Returns:
+        bool: True if the fingerprint matches and every recorded output is intact
+    """
+    if not entry or entry.get('fingerprint') != fingerprint or not entry.get('outputs'):
+        return False
+    for output in entry['outputs']:
+        try:
+            if os.path.getsize(output['path']) != output['size']:
+                return False
+        except OSError:
+            return False
+    return True
@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+"""
+Consolidated, chunked cope store for group-level analyses.
+
+ROI, PSC and subset analyses each re-read and re-decompress the per-contrast
+merged_cope/merged_varcope NIfTI files. This module packs a task's merged
+outputs into a single HDF5 file shaped subjects x contrasts x in-mask voxels,
+with per-subject metadata from the behavioral table, so any contrast or
+subject subset can be sliced without touching NIfTI files.
+
+Layout of cope_store_task-<task>.h5:
+    /cope, /varcope     float32 (n_subjects, n_contrasts, n_voxels), chunked + gzip
+    /subjects           subject IDs in merged (design) order
+    /contrasts          contrast numbers
+    /mask_indices       flat (Fortran-order) indices of in-mask voxels
+    /metadata/<column>  one dataset per behavioral column, in subject order
+    attrs               task, grid shape, affine, creation time, and the
+                        signatures of the merged files each contrast was read from
+
+A store is only a copy of the merged files: CopeStore.is_current compares
+the recorded signatures with the merged files on disk, so readers can fall
+back to the merged files once a contrast has been re-merged.
+
+h5py is only needed when a store is built or read.
+
+Author: Xiaoqian Xiao (xiao.xiaoqian.320@gmail.com)
+"""
+
+import os
+import json
+import logging
+from datetime import datetime
+import numpy as np
+import nibabel as nib
+import pandas as pd
+
+from nifti_cache import load_nifti
+from pre_group_merge import file_signature
+
+logger = logging.getLogger(__name__)
+
+# =============================================================================
+# CONSTANTS
+# =============================================================================
+
+FILE_TYPES = ('cope', 'varcope')
+STORE_DTYPE = np.float32
+VOXEL_CHUNK = 16384      # voxels per chunk
+SUBJECT_CHUNK = 16       # subjects per chunk
+COMPRESSION_LEVEL = 4
+
+
+def _require_h5py():
+    """Import h5py lazily so the rest of the pipeline does not depend on it."""
+    try:
+        import h5py
+    except ImportError as e:
+        raise ImportError("h5py is required for the cope store (pip install h5py)") from e
+    return h5py
+
+
+def get_store_path(task_results_dir, task):
+    """Return the default store path for a task results directory."""
+    return os.path.join(task_results_dir, f'cope_store_task-{task}.h5')
+
+
+def merged_file_path(task_results_dir, contrast, file_type):
+    """Merged per-contrast output a store contrast is read from."""
+    return os.path.join(task_results_dir, f'cope{contrast}', f'merged_{file_type}.nii.gz')
+
+# =============================================================================
+# BUILDING
+# =============================================================================
+
+def build_cope_store(task_results_dir, task, contrasts, subjects, mask_file,
+                     metadata=None, store_file=None):
+    """
+    Build the cope store for one task from its merged per-contrast outputs.
+
+    Each contrast's merged_cope/merged_varcope is read once and written into
+    the store in subject order; volume order in the merged files must match
+    `subjects` (as it does for files produced from the same group_info).
+
+    Args:
+        task_results_dir (str): Task results directory containing copeN/ subdirectories
+        task (str): Task name
+        contrasts (list): Contrast numbers to include
+        subjects (list): Subject IDs in merged (design) order
+        mask_file (str): Mask defining the in-mask voxels (e.g. GROUP_MASK)
+        metadata (pandas.DataFrame): Behavioral data with a subID column (optional)
+        store_file (str): Output path (default: get_store_path)
+
+    Returns:
+        str: Path to the store
+    """
+    h5py = _require_h5py()
+    store_file = store_file or get_store_path(task_results_dir, task)
+
+    mask_img = load_nifti(mask_file)
+    mask_flat = np.asanyarray(mask_img.dataobj).reshape(-1, order='F') > 0
+    mask_indices = np.flatnonzero(mask_flat)
+    n_sub, n_con, n_vox = len(subjects), len(contrasts), len(mask_indices)
+
+    chunks = (min(n_sub, SUBJECT_CHUNK), 1, min(n_vox, VOXEL_CHUNK))
+    tmp_file = store_file + '.partial'
+
+    with h5py.File(tmp_file, 'w') as h5:
+        h5.attrs['task'] = task
+        h5.attrs['shape'] = np.asarray(mask_img.shape[:3], dtype=np.int64)
+        h5.attrs['affine'] = mask_img.affine
+        h5.attrs['created'] = datetime.now().isoformat(timespec='seconds')
+
+        h5.create_dataset('subjects', data=np.asarray(subjects, dtype=h5py.string_dtype()))
+        h5.create_dataset('contrasts', data=np.asarray(contrasts, dtype=np.int64))
+        h5.create_dataset('mask_indices', data=mask_indices.astype(np.int64))
+        sources = {}
+
+        datasets = {
+            file_type: h5.create_dataset(file_type, shape=(n_sub, n_con, n_vox), dtype=STORE_DTYPE,
+                                         chunks=chunks, compression='gzip',
+                                         compression_opts=COMPRESSION_LEVEL, shuffle=True)
+            for file_type in FILE_TYPES
+        }
+
+        for c_idx, contrast in enumerate(contrasts):
+            sources[str(contrast)] = {}
+            for file_type in FILE_TYPES:
+                merged_file = merged_file_path(task_results_dir, contrast, file_type)
+                sources[str(contrast)][file_type] = file_signature(merged_file)
+                img = load_nifti(merged_file)
+                if img.ndim != 4 or img.shape[3] != n_sub or tuple(img.shape[:3]) != tuple(mask_img.shape[:3]):
+                    raise ValueError(f"{merged_file} has shape {img.shape}, expected "
+                                     f"{tuple(mask_img.shape[:3]) + (n_sub,)}")
+                data = np.asanyarray(img.dataobj, dtype=STORE_DTYPE).reshape((-1, n_sub), order='F')
+                datasets[file_type][:, c_idx, :] = data[mask_indices].T
+                del data
+            logger.info(f"Stored contrast {contrast} ({c_idx + 1}/{n_con})")
+        h5.attrs['merged'] = json.dumps(sources)
+
+        if metadata is not None:
+            meta = metadata.set_index('subID').reindex(subjects)
+            group = h5.create_group('metadata')
+            for column in meta.columns:
+                values = meta[column].to_numpy()
+                if values.dtype.kind in 'biuf':
+                    group.create_dataset(column, data=values)
+                else:
+                    group.create_dataset(column, data=np.asarray([str(v) for v in values],
+                                                                 dtype=h5py.string_dtype()))
+
+    os.replace(tmp_file, store_file)
+    logger.info(f"Built cope store {store_file}: {n_sub} subjects x {n_con} contrasts x {n_vox} voxels")
+    return store_file
+
+# =============================================================================
+# READING
+# =============================================================================
+
+def discard_stale_store(store_file):
+    """
+    Remove a store whose merged files have been rewritten since it was built.
+
+    Args:
+        store_file (str): Store path (missing stores are ignored)
+
+    Returns:
+        bool: True if a stale store was removed
+    """
+    if not os.path.exists(store_file):
+        return False
+    with CopeStore(store_file) as store:
+        current = store.is_current()
+    if current:
+        return False
+    os.remove(store_file)
+    logger.info(f"Removed {store_file}: its merged files have changed (rebuild with --build-store)")
+    return True
+
+
+class CopeStore:
+    """
+    Read-only access to a cope store.
+
+    Example:
+        with CopeStore(path) as store:
+            copes = store.get('cope', contrasts=[1, 2], subjects=['N101', 'N102'])
+            store.to_nifti(copes[:, 0, :].T, 'subset_cope1.nii.gz')
+    """
+
+    def __init__(self, store_file):
+        h5py = _require_h5py()
+        self.store_file = store_file
+        self._h5 = h5py.File(store_file, 'r')
+        self.task = self._h5.attrs['task']
+        self.shape = tuple(int(n) for n in self._h5.attrs['shape'])
+        self.affine = np.asarray(self._h5.attrs['affine'])
+        self.subjects = [s.decode() if isinstance(s, bytes) else s for s in self._h5['subjects'][()]]
+        self.contrasts = [int(c) for c in self._h5['contrasts'][()]]
+        self.mask_indices = self._h5['mask_indices'][()]
+        # Stores built before signatures were recorded are never current
+        self.merged = json.loads(self._h5.attrs.get('merged', '{}'))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Close the underlying HDF5 file."""
+        self._h5.close()
+
+    def is_current(self, contrasts=None):
+        """
+        Whether the store still matches the merged files it was built from.
+
+        Args:
+            contrasts (list): Contrasts to check (default: all in the store)
+
+        Returns:
+            bool: True if every checked contrast is in the store and its merged
+                  cope/varcope still have the recorded path, size and mtime
+        """
+        task_results_dir = os.path.dirname(os.path.abspath(self.store_file))
+        for contrast in (self.contrasts if contrasts is None else contrasts):
+            recorded = self.merged.get(str(contrast))
+            if not recorded:
+                return False
+            for file_type in FILE_TYPES:
+                merged_file = merged_file_path(task_results_dir, contrast, file_type)
+                if not os.path.exists(merged_file) or recorded.get(file_type) != file_signature(merged_file):
+                    return False
+        return True
+
+    @property
+    def metadata(self):
+        """pandas.DataFrame: Per-subject metadata in store order (indexed by subID)."""
+        columns = {}
+        if 'metadata' in self._h5:
+            for name, dset in self._h5['metadata'].items():
+                values = dset[()]
+                if values.dtype.kind in 'OS':
+                    values = [v.decode() if isinstance(v, bytes) else v for v in values]
+                columns[name] = values
+        return pd.DataFrame(columns, index=pd.Index(self.subjects, name='subID'))
+
+    def _positions(self, wanted, available, label):
+        """Map requested labels to positions, keeping the requested order."""
+        if wanted is None:
+            return np.arange(len(available))
+        lookup = {value: i for i, value in enumerate(available)}
+        missing = [w for w in wanted if w not in lookup]
+        if missing:
+            raise KeyError(f"{label} not in store: {missing}")
+        return np.asarray([lookup[w] for w in wanted])
+
+    def get(self, file_type='cope', contrasts=None, subjects=None):
+        """
+        Read a subject x contrast x voxel block.
+
+        Args:
+            file_type (str): 'cope' or 'varcope'
+            contrasts (list): Contrast numbers (default: all)
+            subjects (list): Subject IDs (default: all), returned in this order
+
+        Returns:
+            numpy.ndarray: (n_subjects, n_contrasts, n_voxels) float32 array
+        """
+        sub_pos = self._positions(subjects, self.subjects, 'Subjects')
+        con_pos = self._positions(contrasts, self.contrasts, 'Contrasts')
+
+        # HDF5 fancy indexing needs increasing indices; read sorted, then reorder
+        sub_sorted = np.unique(sub_pos)
+        dset = self._h5[file_type]
+        block = np.empty((len(sub_pos), len(con_pos), dset.shape[2]), dtype=dset.dtype)
+        for out_idx, c in enumerate(con_pos):
+            rows = dset[sub_sorted.tolist(), int(c), :]
+            block[:, out_idx, :] = rows[np.searchsorted(sub_sorted, sub_pos)]
+        return block
+
+    def to_volume(self, values):
+        """
+        Scatter in-mask values back onto the 3D grid.
+
+        Args:
+            values (numpy.ndarray): (n_voxels,) or (n_voxels, n_volumes) array
+
+        Returns:
+            numpy.ndarray: (x, y, z) or (x, y, z, n_volumes) array
+        """
+        values = np.asarray(values)
+        extra = values.shape[1:]
+        volume = np.zeros((int(np.prod(self.shape)),) + extra, dtype=values.dtype)
+        volume[self.mask_indices] = values
+        return volume.reshape(self.shape + extra, order='F')
+
+    def to_nifti(self, values, out_file):
+        """Write in-mask values as a NIfTI image on the store grid."""
+        nib.save(nib.Nifti1Image(self.to_volume(values), self.affine), out_file)
+        return out_file
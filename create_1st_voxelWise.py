@@ -9,6 +9,15 @@ analysis and LSS (Least Squares Separate) analysis.
 Usage:
     python create_1st_voxelWise.py --subject SUBJECT_ID --task TASK_NAME
     python create_1st_voxelWise.py  # Generate SLURM scripts for all subjects
+    python create_1st_voxelWise.py --subject SUBJECT_ID --task TASK_NAME --stage-local
+    python create_1st_voxelWise.py --stage-local  # SLURM scripts that stage on node-local scratch
+    python create_1st_voxelWise.py --retention keep-restartable  # SLURM scripts that prune work dirs
+    python create_1st_voxelWise.py --force  # Also regenerate scripts for subjects that are up to date
+
+Subjects whose inputs (BOLD, mask, events, confounds), workflow configuration
+and contrast list are unchanged since their last successful run are recorded
+in the task's completion ledger (<work_dir>/completion_ledger/sub_<ID>.json)
+and skipped by script generation, launch_1st_voxelWise.sh and the job itself.
 
 Author: Xiaoqian Xiao (xiao.xiaoqian.320@gmail.com)
 """
@@ -18,6 +27,7 @@ Author: Xiaoqian Xiao (xiao.xiaoqian.320@gmail.com)
 # =============================================================================
 
 import os
+import glob
 import json
 import logging
 from pathlib import Path
@@ -27,6 +37,9 @@ import pandas as pd
 import nipype.pipeline.engine as pe
 import nipype.interfaces.utility as niu
 import subprocess
+from scratch_staging import staged_workdir, stage_inputs
+from workdir_retention import RetentionMonitor, RETENTION_LEVELS, DEFAULT_RETENTION
+from completion_ledger import compute_fingerprint, read_entry, write_entry, is_up_to_date
 
 # Configure logging
 logging.basicConfig(
@@ -80,6 +93,10 @@ SPACE = ['MNI152NLin2009cAsym']
 OUTPUT_DIR = os.path.join(DERIVATIVES_DIR, 'fMRI_analysis')
 Path(OUTPUT_DIR).mkdir(parents=True, exist_ok=True)
 
+# Completion ledger (one entry per subject, next to the task's SLURM scripts)
+LEDGER_DIR_NAME = 'completion_ledger'
+LEDGER_INPUTS = ('bold', 'mask', 'events', 'regressors')
+
 # =============================================================================
 # BIDS LAYOUT INITIALIZATION
 # =============================================================================
@@ -297,11 +314,73 @@ def create_subject_inputs(sub, part, layout, query):
     logger.info(f"Created inputs for subject {sub}: {list(inputs[sub].keys())}")
     return inputs
 
+# =============================================================================
+# COMPLETION LEDGER
+# =============================================================================
+
+def subject_fingerprint(sub, inputs, ledger_dir):
+    """
+    Fingerprint of a subject's first-level run.
+
+    Covers the content of the BOLD, mask, events and confounds files, the TR,
+    create_workflow_config() and the contrast list derived from the events.
+
+    Args:
+        sub (str): Subject ID
+        inputs (dict): Input files dictionary
+        ledger_dir (str): Completion ledger directory (its digests are reused)
+
+    Returns:
+        tuple: (fingerprint, input records, parameters)
+    """
+    from first_level_workflows import create_contrasts
+
+    config = create_workflow_config()
+    condition_names = get_condition_names_from_events(inputs[sub]['events'])
+    contrasts = create_contrasts(condition_names, contrast_type=config['contrast_type'])[0]
+    # Condition order comes from a set and varies between processes; the contrast set does not
+    params = {'tr': inputs[sub]['tr'], 'config': config, 'contrasts': sorted(contrasts)}
+    files = {key: inputs[sub][key] for key in LEDGER_INPUTS}
+    fingerprint, records = compute_fingerprint(files, params, read_entry(ledger_dir, f'sub_{sub}'))
+    return fingerprint, records, params
+
+def subject_is_up_to_date(sub, ledger_dir, fingerprint):
+    """Whether the ledger records a complete run of a subject with this fingerprint."""
+    return is_up_to_date(read_entry(ledger_dir, f'sub_{sub}'), fingerprint)
+
+def record_subject_completion(sub, task, output_dir, ledger_dir, fingerprint, records, params):
+    """
+    Record a subject as complete once all its copes and varcopes are written.
+
+    Args:
+        sub (str): Subject ID
+        task (str): Task name
+        output_dir (str): Output directory of the first-level workflow
+        ledger_dir (str): Completion ledger directory
+        fingerprint (str): Fingerprint from subject_fingerprint
+        records (dict): Input records from subject_fingerprint
+        params (dict): Parameters from subject_fingerprint
+
+    Returns:
+        str: Ledger entry path, or None if outputs are missing
+    """
+    subject_dir = os.path.join(output_dir, 'firstLevel_timeEffect', f'sub-{sub}')
+    outputs = [path for desc in ('cope', 'varcope')
+               for path in glob.glob(os.path.join(subject_dir, '**', f'*task-{task}_*desc-{desc}[0-9]*'),
+                                     recursive=True)]
+    expected = 2 * len(params['contrasts'])
+    if not expected or len(outputs) < expected:
+        logger.warning(f"Found {len(outputs)} of {expected} cope/varcope outputs for subject {sub}, "
+                       f"task {task}; not recording it as complete")
+        return None
+    return write_entry(ledger_dir, f'sub_{sub}', fingerprint, records, params, outputs)
+
 # =============================================================================
 # SLURM SCRIPT GENERATION
 # =============================================================================
 
-def create_slurm_script(sub, inputs, work_dir, output_dir, task, container_path):
+def create_slurm_script(sub, inputs, work_dir, output_dir, task, container_path, stage_local=False,
+                        retention=DEFAULT_RETENTION, fingerprint=None, force=False):
     """
     Generate SLURM script for a subject.
     
@@ -312,6 +391,12 @@ def create_slurm_script(sub, inputs, work_dir, output_dir, task, container_path)
         output_dir (str): Output directory
         task (str): Task name
         container_path (str): Path to container image
+        stage_local (bool): Run the workflow on node-local scratch (--stage-local)
+        retention (str): Working-directory retention level (--retention)
+        fingerprint (str): Completion-ledger fingerprint, recorded in the script so that
+                           launch_1st_voxelWise.sh can skip it once the subject is complete
+                           (None for subjects not yet in the ledger; the job checks them)
+        force (bool): Rerun the subject even if the ledger marks it complete (--force)
     
     Returns:
         str: Path to generated SLURM script
@@ -321,6 +406,11 @@ def create_slurm_script(sub, inputs, work_dir, output_dir, task, container_path)
         logger.warning(f"Container not found at: {container_path}")
         logger.warning("Please ensure the container exists before running SLURM jobs")
     
+    stage_arg = " --stage-local" if stage_local else ""
+    if retention != DEFAULT_RETENTION:
+        stage_arg += f" --retention {retention}"
+    if force:
+        stage_arg += " --force"
     slurm_script = f"""#!/bin/bash
 #SBATCH --job-name=first_level_sub_{sub}
 #SBATCH --account=fang
@@ -332,6 +422,7 @@ def create_slurm_script(sub, inputs, work_dir, output_dir, task, container_path)
 #SBATCH --time=2:00:00
 #SBATCH --output=/gscratch/scrubbed/fanglab/xiaoqian/NARSAD/work_flows/firstLevel_timeEffect/{task}_sub_{sub}_%j.out
 #SBATCH --error=/gscratch/scrubbed/fanglab/xiaoqian/NARSAD/work_flows/firstLevel_timeEffect/{task}_sub_{sub}_%j.err
+# LEDGER_FINGERPRINT={fingerprint or ''}
 
 # Load required modules
 module load apptainer
@@ -345,9 +436,14 @@ apptainer exec \\
     -B /gscratch/scrubbed/fanglab/xiaoqian:/scrubbed_dir \\
     -B /gscratch/scrubbed/fanglab/xiaoqian/repo/hyak_narsad_timeEffect/create_1st_voxelWise.py:/app/create_1st_voxelWise.py \\
     -B /gscratch/scrubbed/fanglab/xiaoqian/repo/hyak_narsad_timeEffect/group_level_workflows.py:/app/group_level_workflows.py \\
+    -B /gscratch/scrubbed/fanglab/xiaoqian/repo/hyak_narsad_timeEffect/first_level_workflows.py:/app/first_level_workflows.py \\
     -B /gscratch/scrubbed/fanglab/xiaoqian/repo/hyak_narsad_timeEffect/utils.py:/app/utils.py \\
+    -B /gscratch/scrubbed/fanglab/xiaoqian/repo/hyak_narsad_timeEffect/scratch_staging.py:/app/scratch_staging.py \\
+    -B /gscratch/scrubbed/fanglab/xiaoqian/repo/hyak_narsad_timeEffect/workdir_retention.py:/app/workdir_retention.py \\
+    -B /gscratch/scrubbed/fanglab/xiaoqian/repo/hyak_narsad_timeEffect/completion_ledger.py:/app/completion_ledger.py \\
+    -B /gscratch/scrubbed/fanglab/xiaoqian/repo/hyak_narsad_timeEffect/result_promotion.py:/app/result_promotion.py \\
     {container_path} \\
-    python3 /app/create_1st_voxelWise.py --subject {sub} --task {task}
+    python3 /app/create_1st_voxelWise.py --subject {sub} --task {task}{stage_arg}
 """
     
     script_path = os.path.join(work_dir, f'sub_{sub}_slurm.sh')
@@ -368,7 +464,8 @@ apptainer exec \\
 # WORKFLOW EXECUTION
 # =============================================================================
 
-def run_subject_workflow(sub, inputs, work_dir, output_dir, task):
+def run_subject_workflow(sub, inputs, work_dir, output_dir, task, workflow_base_dir=None,
+                         retention=DEFAULT_RETENTION):
     """
     Run first-level workflow for a single subject.
     
@@ -378,6 +475,9 @@ def run_subject_workflow(sub, inputs, work_dir, output_dir, task):
         work_dir (str): Working directory
         output_dir (str): Output directory
         task (str): Task name
+        workflow_base_dir (str): Workflow base directory (default: work_dir/sub_<sub>);
+                                 the staged local directory with --stage-local
+        retention (str): Working-directory retention level (workdir_retention)
     """
     try:
         # Import workflows
@@ -409,7 +509,7 @@ def run_subject_workflow(sub, inputs, work_dir, output_dir, task):
         )
         
         # Set workflow base directory
-        workflow.base_dir = os.path.join(work_dir, f'sub_{sub}')
+        workflow.base_dir = workflow_base_dir or os.path.join(work_dir, f'sub_{sub}')
         
         # Create output directory for this subject
         subject_output_dir = os.path.join(output_dir, 'firstLevel_timeEffect', task, f'sub-{sub}')
@@ -419,8 +519,15 @@ def run_subject_workflow(sub, inputs, work_dir, output_dir, task):
         logger.info(f"Workflow base directory: {workflow.base_dir}")
         logger.info(f"Output directory: {subject_output_dir}")
         
-        # Run the workflow
-        workflow.run(**PLUGIN_SETTINGS)
+        # Run the workflow, pruning node directories to the retention level as nodes finish
+        monitor = RetentionMonitor(workflow, retention)
+        try:
+            workflow.run(plugin=PLUGIN_SETTINGS['plugin'],
+                         plugin_args=dict(PLUGIN_SETTINGS['plugin_args'], status_callback=monitor))
+        except Exception:
+            monitor.finalize(success=False)
+            raise
+        monitor.finalize()
         
         logger.info(f"Workflow completed successfully for subject {sub}, task {task}")
         
@@ -463,8 +570,22 @@ def process_single_subject(args, layout, query):
                 # Create subject inputs
                 inputs = create_subject_inputs(sub, part, layout, query)
                 
+                ledger_dir = os.path.join(work_dir, LEDGER_DIR_NAME)
+                fingerprint, records, params = subject_fingerprint(sub, inputs, ledger_dir)
+                if not args.force and subject_is_up_to_date(sub, ledger_dir, fingerprint):
+                    logger.info(f"Subject {sub}, task {task} is up to date in {ledger_dir}; skipping "
+                                f"(use --force to rerun)")
+                    break
+                
                 logger.info(f"Running first-level analysis for subject {sub}, task {task}")
-                run_subject_workflow(sub, inputs, work_dir, OUTPUT_DIR, task)
+                # DataSink writes to OUTPUT_DIR directly, so nothing else needs syncing back
+                with staged_workdir(os.path.join(work_dir, f'sub_{sub}'),
+                                    enabled=args.stage_local) as subject_work_dir:
+                    if args.stage_local:
+                        inputs = stage_inputs(inputs, subject_work_dir)
+                    run_subject_workflow(sub, inputs, work_dir, OUTPUT_DIR, task,
+                                         workflow_base_dir=subject_work_dir, retention=args.retention)
+                record_subject_completion(sub, task, OUTPUT_DIR, ledger_dir, fingerprint, records, params)
                 
             except Exception as e:
                 logger.error(f"Failed to process subject {sub}: {e}")
@@ -477,15 +598,25 @@ def process_single_subject(args, layout, query):
         logger.error(error_msg)
         raise ValueError(error_msg)
 
-def generate_slurm_scripts(layout, query):
+def generate_slurm_scripts(layout, query, stage_local=False, retention=DEFAULT_RETENTION, force=False):
     """
-    Generate SLURM scripts for all subjects.
+    Generate SLURM scripts for all subjects that are not up to date.
+    
+    Subjects recorded as complete in the completion ledger with an unchanged
+    fingerprint get no script (a stale script from an earlier generation is
+    removed), so only new or changed subjects are launched. Subjects without
+    a completed ledger entry are not fingerprinted here; their scripts carry
+    no fingerprint and the job computes and records it.
     
     Args:
         layout: BIDS layout object
         query (dict): Query dictionary
+        stage_local (bool): Generate scripts that stage on node-local scratch
+        retention (str): Working-directory retention level passed to the scripts
+        force (bool): Generate scripts for up-to-date subjects as well
     """
     logger.info("Generating SLURM scripts for all subjects")
+    generated, up_to_date = 0, 0
     
     for part in layout.get(invalid_filters='allow', **query):
         entities = part.entities
@@ -500,13 +631,33 @@ def generate_slurm_scripts(layout, query):
             # Create subject inputs
             inputs = create_subject_inputs(sub, part, layout, query)
             
+            # Skip subjects whose outputs are up to date. Without a completed entry there is
+            # nothing to compare against, so hashing the inputs is left to the job (once)
+            ledger_dir = os.path.join(work_dir, LEDGER_DIR_NAME)
+            entry = read_entry(ledger_dir, f'sub_{sub}')
+            fingerprint = None
+            if entry and entry.get('outputs'):
+                fingerprint, _, _ = subject_fingerprint(sub, inputs, ledger_dir)
+            if fingerprint and not force and subject_is_up_to_date(sub, ledger_dir, fingerprint):
+                stale_script = os.path.join(work_dir, f'sub_{sub}_slurm.sh')
+                if os.path.exists(stale_script):
+                    os.remove(stale_script)
+                logger.info(f"Subject {sub}, task {task} is up to date; no SLURM script generated")
+                up_to_date += 1
+                continue
+            
             # Generate SLURM script
-            script_path = create_slurm_script(sub, inputs, work_dir, OUTPUT_DIR, task, CONTAINER_PATH)
+            script_path = create_slurm_script(sub, inputs, work_dir, OUTPUT_DIR, task, CONTAINER_PATH,
+                                              stage_local=stage_local, retention=retention,
+                                              fingerprint=fingerprint, force=force)
             logger.info(f"SLURM script created for subject {sub}, task {task}")
+            generated += 1
             
         except Exception as e:
             logger.error(f"Failed to generate SLURM script for subject {sub}: {e}")
             continue
+    
+    logger.info(f"Generated {generated} SLURM scripts; {up_to_date} subjects up to date")
 
 def main():
     """Main execution function."""
@@ -516,6 +667,15 @@ def main():
     parser = argparse.ArgumentParser(description="Run first-level fMRI analysis.")
     parser.add_argument('--subject', type=str, help="Specific subject ID to process")
     parser.add_argument('--task', type=str, help="Specific task to process (e.g., phase2, phase3)")
+    parser.add_argument('--stage-local', action='store_true',
+                        help="Run the workflow on node-local scratch ($TMPDIR) with a resumable "
+                             "handoff to the shared work directory on preemption")
+    parser.add_argument('--retention', default=DEFAULT_RETENTION, choices=RETENTION_LEVELS,
+                        help="Working-directory retention: keep-all, keep-restartable (drop outputs no "
+                             "node reads) or results-only (drop node directories after the run)")
+    parser.add_argument('--force', action='store_true',
+                        help="Run (or generate scripts for) subjects even if the completion ledger "
+                             "marks them up to date")
     args = parser.parse_args()
     
     try:
@@ -538,7 +698,8 @@ def main():
             process_single_subject(args, layout, query)
         else:
             # Generate SLURM scripts for all subjects
-            generate_slurm_scripts(layout, query)
+            generate_slurm_scripts(layout, query, stage_local=args.stage_local, retention=args.retention,
+                                   force=args.force)
         
         logger.info("Processing completed successfully")
         return 0
@@ -112,6 +112,31 @@ get_available_copes() {
 # Single container for all data sources
 CONTAINER_PATH="/gscratch/scrubbed/fanglab/xiaoqian/images/narsad-fmri_timeEffect_1.0.sif"
 
+# Repository modules bound over the container copies
+REPO_DIR="/gscratch/scrubbed/fanglab/xiaoqian/repo/hyak_narsad_timeEffect"
+APP_MODULES=(
+    "group_level_workflows.py"
+    "run_group_voxelWise.py"
+    "resampling.py"
+    "result_promotion.py"
+    "design_cache.py"
+    "native_randomise.py"
+    "native_flame.py"
+    "native_cluster.py"
+    "roi_engine.py"
+    "roi_stats.py"
+    "group_results_db.py"
+    "nifti_cache.py"
+    "scratch_staging.py"
+    "workdir_retention.py"
+    "completion_ledger.py"
+    "tfce.py"
+)
+BIND_ARGS="-B /gscratch/fang:/data -B /gscratch/scrubbed/fanglab/xiaoqian:/scrubbed_dir"
+for module in "${APP_MODULES[@]}"; do
+    BIND_ARGS="${BIND_ARGS} -B ${REPO_DIR}/${module}:/app/${module}"
+done
+
 # =============================================================================
 # DATA SOURCE CONFIGURATIONS
 # =============================================================================
@@ -137,6 +162,15 @@ and generates scripts only for those that have completed pre-group processing.
 OPTIONS:
     --data-source TYPE     Data source type: standard, placebo, or guess (default: standard)
     --analysis-type TYPE   Analysis type: randomise, flameo, or both (default: both)
+    --engine ENGINE        Group-level engine: fsl or native (default: fsl)
+    --adaptive-perm        Stop permutations early per contrast (native engine only)
+    --cluster-engine ENG   FLAMEO cluster inference: fsl or native (default: fsl)
+    --batch                One job per task and analysis type covering all copes
+                           (native randomise shares one permutation set across copes;
+                           fsl randomise and flameo run the copes one after another)
+    --no-family-wise       Batch runs: skip the correction across copes (needed for --adaptive-perm)
+    --stage-local          Run workflows on node-local scratch (\$TMPDIR), resumable after preemption
+    --retention LEVEL      Work dir retention: keep-all, keep-restartable, results-only (default: keep-all)
     --account ACCOUNT     SLURM account (default: $DEFAULT_ACCOUNT)
     --partition PARTITION SLURM partition (default: $DEFAULT_PARTITION)
     --cpus-per-task N     CPUs per task (default: $DEFAULT_CPUS_PER_TASK)
@@ -156,6 +190,24 @@ EXAMPLES:
     # Generate scripts for guess analysis with custom settings
     $0 --data-source guess --account fang --partition ckpt-all --memory 32G
     
+    # Use the in-process permutation engine for randomise jobs
+    $0 --data-source standard --analysis-type randomise --engine native
+
+    # Native engine with adaptive permutation stopping
+    $0 --data-source standard --analysis-type randomise --engine native --adaptive-perm
+
+    # One job per task running all copes against a shared permutation set
+    $0 --data-source standard --analysis-type randomise --engine native --batch
+
+    # Batch with adaptive stopping (each cope stops on its own, no correction across copes)
+    $0 --data-source standard --analysis-type randomise --engine native --batch --adaptive-perm --no-family-wise
+
+    # Keep Nipype working files on node-local scratch instead of the shared filesystem
+    $0 --data-source standard --stage-local
+
+    # Drop node outputs once consumed and the node directories after promotion
+    $0 --data-source standard --retention results-only
+    
     # Generate scripts for standard analysis with custom base directory
     $0 --data-source standard --base-dir /custom/path
 
@@ -188,6 +240,13 @@ get_data_source_config() {
 
 # Initialize variables with defaults
 DATA_SOURCE="standard"
+ENGINE="fsl"
+ADAPTIVE_PERM=false
+BATCH=false
+NO_FAMILY_WISE=false
+STAGE_LOCAL=false
+RETENTION="keep-all"
+CLUSTER_ENGINE="fsl"
 ANALYSIS_TYPES=("${DEFAULT_ANALYSIS_TYPES[@]}")
 ACCOUNT="$DEFAULT_ACCOUNT"
 PARTITION="$DEFAULT_PARTITION"
@@ -212,6 +271,34 @@ while [[ $# -gt 0 ]]; do
             fi
             shift 2
             ;;
+        --engine)
+            ENGINE="$2"
+            shift 2
+            ;;
+        --adaptive-perm)
+            ADAPTIVE_PERM=true
+            shift
+            ;;
+        --batch)
+            BATCH=true
+            shift
+            ;;
+        --no-family-wise)
+            NO_FAMILY_WISE=true
+            shift
+            ;;
+        --stage-local)
+            STAGE_LOCAL=true
+            shift
+            ;;
+        --retention)
+            RETENTION="$2"
+            shift 2
+            ;;
+        --cluster-engine)
+            CLUSTER_ENGINE="$2"
+            shift 2
+            ;;
         --account)
             ACCOUNT="$2"
             shift 2
@@ -263,6 +350,43 @@ if [[ "$DATA_SOURCE" != "standard" && "$DATA_SOURCE" != "placebo" && "$DATA_SOUR
     exit 1
 fi
 
+# Validate engine
+if [[ "$ENGINE" != "fsl" && "$ENGINE" != "native" ]]; then
+    echo "Error: Invalid engine: $ENGINE" >&2
+    echo "Valid engines: fsl, native" >&2
+    exit 1
+fi
+if [[ "$ADAPTIVE_PERM" == true && "$ENGINE" != "native" ]]; then
+    echo "Error: --adaptive-perm requires --engine native" >&2
+    exit 1
+fi
+if [[ "$ADAPTIVE_PERM" == true && "$BATCH" == true && "$NO_FAMILY_WISE" != true ]]; then
+    # The correction across copes needs every permutation of every cope
+    echo "Error: --adaptive-perm with --batch requires --no-family-wise" >&2
+    exit 1
+fi
+if [[ "$CLUSTER_ENGINE" != "fsl" && "$CLUSTER_ENGINE" != "native" ]]; then
+    echo "Error: Invalid cluster engine: $CLUSTER_ENGINE" >&2
+    echo "Valid cluster engines: fsl, native" >&2
+    exit 1
+fi
+ENGINE_ARGS="--engine ${ENGINE} --cluster-engine ${CLUSTER_ENGINE}"
+if [[ "$ADAPTIVE_PERM" == true ]]; then
+    ENGINE_ARGS="${ENGINE_ARGS} --adaptive-perm"
+fi
+if [[ "$NO_FAMILY_WISE" == true ]]; then
+    ENGINE_ARGS="${ENGINE_ARGS} --no-family-wise"
+fi
+if [[ "$STAGE_LOCAL" == true ]]; then
+    ENGINE_ARGS="${ENGINE_ARGS} --stage-local"
+fi
+if [[ "$RETENTION" != "keep-all" && "$RETENTION" != "keep-restartable" && "$RETENTION" != "results-only" ]]; then
+    echo "Error: Invalid retention level: $RETENTION" >&2
+    echo "Valid levels: keep-all, keep-restartable, results-only" >&2
+    exit 1
+fi
+ENGINE_ARGS="${ENGINE_ARGS} --retention ${RETENTION}"
+
 # Validate analysis types
 for analysis_type in "${ANALYSIS_TYPES[@]}"; do
     if [[ "$analysis_type" != "randomise" && "$analysis_type" != "flameo" ]]; then
@@ -281,6 +405,9 @@ echo "Group-Level Voxel-Wise SLURM Script Generator"
 echo "=========================================="
 echo "Data source: $DATA_SOURCE"
 echo "Analysis types: ${ANALYSIS_TYPES[*]}"
+echo "Group-level engine: $ENGINE (adaptive permutations: $ADAPTIVE_PERM)"
+echo "Cluster engine: $CLUSTER_ENGINE"
+echo "Batch mode: $BATCH (family-wise across copes: $([[ "$NO_FAMILY_WISE" == true ]] && echo false || echo true))"
 echo "Account: $ACCOUNT"
 echo "Partition: $PARTITION"
 echo "CPUs per task: $CPUS_PER_TASK"
@@ -325,11 +452,24 @@ for task in "${TASKS[@]}"; do
     fi
     
     echo "Generating scripts for task: $task (available copes: $CONTRASTS)"
+
+    # Batch mode: one job covers every available cope of the task
+    if [[ "$BATCH" == true ]]; then
+        JOB_UNITS=("all")
+    else
+        JOB_UNITS=($CONTRASTS)
+    fi
     
-    for contrast in $CONTRASTS; do
+    for contrast in "${JOB_UNITS[@]}"; do
         for analysis_type in "${ANALYSIS_TYPES[@]}"; do
-            # Create job name
-            job_name="group_${task}_cope${contrast}_${analysis_type}"
+            # Create job name and contrast selection
+            if [[ "$contrast" == "all" ]]; then
+                job_name="group_${task}_allcopes_${analysis_type}"
+                contrast_args="--contrasts ${CONTRASTS}"
+            else
+                job_name="group_${task}_cope${contrast}_${analysis_type}"
+                contrast_args="--contrast ${contrast}"
+            fi
             script_path="${SCRIPT_DIR}/${job_name}.sh"
             out_path="${SCRIPT_DIR}/${job_name}_%j.out"
             err_path="${SCRIPT_DIR}/${job_name}_%j.err"
@@ -349,12 +489,13 @@ for task in "${TASKS[@]}"; do
 #SBATCH --error=${err_path}
 
 module load apptainer
-apptainer exec -B /gscratch/fang:/data -B /gscratch/scrubbed/fanglab/xiaoqian:/scrubbed_dir -B /gscratch/scrubbed/fanglab/xiaoqian/repo/hyak_narsad_timeEffect/group_level_workflows.py:/app/group_level_workflows.py -B /gscratch/scrubbed/fanglab/xiaoqian/repo/hyak_narsad_timeEffect/run_group_voxelWise.py:/app/run_group_voxelWise.py ${CONTAINER_PATH} \\
+apptainer exec ${BIND_ARGS} ${CONTAINER_PATH} \\
     python3 /app/${SCRIPT_NAME} \\
     --task ${task} \\
-    --contrast ${contrast} \\
+    ${contrast_args} \\
     --analysis-type ${analysis_type} \\
     --data-source ${DATA_SOURCE} \\
+    ${ENGINE_ARGS} \\
     --base-dir /data/NARSAD/MRI/derivatives/fMRI_analysis
 
 EOF
@@ -29,6 +29,18 @@ USAGE:
     # Dry run to see what would be created
     python3 create_pre_group_voxelWise.py --dry-run
     
+    # One single-pass job per phase instead of one job per cope
+    python3 create_pre_group_voxelWise.py --single-pass
+    
+    # Single-pass jobs that only merge added subjects into the existing outputs
+    python3 create_pre_group_voxelWise.py --single-pass --incremental
+    
+    # Placebo subset derived from the standard outputs (run after the standard jobs)
+    python3 create_pre_group_voxelWise.py --data-source placebo --from-standard
+    
+    # Per-cope jobs that run their workflows on node-local scratch
+    python3 create_pre_group_voxelWise.py --stage-local
+    
     # Show help
     python3 create_pre_group_voxelWise.py --help
 
@@ -74,6 +86,7 @@ SLURM PARAMETERS:
 OUTPUT:
     Creates SLURM scripts in script_dir:
     - pre_group_sub-XXX_phaseY.sh (individual job scripts)
+    - pre_group_phaseY_allcopes.sh (with --single-pass, one job per phase)
     - launch_all_pre_group.sh (launch all jobs)
     - monitor_jobs.sh (monitor job progress)
     - logs/ directory for job outputs
@@ -168,10 +181,28 @@ def get_cope_list(derivatives_dir):
     logger.info(f"Found copes: {[f'{c[0]}-cope{c[1]}' for c in unique_copes]}")
     return unique_copes
 
-def create_slurm_script(phase, cope_num, output_dir, script_dir, slurm_params, data_source, include_columns):
-    """Create a SLURM script for a specific phase and cope."""
-    
-    script_name = f"pre_group_{phase}_cope{cope_num}.sh"
+def create_slurm_script(phase, cope_num, output_dir, script_dir, slurm_params, data_source, include_columns,
+                        build_store=False, from_standard=False, stage_local=False, retention='keep-all',
+                        incremental=False):
+    """Create a SLURM script for a specific phase and cope.
+    
+    If cope_num is None, the script merges all copes of the phase in a single
+    pass (run_pre_group_voxelWise.py --single-pass). build_store additionally
+    packs the phase's merged outputs into the chunked cope store. from_standard
+    derives a placebo/guess subset for all copes of the phase from the standard
+    outputs (run_pre_group_voxelWise.py --from-standard). stage_local runs the
+    per-cope workflow on node-local scratch (--stage-local); retention is the
+    working-directory retention level (--retention). incremental updates the
+    existing single-pass merged outputs for added/excluded subjects (--incremental).
+    """
+    
+    if from_standard:
+        job_label = f"{phase}_subset"
+    elif cope_num is not None:
+        job_label = f"{phase}_cope{cope_num}"
+    else:
+        job_label = f"{phase}_allcopes"
+    script_name = f"pre_group_{job_label}.sh"
     script_path = os.path.join(script_dir, script_name)
     
     # Container bind mounts
@@ -180,6 +211,22 @@ def create_slurm_script(phase, cope_num, output_dir, script_dir, slurm_params, d
         "-B /gscratch/scrubbed/fanglab/xiaoqian:/scrubbed_dir",
         "-B /gscratch/scrubbed/fanglab/xiaoqian/repo/hyak_narsad_timeEffect/group_level_workflows.py:/app/group_level_workflows.py",
         "-B /gscratch/scrubbed/fanglab/xiaoqian/repo/hyak_narsad_timeEffect/run_pre_group_voxelWise.py:/app/run_pre_group_voxelWise.py",
+        "-B /gscratch/scrubbed/fanglab/xiaoqian/repo/hyak_narsad_timeEffect/pre_group_merge.py:/app/pre_group_merge.py",
+        "-B /gscratch/scrubbed/fanglab/xiaoqian/repo/hyak_narsad_timeEffect/resampling.py:/app/resampling.py",
+        "-B /gscratch/scrubbed/fanglab/xiaoqian/repo/hyak_narsad_timeEffect/design_cache.py:/app/design_cache.py",
+        "-B /gscratch/scrubbed/fanglab/xiaoqian/repo/hyak_narsad_timeEffect/result_promotion.py:/app/result_promotion.py",
+        "-B /gscratch/scrubbed/fanglab/xiaoqian/repo/hyak_narsad_timeEffect/cope_store.py:/app/cope_store.py",
+        "-B /gscratch/scrubbed/fanglab/xiaoqian/repo/hyak_narsad_timeEffect/native_randomise.py:/app/native_randomise.py",
+        "-B /gscratch/scrubbed/fanglab/xiaoqian/repo/hyak_narsad_timeEffect/tfce.py:/app/tfce.py",
+        "-B /gscratch/scrubbed/fanglab/xiaoqian/repo/hyak_narsad_timeEffect/native_flame.py:/app/native_flame.py",
+        "-B /gscratch/scrubbed/fanglab/xiaoqian/repo/hyak_narsad_timeEffect/native_cluster.py:/app/native_cluster.py",
+        "-B /gscratch/scrubbed/fanglab/xiaoqian/repo/hyak_narsad_timeEffect/roi_engine.py:/app/roi_engine.py",
+        "-B /gscratch/scrubbed/fanglab/xiaoqian/repo/hyak_narsad_timeEffect/roi_stats.py:/app/roi_stats.py",
+        "-B /gscratch/scrubbed/fanglab/xiaoqian/repo/hyak_narsad_timeEffect/group_results_db.py:/app/group_results_db.py",
+        "-B /gscratch/scrubbed/fanglab/xiaoqian/repo/hyak_narsad_timeEffect/nifti_cache.py:/app/nifti_cache.py",
+        "-B /gscratch/scrubbed/fanglab/xiaoqian/repo/hyak_narsad_timeEffect/scratch_staging.py:/app/scratch_staging.py",
+        "-B /gscratch/scrubbed/fanglab/xiaoqian/repo/hyak_narsad_timeEffect/workdir_retention.py:/app/workdir_retention.py",
+        "-B /gscratch/scrubbed/fanglab/xiaoqian/repo/hyak_narsad_timeEffect/completion_ledger.py:/app/completion_ledger.py",
         "-B /gscratch/scrubbed/fanglab/xiaoqian/repo/hyak_narsad_timeEffect:/app/updated"
     ]
     
@@ -188,27 +235,43 @@ def create_slurm_script(phase, cope_num, output_dir, script_dir, slurm_params, d
     host_output_dir = output_dir.replace('/data', '/gscratch/fang')
 
     # Build the command string
+    if from_standard:
+        cope_arg = "--from-standard"
+    else:
+        cope_arg = f"--cope {cope_num}" if cope_num is not None else "--single-pass"
     cmd_base = f"""python3 /app/run_pre_group_voxelWise.py \\
     --output-dir {output_dir} \\
     --phase {phase} \\
-    --cope {cope_num} \\
+    {cope_arg} \\
     --data-source {data_source}"""
     
     if include_columns:
         cmd_base += f" \\\n    --include-columns {include_columns}"
     
+    if incremental:
+        cmd_base += " \\\n    --incremental"
+    
+    if build_store:
+        cmd_base += " \\\n    --build-store"
+    
+    if stage_local:
+        cmd_base += " \\\n    --stage-local"
+    
+    if retention != 'keep-all':
+        cmd_base += f" \\\n    --retention {retention}"
+    
     # Script content
     script_content = f"""#!/bin/bash
-#SBATCH --job-name=pre_group_{phase}_cope{cope_num}
+#SBATCH --job-name=pre_group_{job_label}
 #SBATCH --partition={slurm_params['partition']}
 #SBATCH --account={slurm_params['account']}
 #SBATCH --time={slurm_params['time']}
 #SBATCH --mem={slurm_params['mem']}
 #SBATCH --cpus-per-task={slurm_params['cpus_per_task']}
-#SBATCH --output=logs/pre_group_{phase}_cope{cope_num}_%j.out
-#SBATCH --error=logs/pre_group_{phase}_cope{cope_num}_%j.err
+#SBATCH --output=logs/pre_group_{job_label}_%j.out
+#SBATCH --error=logs/pre_group_{job_label}_%j.err
 
-# Pre-group voxel-wise analysis for {phase} - cope{cope_num}
+# Pre-group voxel-wise analysis for {job_label}
 # Generated by create_pre_group_voxelWise.py
 
 set -e
@@ -223,11 +286,11 @@ export DATA_DIR=/data
 # Create output directory on host (before container launch)
 mkdir -p {host_output_dir}
 
-# Run the pre-group analysis for this phase and cope
+# Run the pre-group analysis for this phase and cope(s)
 apptainer exec {' '.join(container_binds)} {slurm_params['container']} \\
     {cmd_base}
 
-echo "Completed pre-group analysis for {phase} - cope{cope_num}"
+echo "Completed pre-group analysis for {job_label}"
 """
     
     # Write script
@@ -285,6 +348,43 @@ Examples:
         help='Comma-separated list of columns to include (e.g., "subID,group_id,drug_id")'
     )
     
+    parser.add_argument(
+        '--single-pass',
+        action='store_true',
+        help='Create one job per phase that merges all copes in a single pass over subjects'
+    )
+    
+    parser.add_argument(
+        '--incremental',
+        action='store_true',
+        help='With --single-pass, update the existing merged outputs instead of merging all subjects again'
+    )
+    
+    parser.add_argument(
+        '--from-standard',
+        action='store_true',
+        help='For placebo/guess, create one job per phase that indexes the standard merged outputs'
+    )
+    
+    parser.add_argument(
+        '--build-store',
+        action='store_true',
+        help='With --single-pass, also build the chunked cope store for each phase'
+    )
+    
+    parser.add_argument(
+        '--stage-local',
+        action='store_true',
+        help='Run the per-cope workflows on node-local scratch with a resumable handoff on preemption'
+    )
+    
+    parser.add_argument(
+        '--retention',
+        default='keep-all',
+        choices=['keep-all', 'keep-restartable', 'results-only'],
+        help='Working-directory retention level for the per-cope workflows (default: keep-all)'
+    )
+    
     parser.add_argument(
         '--dry-run',
         action='store_true',
@@ -293,6 +393,13 @@ Examples:
     
     args = parser.parse_args()
     
+    if args.build_store and not args.single_pass:
+        parser.error("--build-store requires --single-pass (the store covers all copes of a phase)")
+    if args.from_standard and args.data_source == 'standard':
+        parser.error("--from-standard requires --data-source placebo or guess")
+    if args.incremental and not args.single_pass:
+        parser.error("--incremental requires --single-pass")
+    
     # Use container paths directly since this script runs inside the container
     logger.info("Using container paths directly")
     output_dir = '/data/NARSAD/MRI/derivatives/fMRI_analysis/groupLevel_timeEffect'
@@ -371,16 +478,26 @@ Examples:
     
     logger.info(f"Found {len(phase_cope_pairs)} phase-cope combinations to process")
     
+    # In single-pass and subset modes every phase becomes one job covering all of its copes
+    if args.single_pass or args.from_standard:
+        phase_cope_pairs = [(phase, None) for phase in sorted({p for p, _ in phase_cope_pairs})]
+        logger.info(f"Single-pass mode: {len(phase_cope_pairs)} phase jobs")
+    
     if args.dry_run:
         logger.info("DRY RUN - Would create the following scripts:")
         for phase, cope_num in phase_cope_pairs:
-            logger.info(f"  pre_group_{phase}_cope{cope_num}.sh")
+            if args.from_standard:
+                logger.info(f"  pre_group_{phase}_subset.sh")
+            else:
+                logger.info(f"  pre_group_{phase}_{'allcopes' if cope_num is None else f'cope{cope_num}'}.sh")
         return
     
     # Create individual SLURM scripts
     created_scripts = []
     for phase, cope_num in phase_cope_pairs:
-        script_path = create_slurm_script(phase, cope_num, output_dir, script_dir, slurm_params, args.data_source, args.include_columns)
+        script_path = create_slurm_script(phase, cope_num, output_dir, script_dir, slurm_params, args.data_source, args.include_columns,
+                                          args.build_store, args.from_standard, args.stage_local,
+                                          args.retention, args.incremental)
         created_scripts.append(script_path)
         logger.info(f"Created: {script_path}")
     
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+"""
+Content-addressed cache of group-level design files.
+
+The design (design.mat, design.grp, contrast.con) depends only on the subject
+set and the group_info columns, not on the contrast, yet it used to be rebuilt
+inside every per-contrast workflow. Designs are now compiled once per
+(task, data source, subject-set fingerprint) into
+
+    <cache_root>/<fingerprint>/design_files/
+
+and hardlinked into each contrast's design_files directory. A design_info.json
+next to the design records the fingerprint and subject order, so jobs can
+refuse to run when a contrast's inputs do not match its design.
+
+Author: Xiaoqian Xiao (xiao.xiaoqian.320@gmail.com)
+"""
+
+import os
+import re
+import json
+import shutil
+import hashlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+# =============================================================================
+# CONSTANTS
+# =============================================================================
+
+DESIGN_INFO_NAME = 'design_info.json'
+_SUBJECT_PATTERN = re.compile(r'sub-([A-Za-z0-9]+)')
+
+# =============================================================================
+# FINGERPRINTS
+# =============================================================================
+
+def design_fingerprint(task, data_source, group_info, columns=None):
+    """
+    Return the fingerprint identifying a design.
+
+    Args:
+        task (str): Task name
+        data_source (str): Data source ('standard', 'placebo', 'guess')
+        group_info (list): Group information rows (subject ID first), in design order
+        columns (list): group_info column names, if known
+
+    Returns:
+        str: SHA-256 hex digest
+    """
+    payload = {
+        'task': task,
+        'data_source': data_source,
+        'columns': list(columns) if columns else None,
+        'rows': [[str(v) for v in row] for row in group_info],
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+
+def subjects_from_files(files):
+    """Extract subject IDs (without 'sub-') from BIDS file paths, keeping order."""
+    subjects = []
+    for path in files:
+        match = _SUBJECT_PATTERN.search(os.path.basename(path)) or _SUBJECT_PATTERN.search(path)
+        subjects.append(match.group(1) if match else None)
+    return subjects
+
+# =============================================================================
+# COMPILATION AND LINKING
+# =============================================================================
+
+def compile_design(group_info, task, data_source, cache_root, columns=None):
+    """
+    Compile the design for a subject set once and return its cache entry.
+
+    Args:
+        group_info (list): Group information rows (subject ID first), in design order
+        task (str): Task name
+        data_source (str): Data source ('standard', 'placebo', 'guess')
+        cache_root (str): Root of the design cache
+        columns (list): group_info column names, if known
+
+    Returns:
+        str: Cache entry directory (contains design_files/)
+    """
+    from group_level_workflows import create_dummy_design_files
+
+    fingerprint = design_fingerprint(task, data_source, group_info, columns)
+    entry_dir = os.path.join(cache_root, fingerprint)
+    info_file = os.path.join(entry_dir, 'design_files', DESIGN_INFO_NAME)
+
+    if os.path.exists(info_file):
+        logger.info(f"Using cached design {fingerprint[:12]} for task-{task} ({data_source})")
+        return entry_dir
+
+    # Build next to the final entry and rename into place
+    staging_dir = f"{entry_dir}.{os.getpid()}.partial"
+    if os.path.exists(staging_dir):
+        shutil.rmtree(staging_dir)
+    create_dummy_design_files(group_info, staging_dir)
+
+    info = {
+        'fingerprint': fingerprint,
+        'task': task,
+        'data_source': data_source,
+        'columns': list(columns) if columns else None,
+        'subjects': [str(row[0]) for row in group_info],
+    }
+    with open(os.path.join(staging_dir, 'design_files', DESIGN_INFO_NAME), 'w') as f:
+        json.dump(info, f, indent=2)
+
+    try:
+        os.replace(staging_dir, entry_dir)
+    except OSError:
+        # Another job compiled the same design first
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        if not os.path.exists(info_file):
+            raise
+
+    logger.info(f"Compiled design {fingerprint[:12]} for task-{task} ({data_source}): "
+                f"{len(group_info)} subjects")
+    return entry_dir
+
+
+def link_design(entry_dir, contrast_dir):
+    """
+    Link a cached design into a contrast directory's design_files.
+
+    Args:
+        entry_dir (str): Cache entry returned by compile_design
+        contrast_dir (str): Contrast results directory
+
+    Returns:
+        str: The contrast's design_files directory
+    """
+    from result_promotion import promote_tree
+
+    design_dir = os.path.join(contrast_dir, 'design_files')
+    promote_tree(os.path.join(entry_dir, 'design_files'), design_dir, mode='link', checksum=False)
+    return design_dir
+
+
+def read_design_info(design_dir):
+    """Return the design_info.json of a design_files directory, or None if missing."""
+    info_file = os.path.join(design_dir, DESIGN_INFO_NAME)
+    if not os.path.exists(info_file):
+        return None
+    with open(info_file) as f:
+        return json.load(f)
+
+
+def verify_design_subjects(design_dir, subjects):
+    """
+    Refuse a design whose subject order differs from the collected inputs.
+
+    Args:
+        design_dir (str): design_files directory
+        subjects (list): Subject IDs of the collected inputs, in merge order
+
+    Raises:
+        ValueError: If the subjects do not match the design fingerprint
+    """
+    info = read_design_info(design_dir)
+    if info is None:
+        raise ValueError(f"No {DESIGN_INFO_NAME} in {design_dir}; cannot verify the design")
+
+    expected = [str(s) for s in info['subjects']]
+    collected = [str(s) for s in subjects]
+    if collected != expected:
+        missing = sorted(set(expected) - set(collected))
+        extra = sorted(set(collected) - set(expected))
+        raise ValueError(
+            f"Collected subjects do not match design {info['fingerprint'][:12]} in {design_dir} "
+            f"(missing: {missing}, unexpected: {extra}, "
+            f"order differs: {not missing and not extra})"
+        )
@@ -5,6 +5,7 @@ from nipype.interfaces import fsl, utility as niu, io as nio
 from niworkflows.interfaces.bids import DerivativesDataSink as BIDSDerivatives
 from utils import _dict_ds
 from utils import _dict_ds_lss
+from utils import subject_records
 from utils import _bids2nipypeinfo
 from utils import _bids2nipypeinfo_lss
 from nipype.interfaces.fsl import SUSAN, ApplyMask, FLIRT, FILMGLS, Level1Design, FEATModel
@@ -340,7 +341,8 @@ def first_level_wf(in_files, output_dir, condition_names=None, contrasts=None,
     Generic first-level workflow for fMRI analysis.
     
     Args:
-        in_files (dict): Input files dictionary
+        in_files (dict or list): Input files dictionary {sub: {...}}, or per-subject
+                                 SubjectRecord inputs (utils.subject_records)
         output_dir (str): Output directory path
         condition_names (list): List of condition names (auto-detected if None)
         contrasts (list): List of contrast tuples (auto-generated if None)
@@ -366,8 +368,7 @@ def first_level_wf(in_files, output_dir, condition_names=None, contrasts=None,
     # Data source
     datasource = pe.Node(niu.Function(function=_dict_ds, output_names=DATA_ITEMS),
                          name='datasource')
-    datasource.inputs.in_dict = in_files
-    datasource.iterables = ('sub', sorted(in_files.keys()))
+    datasource.iterables = ('sub', subject_records(in_files))
 
     # Extract motion parameters from regressors file
     runinfo = pe.Node(niu.Function(
@@ -479,7 +480,8 @@ def first_level_wf_LSS(in_files, output_dir, trial_ID, condition_names=None, con
     fine-grained temporal information and avoid blurring trial-specific responses.
     
     Args:
-        in_files (dict): Input files dictionary
+        in_files (dict or list): Input files dictionary {sub: {...}}, or per-subject
+                                 SubjectRecord inputs (utils.subject_records)
         output_dir (str): Output directory path
         trial_ID (int): Trial ID for LSS analysis
         condition_names (list): List of condition names (auto-detected if None)
@@ -505,8 +507,7 @@ def first_level_wf_LSS(in_files, output_dir, trial_ID, condition_names=None, con
 
     datasource = pe.Node(niu.Function(function=_dict_ds_lss, output_names=DATA_ITEMS_LSS),
                          name='datasource')
-    datasource.inputs.in_dict = in_files
-    datasource.iterables = ('sub', sorted(in_files.keys()))
+    datasource.iterables = ('sub', subject_records(in_files))
 
     # Extract motion parameters from regressors file
     runinfo = pe.Node(niu.Function(
@@ -630,7 +631,8 @@ def first_level_wf_voxelwise(inputs, output_dir, condition_names=None, contrasts
     need to be handled as separate regressors, separate from the main condition contrasts.
     
     Args:
-        inputs (dict): Input files dictionary
+        inputs (dict or list): Input files dictionary {sub: {...}}, or per-subject
+                               SubjectRecord inputs (utils.subject_records)
         output_dir (str): Output directory path
         condition_names (list): List of condition names (auto-detected if None)
         contrasts (list): List of contrast tuples (auto-generated if None)
@@ -656,8 +658,7 @@ def first_level_wf_voxelwise(inputs, output_dir, condition_names=None, contrasts
     # Data source
     datasource = pe.Node(niu.Function(function=_dict_ds, output_names=DATA_ITEMS),
                          name='datasource')
-    datasource.inputs.in_dict = inputs
-    datasource.iterables = ('sub', sorted(inputs.keys()))
+    datasource.iterables = ('sub', subject_records(inputs))
 
     # Extract motion parameters from regressors file
     runinfo = pe.Node(niu.Function(
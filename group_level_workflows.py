@@ -8,6 +8,13 @@ import glob
 import subprocess
 import pandas as pd
 import numpy as np
+from resampling import resample_inputs_to_grid
+from native_randomise import run_randomise_node
+from native_flame import run_flame_node
+from native_cluster import run_cluster_node
+from roi_engine import extract_all_roi_values, indexed_roi_files
+from roi_stats import run_roi_stats_node
+from result_promotion import write_sink_manifest
 
 # Author: Xiaoqian Xiao (xiao.xiaoqian.320@gmail.com)
 
@@ -15,8 +22,15 @@ import numpy as np
 # WORKFLOW DEFINITIONS
 # =============================================================================
 
-def wf_data_prepare(output_dir, contrast, name="wf_data_prepare"):
-    """Workflow for data preparation and merging (renamed from data_prepare_wf)."""
+def wf_data_prepare(output_dir, contrast, name="wf_data_prepare", resample_engine='fsl',
+                    weight_cache_dir=None, compile_design=True):
+    """Workflow for data preparation and merging (renamed from data_prepare_wf).
+
+    resample_engine selects how off-grid inputs are resampled: 'fsl' (FLIRT per
+    image, default) or 'native' (cached sparse trilinear weights, shared across
+    copes, varcopes and contrasts). With compile_design=False the design is not built
+    here; the caller links a design compiled once per subject set (design_cache).
+    """
     wf = Workflow(name=name, base_dir=output_dir)
 
     # Input node
@@ -31,14 +45,20 @@ def wf_data_prepare(output_dir, contrast, name="wf_data_prepare"):
                       name='design_gen')
     design_gen.inputs.output_dir = output_dir
 
+    # Per-subject resampling, skipped for inputs already on the group mask grid
+    resample_inputs = Node(Function(input_names=['in_copes', 'in_varcopes', 'reference', 'n_procs',
+                                                 'engine', 'cache_dir'],
+                                    output_names=['out_copes', 'out_varcopes'],
+                                    function=resample_inputs_to_grid),
+                           name='resample_inputs')
+    resample_inputs.inputs.n_procs = 4
+    resample_inputs.inputs.engine = resample_engine
+    resample_inputs.inputs.cache_dir = weight_cache_dir
+
     # Merge nodes
     merge_copes = Node(Merge(dimension='t', output_type='NIFTI_GZ'), name='merge_copes')
     merge_varcopes = Node(Merge(dimension='t', output_type='NIFTI_GZ'), name='merge_varcopes')
 
-    # Resample nodes with explicit output file specification
-    resample_copes = Node(FLIRT(apply_isoxfm=2), name='resample_copes')
-    resample_varcopes = Node(FLIRT(apply_isoxfm=2), name='resample_varcopes')
-
     # Rename nodes
     rename_copes = Node(Function(input_names=['in_file', 'output_dir', 'contrast', 'file_type'],
                                  output_names=['out_file'],
@@ -61,26 +81,30 @@ def wf_data_prepare(output_dir, contrast, name="wf_data_prepare"):
 
     # Workflow connections
     wf.connect([
-        (inputnode, design_gen, [('group_info', 'group_info')]),
-        (inputnode, merge_copes, [('in_copes', 'in_files')]),
-        (inputnode, merge_varcopes, [('in_varcopes', 'in_files')]),
-        (inputnode, resample_copes, [('group_mask', 'reference')]),
-        (inputnode, resample_varcopes, [('group_mask', 'reference')]),
-        (merge_copes, resample_copes, [('merged_file', 'in_file')]),
-        (merge_varcopes, resample_varcopes, [('merged_file', 'in_file')]),
-        (resample_copes, rename_copes, [('out_file', 'in_file')]),
-        (resample_varcopes, rename_varcopes, [('out_file', 'in_file')]),
+        (inputnode, resample_inputs, [('in_copes', 'in_copes'),
+                                      ('in_varcopes', 'in_varcopes'),
+                                      ('group_mask', 'reference')]),
+        (resample_inputs, merge_copes, [('out_copes', 'in_files')]),
+        (resample_inputs, merge_varcopes, [('out_varcopes', 'in_files')]),
+        (merge_copes, rename_copes, [('merged_file', 'in_file')]),
+        (merge_varcopes, rename_varcopes, [('merged_file', 'in_file')]),
         (rename_copes, datasink, [('out_file', 'merged_copes')]),
-        (rename_varcopes, datasink, [('out_file', 'merged_varcopes')]),
-        (design_gen, datasink, [('design_file', 'design_files.design_file'),
-                                ('grp_file', 'design_files.grp_file'),
-                                ('con_file', 'design_files.con_file')])
+        (rename_varcopes, datasink, [('out_file', 'merged_varcopes')])
     ])
 
+    if compile_design:
+        wf.connect([
+            (inputnode, design_gen, [('group_info', 'group_info')]),
+            (design_gen, datasink, [('design_file', 'design_files.design_file'),
+                                    ('grp_file', 'design_files.grp_file'),
+                                    ('con_file', 'design_files.con_file')])
+        ])
+
     return wf
 
 
-def wf_roi_extract(output_dir, roi_dir="/Users/xiaoqianxiao/tool/parcellation/ROIs", name="wf_roi_extract"):
+def wf_roi_extract(output_dir, roi_dir="/Users/xiaoqianxiao/tool/parcellation/ROIs", name="wf_roi_extract",
+                   engine='fsl'):
     """Workflow to extract ROI beta values and PSC from fMRI data.
     
     This workflow extracts mean beta values and percent signal change (PSC) 
@@ -128,19 +152,51 @@ def wf_roi_extract(output_dir, roi_dir="/Users/xiaoqianxiao/tool/parcellation/RO
     OUTPUTS:
     - beta_csv: Mean beta values for each ROI across subjects
     - psc_csv: Percent signal change values for each ROI across subjects
-    - Individual text files for each ROI with subject-wise values
+    - Individual text files for each ROI with subject-wise values (engine='fsl')
     
     Args:
         output_dir (str): Output directory
         roi_dir (str): Directory containing ROI mask files
         name (str): Workflow name
+        engine (str): 'fsl' (default) runs fslstats per ROI; 'native' reads each
+                      4D file once and computes all ROI means as one sparse
+                      matrix product (roi_engine)
     """
     wf = Workflow(name=name, base_dir=output_dir)
 
-    # Input node
-    inputnode = Node(IdentityInterface(fields=['cope_file', 'baseline_file', 'result_dir']),
+    # Input node (store_file/contrast/baseline_contrast let engine='native' read the cope store)
+    inputnode = Node(IdentityInterface(fields=['cope_file', 'baseline_file', 'result_dir', 'store_file',
+                                               'contrast', 'baseline_contrast']),
                      name='inputnode')
 
+    # Output node
+    outputnode = Node(IdentityInterface(fields=['beta_csv', 'psc_csv']),
+                      name='outputnode')
+
+    # DataSink
+    datasink = Node(DataSink(base_directory=output_dir), name='datasink')
+
+    if engine == 'native':
+        # All ROIs in one pass over each 4D file
+        roi_extract = Node(Function(input_names=['cope_file', 'roi_dir', 'baseline_file', 'output_dir',
+                                                 'store_file', 'contrast', 'baseline_contrast'],
+                                    output_names=['beta_csv', 'psc_csv'],
+                                    function=extract_all_roi_values),
+                           name='roi_extract')
+        roi_extract.inputs.roi_dir = roi_dir
+        wf.connect([
+            (inputnode, roi_extract, [('cope_file', 'cope_file'),
+                                      ('baseline_file', 'baseline_file'),
+                                      ('store_file', 'store_file'),
+                                      ('contrast', 'contrast'),
+                                      ('baseline_contrast', 'baseline_contrast')]),
+            (roi_extract, outputnode, [('beta_csv', 'beta_csv'),
+                                       ('psc_csv', 'psc_csv')]),
+            (outputnode, datasink, [('beta_csv', 'roi_results.@beta_csv'),
+                                    ('psc_csv', 'roi_results.@psc_csv')])
+        ])
+        return wf
+
     # Node to get ROI files
     roi_node = Node(Function(input_names=['roi_dir'], output_names=['roi_files'], function=get_roi_files),
                     name='roi_node')
@@ -161,13 +217,6 @@ def wf_roi_extract(output_dir, roi_dir="/Users/xiaoqianxiao/tool/parcellation/RO
                        name='roi_combine')
     roi_combine.inputs.output_dir = output_dir
 
-    # Output node
-    outputnode = Node(IdentityInterface(fields=['beta_csv', 'psc_csv']),
-                      name='outputnode')
-
-    # DataSink
-    datasink = Node(DataSink(base_directory=output_dir), name='datasink')
-
     # Workflow connections
     wf.connect([
         # Inputs to roi_extract
@@ -194,30 +243,56 @@ def wf_roi_extract(output_dir, roi_dir="/Users/xiaoqianxiao/tool/parcellation/RO
 
 
 
-def wf_flameo(output_dir, name="wf_flameo"):
-    """Workflow for group-level analysis with FLAMEO and clustering (GRF with dlh)."""
+def wf_flameo(output_dir, name="wf_flameo", engine='fsl', n_procs=4, cluster_engine='fsl'):
+    """Workflow for group-level analysis with FLAMEO and clustering (GRF with dlh).
+
+    engine='native' replaces FLAMEO flame1 with the in-process mixed-effects
+    estimator (native_flame), which writes FLAMEO-named zstats for the same
+    smoothness and clustering stages.
+    cluster_engine='native' replaces the per-zstat SmoothEstimate and Cluster
+    MapNodes with one in-process stage (native_cluster) that estimates
+    smoothness once from the design's residuals and clusters every zstat.
+    Every file written by the sink is listed in <output_dir>/<name>_sink_manifest.json.
+    """
     wf = Workflow(name=name, base_dir=output_dir)
 
     inputnode = Node(IdentityInterface(fields=['cope_file', 'var_cope_file', 'mask_file',
                                                'design_file', 'grp_file', 'con_file', 'result_dir']),
                      name='inputnode')
 
-    flameo = Node(FLAMEO(run_mode='flame1'), name='flameo')  # flame1 for mixed effects
-
-    # Smoothness estimation for GRF clustering
-    smoothness = MapNode(SmoothEstimate(),
-                         iterfield=['zstat_file'],  # Only zstat_file iterates
-                         name='smoothness')
-
-    # Clustering node with dlh for GRF-based correction
-    clustering = MapNode(Cluster(threshold=2.3,  # Z-threshold (e.g., 2.3 or 3.1)
-                                 connectivity=26,  # 3D connectivity
-                                 out_threshold_file=True,
-                                 out_index_file=True,
-                                 out_localmax_txt_file=True,  # Local maxima text file
-                                 pthreshold=0.05),  # Cluster-level FWE threshold
-                         iterfield=['in_file', 'dlh', 'volume'],
-                         name='clustering')
+    if engine == 'native':
+        flameo = Node(Function(input_names=['cope_file', 'var_cope_file', 'mask_file', 'design_file',
+                                            't_con_file', 'cov_split_file', 'n_procs'],
+                               output_names=['zstats', 'tstats', 'copes', 'var_copes', 'res4d'],
+                               function=run_flame_node),
+                      name='flameo')
+        flameo.inputs.n_procs = n_procs
+    else:
+        flameo = Node(FLAMEO(run_mode='flame1'), name='flameo')  # flame1 for mixed effects
+
+    if cluster_engine == 'native':
+        # Smoothness from residuals and GRF clustering of all zstats in one node
+        clustering = Node(Function(input_names=['zstat_files', 'mask_file', 'res4d', 'z_threshold', 'p_threshold'],
+                                   output_names=['threshold_file', 'index_file', 'localmax_txt_file'],
+                                   function=run_cluster_node),
+                          name='clustering')
+        clustering.inputs.z_threshold = 2.3
+        clustering.inputs.p_threshold = 0.05
+    else:
+        # Smoothness estimation for GRF clustering
+        smoothness = MapNode(SmoothEstimate(),
+                             iterfield=['zstat_file'],  # Only zstat_file iterates
+                             name='smoothness')
+
+        # Clustering node with dlh for GRF-based correction
+        clustering = MapNode(Cluster(threshold=2.3,  # Z-threshold (e.g., 2.3 or 3.1)
+                                     connectivity=26,  # 3D connectivity
+                                     out_threshold_file=True,
+                                     out_index_file=True,
+                                     out_localmax_txt_file=True,  # Local maxima text file
+                                     pthreshold=0.05),  # Cluster-level FWE threshold
+                             iterfield=['in_file', 'dlh', 'volume'],
+                             name='clustering')
 
     outputnode = Node(IdentityInterface(fields=['zstats', 'cluster_thresh', 'cluster_index', 'cluster_peaks']),
                       name='outputnode')
@@ -233,15 +308,6 @@ def wf_flameo(output_dir, name="wf_flameo"):
                              ('grp_file', 'cov_split_file'),
                              ('con_file', 't_con_file')]),
 
-        # Smoothness estimation
-        (flameo, smoothness, [(('zstats', flatten_stats), 'zstat_file')]),
-        (inputnode, smoothness, [('mask_file', 'mask_file')]),  # Single mask, no iteration
-
-        # Clustering with dlh
-        (flameo, clustering, [(('zstats', flatten_stats), 'in_file')]),
-        (smoothness, clustering, [('volume', 'volume')]),
-        (smoothness, clustering, [('dlh', 'dlh')]),
-
         # Outputs to outputnode
         (flameo, outputnode, [('zstats', 'zstats')]),
         (clustering, outputnode, [('threshold_file', 'cluster_thresh'),
@@ -254,16 +320,56 @@ def wf_flameo(output_dir, name="wf_flameo"):
                                 ('cluster_index', 'cluster_results.@index'),
                                 ('cluster_peaks', 'cluster_results.@peaks')])
     ])
+
+    if cluster_engine == 'native':
+        wf.connect([
+            (flameo, clustering, [(('zstats', flatten_stats), 'zstat_files'),
+                                  ('res4d', 'res4d')]),
+            (inputnode, clustering, [('mask_file', 'mask_file')]),
+        ])
+    else:
+        wf.connect([
+            # Smoothness estimation
+            (flameo, smoothness, [(('zstats', flatten_stats), 'zstat_file')]),
+            (inputnode, smoothness, [('mask_file', 'mask_file')]),  # Single mask, no iteration
+
+            # Clustering with dlh
+            (flameo, clustering, [(('zstats', flatten_stats), 'in_file')]),
+            (smoothness, clustering, [('volume', 'volume')]),
+            (smoothness, clustering, [('dlh', 'dlh')]),
+        ])
+    add_sink_manifest(wf, datasink, output_dir, name)
     return wf
 
-def wf_randomise(output_dir, name="wf_randomise"):
-    """Workflow for group-level analysis with Randomise and TFCE."""
+def wf_randomise(output_dir, name="wf_randomise", engine='fsl', n_procs=4, adaptive=False):
+    """Workflow for group-level analysis with Randomise and TFCE.
+
+    engine='native' replaces FSL randomise with the in-process permutation
+    engine (native_randomise), which writes the same randomise_* file names.
+    With adaptive=True the native engine stops permuting a contrast early once
+    its corrected p-values are settled and records the permutation counts in
+    stats/randomise_permutations.json.
+    Every file written by the sink is listed in <output_dir>/<name>_sink_manifest.json.
+    """
+    if adaptive and engine != 'native':
+        raise ValueError("Adaptive permutation stopping requires engine='native'")
+
     wf = Workflow(name=name, base_dir=output_dir)
     inputnode = Node(IdentityInterface(fields=['cope_file', 'mask_file', 'design_file', 'con_file']),
                      name='inputnode')
-    randomise = Node(Randomise(num_perm=5000,  # Number of permutations
-                               tfce=True),      # Use TFCE
-                     name='randomise')
+    if engine == 'native':
+        randomise = Node(Function(input_names=['in_file', 'mask', 'design_mat', 'tcon', 'num_perm', 'n_procs',
+                                               'adaptive'],
+                                  output_names=['tstat_files', 't_corrected_p_files', 'perm_log'],
+                                  function=run_randomise_node),
+                         name='randomise')
+        randomise.inputs.num_perm = 5000
+        randomise.inputs.n_procs = n_procs
+        randomise.inputs.adaptive = adaptive
+    else:
+        randomise = Node(Randomise(num_perm=5000,  # Number of permutations
+                                   tfce=True),      # Use TFCE
+                         name='randomise')
     outputnode = Node(IdentityInterface(fields=['tstat_files', 'tfce_corr_p_files']),
                       name='outputnode')
     datasink = Node(DataSink(base_directory=output_dir, parameterization=False), name='datasink')
@@ -281,6 +387,10 @@ def wf_randomise(output_dir, name="wf_randomise"):
         (outputnode, datasink, [('tstat_files', 'stats.@tstats'),
                                 ('tfce_corr_p_files', 'stats.@tfce_corr_p')])
     ])
+    if engine == 'native':
+        # Permutation counts actually run per contrast
+        wf.connect(randomise, 'perm_log', datasink, 'stats.@perm_log')
+    add_sink_manifest(wf, datasink, output_dir, name)
     return wf
 
 # =============================================================================
@@ -303,7 +413,10 @@ def create_group_analysis_workflow(output_dir, method='flameo', subjects=None,
         contrast_type (str): 'standard' or 'minimal' for contrasts
         analysis_type (str): 'whole_brain' or 'roi' - type of analysis to perform
         roi_dir (str): Directory containing ROI mask files (required if analysis_type='roi')
-        **kwargs: Additional arguments for specific workflows
+        **kwargs: Additional arguments for specific workflows. For analysis_type='roi',
+            engine='fsl' (default) runs FLAMEO/randomise on each ROI-masked image;
+            engine='native' fits all ROIs at once on ROI-averaged values
+            (roi_stats.py: OLS for randomise, mixed effects for flameo) and writes one table
     
     Returns:
         tuple: (workflow, design_file, con_file)
@@ -335,16 +448,45 @@ def create_group_analysis_workflow(output_dir, method='flameo', subjects=None,
         # Input node for ROI analysis
         if method == 'flameo':
             inputnode = Node(IdentityInterface(fields=['cope_files', 'var_cope_files', 'mask_file',
-                                                       'design_file', 'con_file', 'result_dir']),
+                                                       'design_file', 'grp_file', 'con_file', 'result_dir']),
                              name='inputnode')
         else:  # randomise
             inputnode = Node(IdentityInterface(fields=['cope_files', 'mask_file',
                                                        'design_file', 'con_file']),
                              name='inputnode')
         
-        # ROI node to fetch ROI files
-        roi_node = Node(Function(input_names=['roi_dir'], output_names=['roi_files'],
-                                 function=get_roi_files),
+        if kwargs.get('engine', 'fsl') == 'native':
+            # Summary-level statistics: one fit for all ROIs, one tidy table
+            roi_stats = Node(Function(input_names=['cope_file', 'roi_dir', 'design_file', 'con_file',
+                                                   'var_cope_file', 'grp_file', 'model', 'num_perm', 'seed'],
+                                      output_names=['roi_stats'],
+                                      function=run_roi_stats_node),
+                             name='roi_stats')
+            roi_stats.inputs.roi_dir = roi_dir
+            roi_stats.inputs.model = 'flame1' if method == 'flameo' else 'ols'
+            roi_stats.inputs.num_perm = kwargs.get('num_perm', 10000)
+            roi_stats.inputs.seed = 0
+
+            outputnode = Node(IdentityInterface(fields=['roi_stats']), name='outputnode')
+            datasink = Node(DataSink(base_directory=output_dir), name='datasink')
+
+            wf.connect([
+                (inputnode, roi_stats, [('cope_files', 'cope_file'),
+                                        ('design_file', 'design_file'),
+                                        ('con_file', 'con_file')]),
+                (roi_stats, outputnode, [('roi_stats', 'roi_stats')]),
+                (outputnode, datasink, [('roi_stats', 'roi_stats')])
+            ])
+            if method == 'flameo':
+                wf.connect([
+                    (inputnode, roi_stats, [('var_cope_files', 'var_cope_file'),
+                                            ('grp_file', 'grp_file')])
+                ])
+            return wf, design_file, con_file
+
+        # ROI node: files of the cached ROI index on the mask grid
+        roi_node = Node(Function(input_names=['roi_dir', 'reference_file'], output_names=['roi_files'],
+                                 function=indexed_roi_files),
                         name='roi_node')
         roi_node.inputs.roi_dir = roi_dir
         
@@ -398,7 +540,7 @@ def create_group_analysis_workflow(output_dir, method='flameo', subjects=None,
         # ROI workflow connections
         if method == 'flameo':
             wf.connect([
-                (inputnode, roi_node, [('cope_files', 'cope_files')]),
+                (inputnode, roi_node, [('mask_file', 'reference_file')]),
                 (roi_node, mask_copes, [('roi_files', 'in_file2')]),
                 (roi_node, mask_varcopes, [('roi_files', 'in_file2')]),
                 (roi_node, analysis_node, [('roi_files', 'mask_file')]),
@@ -411,6 +553,7 @@ def create_group_analysis_workflow(output_dir, method='flameo', subjects=None,
                 (mask_varcopes, analysis_node, [('out_file', 'var_cope_file')]),
                 
                 (inputnode, analysis_node, [('design_file', 'design_file'),
+                                           ('grp_file', 'cov_split_file'),
                                            ('con_file', 't_con_file')]),
                 
                 (analysis_node, fdr_ztop, [(('zstats', flatten_zstats), 'in_file')]),
@@ -429,7 +572,7 @@ def create_group_analysis_workflow(output_dir, method='flameo', subjects=None,
             ])
         else:  # randomise
             wf.connect([
-                (inputnode, roi_node, [('cope_files', 'cope_files')]),
+                (inputnode, roi_node, [('mask_file', 'reference_file')]),
                 (roi_node, mask_copes, [('roi_files', 'in_file2')]),
                 (roi_node, analysis_node, [('roi_files', 'mask')]),
                 
@@ -1052,8 +1195,8 @@ def check_file_exists(in_file):
 def rename_file(in_file, output_dir, contrast, file_type):
     """Rename the merged file to a simpler name with error checking."""
     print(f"DEBUG: Received in_file: {in_file}, contrast: {contrast}, file_type: {file_type}")
-    import shutil
     import os
+    from result_promotion import promote_file
     try:
         contrast_str = str(int(contrast))
     except (ValueError, TypeError):
@@ -1064,8 +1207,9 @@ def rename_file(in_file, output_dir, contrast, file_type):
     out_file = os.path.join(output_dir, new_name)
 
     if os.path.exists(in_file):
-        shutil.move(in_file, out_file)
-        print(f"Renamed {in_file} -> {out_file}")
+        # Atomic rename on the same filesystem, copy only across devices
+        record = promote_file(in_file, out_file, mode='move', checksum=False)
+        print(f"Renamed ({record['method']}) {in_file} -> {out_file}")
     else:
         raise FileNotFoundError(f"Input file {in_file} does not exist!")
 
@@ -1083,6 +1227,17 @@ def flatten_zstats(zstats):
         return [item for sublist in zstats for item in sublist]
     return zstats  # Already a flat list of strings
 
+def add_sink_manifest(wf, datasink, output_dir, name):
+    """Record every file the DataSink writes in <output_dir>/<name>_sink_manifest.json."""
+    sink_manifest = Node(Function(input_names=['out_files', 'base_directory', 'workflow_name'],
+                                  output_names=['manifest_file'],
+                                  function=write_sink_manifest),
+                         name='sink_manifest')
+    sink_manifest.inputs.base_directory = output_dir
+    sink_manifest.inputs.workflow_name = name
+    wf.connect(datasink, 'out_file', sink_manifest, 'out_files')
+    return sink_manifest
+
 def flatten_stats(stats):
     """Flatten a potentially nested list of stat file paths into a single list."""
     if not stats:
@@ -1517,7 +1672,8 @@ wf.run()
 # ROI PSC ANALYSIS WORKFLOW
 # =============================================================================
 
-def wf_roi_psc_analysis(output_dir, name="wf_roi_psc_analysis", method='flameo', baseline_condition='baseline'):
+def wf_roi_psc_analysis(output_dir, name="wf_roi_psc_analysis", method='flameo', baseline_condition='baseline',
+                        psc_layout='multi'):
     """
     Workflow for ROI-based analysis using PSC (Percent Signal Change).
     
@@ -1573,6 +1729,8 @@ def wf_roi_psc_analysis(output_dir, name="wf_roi_psc_analysis", method='flameo',
         name (str): Workflow name
         method (str): 'flameo' for parametric analysis or 'randomise' for non-parametric
         baseline_condition (str): Name of baseline condition for PSC calculation
+        psc_layout (str): 'multi' writes one PSC image covering all ROIs, 'per_roi'
+            one ROI-suffixed PSC image per ROI (see roi_engine.run_roi_psc)
     """
     wf = Workflow(name=name, base_dir=output_dir)
 
@@ -1586,17 +1744,12 @@ def wf_roi_psc_analysis(output_dir, name="wf_roi_psc_analysis", method='flameo',
                                                    'design_file', 'con_file']),
                          name='inputnode')
 
-    # ROI node to fetch ROI files
-    roi_node = Node(Function(input_names=['roi'], output_names=['roi_files'],
-                             function=get_roi_files),
-                    name='roi_node')
-
-    # Convert cope to PSC for each ROI
-    cope_to_psc = MapNode(Function(input_names=['cope_file', 'baseline_cope_file', 'roi_mask'],
-                                   output_names=['psc_file'],
-                                   function=convert_cope_to_psc),
-                          iterfield=['cope_file', 'roi_mask'],
-                          name='cope_to_psc')
+    # Convert cope to PSC for all ROIs in one pass; also yields the ROI files
+    roi_node = Node(Function(input_names=['cope_file', 'baseline_cope_file', 'roi_dir', 'layout'],
+                             output_names=['psc_files', 'roi_files'],
+                             function=convert_cope_to_psc),
+                    name='cope_to_psc')
+    roi_node.inputs.layout = psc_layout
 
     # Analysis node for each ROI
     if method == 'flameo':
@@ -1622,12 +1775,11 @@ def wf_roi_psc_analysis(output_dir, name="wf_roi_psc_analysis", method='flameo',
     # Workflow connections (method-dependent)
     if method == 'flameo':
         wf.connect([
-            (inputnode, roi_node, [('roi', 'roi')]),
-            (inputnode, cope_to_psc, [('cope_files', 'cope_file'),
-                                      ('baseline_cope_file', 'baseline_cope_file')]),
-            (roi_node, cope_to_psc, [('roi_files', 'roi_mask')]),
+            (inputnode, roi_node, [('roi', 'roi_dir'),
+                                   ('cope_files', 'cope_file'),
+                                   ('baseline_cope_file', 'baseline_cope_file')]),
             (roi_node, analysis_node, [('roi_files', 'mask_file')]),
-            (cope_to_psc, analysis_node, [('psc_file', 'cope_file')]),
+            (roi_node, analysis_node, [('psc_files', 'cope_file')]),
             (inputnode, analysis_node, [('var_cope_files', 'var_cope_file'),
                                        ('design_file', 'design_file'),
                                        ('grp_file', 'cov_split_file'),
@@ -1639,12 +1791,11 @@ def wf_roi_psc_analysis(output_dir, name="wf_roi_psc_analysis", method='flameo',
         ])
     else:  # randomise
         wf.connect([
-            (inputnode, roi_node, [('roi', 'roi')]),
-            (inputnode, cope_to_psc, [('cope_files', 'cope_file'),
-                                      ('baseline_cope_file', 'baseline_cope_file')]),
-            (roi_node, cope_to_psc, [('roi_files', 'roi_mask')]),
+            (inputnode, roi_node, [('roi', 'roi_dir'),
+                                   ('cope_files', 'cope_file'),
+                                   ('baseline_cope_file', 'baseline_cope_file')]),
             (roi_node, analysis_node, [('roi_files', 'mask')]),
-            (cope_to_psc, analysis_node, [('psc_file', 'in_file')]),
+            (roi_node, analysis_node, [('psc_files', 'in_file')]),
             (inputnode, analysis_node, [('design_file', 'design_file'),
                                        ('con_file', 'tcon')]),
             (analysis_node, outputnode, [('tstat_files', 'tstat_files'),
@@ -1657,50 +1808,22 @@ def wf_roi_psc_analysis(output_dir, name="wf_roi_psc_analysis", method='flameo',
 
     return wf
 
-def convert_cope_to_psc(cope_file, baseline_cope_file, roi_mask):
+def convert_cope_to_psc(cope_file, baseline_cope_file, roi_dir, layout='multi'):
     """
-    Convert cope file to PSC using baseline condition.
+    Convert a cope file to PSC inside every ROI of roi_dir in one pass.
     
     Args:
         cope_file (str): Path to cope file
         baseline_cope_file (str): Path to baseline cope file
-        roi_mask (str): Path to ROI mask
+        roi_dir (str): Directory containing ROI mask files
+        layout (str): 'multi' (one PSC image covering all ROIs) or 'per_roi'
+            (one ROI-suffixed PSC image per ROI)
     
     Returns:
-        str: Path to PSC file
+        tuple: (PSC file per ROI, ROI mask files), aligned for per-ROI MapNodes
     """
     import os
-    import numpy as np
-    import nibabel as nib
-    from nipype.interfaces.fsl import ImageMaths
-    
-    # Load images
-    cope_img = nib.load(cope_file)
-    baseline_img = nib.load(baseline_cope_file)
-    mask_img = nib.load(roi_mask)
-    
-    # Get data
-    cope_data = cope_img.get_fdata()
-    baseline_data = baseline_img.get_fdata()
-    mask_data = mask_img.get_fdata()
-    
-    # Apply mask
-    cope_masked = cope_data * mask_data
-    baseline_masked = baseline_data * mask_data
-    
-    # Calculate PSC: (cope - baseline) / baseline * 100
-    # Add small constant to avoid division by zero
-    epsilon = 1e-6
-    psc_data = np.where(baseline_masked != 0,
-                        (cope_masked - baseline_masked) / (np.abs(baseline_masked) + epsilon) * 100,
-                        0)
-    
-    # Create new image
-    psc_img = nib.Nifti1Image(psc_data, cope_img.affine, cope_img.header)
-    
-    # Save PSC file
-    psc_file = cope_file.replace('.nii.gz', '_psc.nii.gz')
-    nib.save(psc_img, psc_file)
-    
-    return psc_file
+    from roi_engine import run_roi_psc
+    
+    return run_roi_psc(cope_file, baseline_cope_file, roi_dir, os.path.abspath('psc'), layout=layout)
 
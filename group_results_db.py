@@ -0,0 +1,393 @@
+#!/usr/bin/env python3
+"""
+Queryable database of group-level results across tasks, copes, methods and data sources.
+
+Group outputs (stat maps in stats/ and randomise/, cluster and local-maxima
+tables in cluster_results/) are spread over one results directory per
+task, cope and data source. This module extracts them once into a single
+SQLite database:
+
+    results   one row per results directory (data source, task, cope)
+    maps      per-map summary statistics (extent, range, peak, voxels above threshold)
+    clusters  rows of cluster tables (*_clusters.txt, FSL cluster --othresh tables)
+    peaks     rows of local-maxima tables (*localmax*.txt)
+    files     size/mtime bookkeeping for incremental updates
+
+Indexing is incremental: a file is only opened again when its size or
+modification time changed, and rows of files that disappeared are dropped.
+The files of a results directory are taken from its promotion manifest
+(result_promotion.py) when there is one, so no directory walk is needed.
+
+run_group_voxelWise.py updates the database after every job; the command
+line below (re)indexes whole data sources:
+
+    python group_results_db.py --base-dir /path/to/data [--data-source placebo] [--db results.sqlite]
+
+Author: Xiaoqian Xiao (xiao.xiaoqian.320@gmail.com)
+"""
+
+import os
+import re
+import glob
+import sqlite3
+import logging
+import argparse
+from datetime import datetime
+import numpy as np
+import nibabel as nib
+
+from nifti_cache import load_nifti
+
+logger = logging.getLogger(__name__)
+
+# =============================================================================
+# CONSTANTS
+# =============================================================================
+
+DB_NAME = 'group_results.sqlite'
+RESULT_SUBDIRS = ('stats', 'cluster_results', 'randomise')
+SQLITE_TIMEOUT = 120  # seconds to wait for another job's write lock
+
+# Results directories of each data source, relative to the base directory
+# (mirrors DATA_SOURCE_CONFIGS in run_group_voxelWise.py)
+DATA_SOURCE_RESULTS = {
+    'standard': 'groupLevel_timeEffect/whole_brain',
+    'placebo': 'groupLevel_timeEffect/whole_brain/Placebo',
+    'guess': 'groupLevel_timeEffect/whole_brain/Guess',
+}
+
+# Voxels counted as "above threshold" per map kind
+MAP_THRESHOLDS = {
+    'corrp': 0.95,   # 1 - p maps: p < 0.05
+    'p': 0.95,
+    'zstat': 2.3,
+    'tstat': 2.3,
+    'threshold': 0.0,
+}
+
+# Cluster table headers (FSL cluster and native_cluster) -> columns
+CLUSTER_COLUMNS = {
+    'Cluster Index': 'cluster_index',
+    'Voxels': 'voxels',
+    'P': 'p',
+    '-log10(P)': 'log10p',
+    'Z-MAX': 'z_max',
+    'MAX': 'z_max',
+    'Z-MAX X (vox)': 'x', 'Z-MAX Y (vox)': 'y', 'Z-MAX Z (vox)': 'z',
+    'Z-MAX X (mm)': 'x', 'Z-MAX Y (mm)': 'y', 'Z-MAX Z (mm)': 'z',
+    'MAX X (vox)': 'x', 'MAX Y (vox)': 'y', 'MAX Z (vox)': 'z',
+}
+PEAK_COLUMNS = {'Cluster Index': 'cluster_index', 'Value': 'value', 'x': 'x', 'y': 'y', 'z': 'z'}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    result_id INTEGER PRIMARY KEY,
+    result_dir TEXT UNIQUE NOT NULL,
+    data_source TEXT, task TEXT, cope INTEGER, indexed_at TEXT
+);
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY, result_id INTEGER, size INTEGER, mtime_ns INTEGER, kind TEXT
+);
+CREATE TABLE IF NOT EXISTS maps (
+    path TEXT PRIMARY KEY, result_id INTEGER, method TEXT, map_name TEXT, map_kind TEXT,
+    stat_index INTEGER, n_voxels INTEGER, n_nonzero INTEGER, min REAL, max REAL, mean_nonzero REAL,
+    threshold REAL, n_above INTEGER, peak_i INTEGER, peak_j INTEGER, peak_k INTEGER,
+    peak_x REAL, peak_y REAL, peak_z REAL
+);
+CREATE TABLE IF NOT EXISTS clusters (
+    path TEXT, result_id INTEGER, method TEXT, map_name TEXT, stat_index INTEGER,
+    cluster_index INTEGER, voxels INTEGER, p REAL, log10p REAL, z_max REAL, x REAL, y REAL, z REAL
+);
+CREATE TABLE IF NOT EXISTS peaks (
+    path TEXT, result_id INTEGER, method TEXT, map_name TEXT, stat_index INTEGER,
+    cluster_index INTEGER, value REAL, x REAL, y REAL, z REAL
+);
+CREATE INDEX IF NOT EXISTS clusters_result ON clusters (result_id);
+CREATE INDEX IF NOT EXISTS peaks_result ON peaks (result_id);
+CREATE INDEX IF NOT EXISTS maps_result ON maps (result_id);
+"""
+
+# =============================================================================
+# DATABASE
+# =============================================================================
+
+def default_db_path(base_dir):
+    """Database shared by all data sources of a base directory."""
+    return os.path.join(base_dir, 'groupLevel_timeEffect', DB_NAME)
+
+
+def connect(db_file):
+    """Open (and create if needed) the results database."""
+    os.makedirs(os.path.dirname(os.path.abspath(db_file)), exist_ok=True)
+    conn = sqlite3.connect(db_file, timeout=SQLITE_TIMEOUT)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def query(db_file, sql, params=()):
+    """
+    Run a query against the results database.
+
+    Example:
+        query(db, "SELECT r.task, r.cope, c.* FROM clusters c JOIN results r USING (result_id) "
+                  "WHERE c.p < 0.05 ORDER BY r.task, r.cope")
+
+    Returns:
+        pandas.DataFrame: Query result
+    """
+    import pandas as pd
+
+    with sqlite3.connect(db_file, timeout=SQLITE_TIMEOUT) as conn:
+        return pd.read_sql_query(sql, conn, params=params)
+
+# =============================================================================
+# FILE PARSING
+# =============================================================================
+
+def _stat_index(name):
+    """Trailing statistic number of a file name (zstat3_localmax -> 3), or None."""
+    numbers = re.findall(r'(?:stat|cope)(\d+)', name)
+    return int(numbers[-1]) if numbers else None
+
+
+def _method(rel_path):
+    """Group method that produced a file, from its name and location."""
+    return 'randomise' if 'randomise' in rel_path else 'flameo'
+
+
+def classify(rel_path):
+    """
+    Kind of a result file: 'map', 'clusters', 'peaks' or None (not indexed).
+    """
+    name = os.path.basename(rel_path)
+    if name.endswith('.txt'):
+        if 'localmax' in name:
+            return 'peaks'
+        if 'cluster' in name:
+            return 'clusters'
+        return None
+    if name.endswith(('.nii.gz', '.nii')) and not name.startswith(('res4d', 'merged')):
+        return 'map'
+    return None
+
+
+def map_kind(name):
+    """Statistic kind of a map name (for the above-threshold count)."""
+    if name.endswith('index'):
+        return 'index'
+    if 'corrp' in name:
+        return 'corrp'
+    if re.search(r'_p_|^p_', name):
+        return 'p'
+    if 'threshold' in name or 'thresh' in name:
+        return 'threshold'
+    if 'zstat' in name:
+        return 'zstat'
+    if 'tstat' in name:
+        return 'tstat'
+    return 'other'
+
+
+def summarize_map(path):
+    """
+    Summary statistics of a 3D map (4D images are skipped).
+
+    Returns:
+        dict or None: Columns of the maps table
+    """
+    img = load_nifti(path)
+    if len(img.shape) > 3 and img.shape[3] > 1:
+        return None
+    data = np.asanyarray(img.dataobj, dtype=np.float32).reshape(img.shape[:3])
+    name = os.path.basename(path).split('.nii')[0]
+    kind = map_kind(name)
+    threshold = MAP_THRESHOLDS.get(kind)
+
+    nonzero = data[data != 0]
+    row = {'map_name': name, 'map_kind': kind, 'stat_index': _stat_index(name),
+           'n_voxels': int(data.size), 'n_nonzero': int(nonzero.size),
+           'min': float(data.min()), 'max': float(data.max()),
+           'mean_nonzero': float(nonzero.mean()) if nonzero.size else None,
+           'threshold': threshold,
+           'n_above': int(np.sum(data > threshold)) if threshold is not None else None}
+    peak = np.unravel_index(int(np.argmax(data)), data.shape)
+    peak_mm = nib.affines.apply_affine(img.affine, peak)
+    row.update({'peak_i': int(peak[0]), 'peak_j': int(peak[1]), 'peak_k': int(peak[2]),
+                'peak_x': float(peak_mm[0]), 'peak_y': float(peak_mm[1]), 'peak_z': float(peak_mm[2])})
+    return row
+
+
+def read_table(path, columns):
+    """
+    Parse a tab-separated FSL cluster/local-maxima table into row dicts.
+
+    Only the header columns listed in columns are kept (renamed); other
+    columns (COG, COPE statistics) are ignored.
+    """
+    with open(path) as f:
+        lines = [line.rstrip('\n') for line in f if line.strip()]
+    if not lines:
+        return []
+    header = [h.strip() for h in lines[0].split('\t')]
+    rows = []
+    for line in lines[1:]:
+        values = [v.strip() for v in line.split('\t')]
+        row = {}
+        for h, v in zip(header, values):
+            if h in columns and columns[h] not in row and v:
+                row[columns[h]] = float(v)
+        if row:
+            rows.append(row)
+    return rows
+
+# =============================================================================
+# INDEXING
+# =============================================================================
+
+def result_files(result_dir):
+    """
+    Relative paths of the result files of a results directory.
+
+    The promotion manifest lists them; directories without one (older
+    results) fall back to scanning the known result subdirectories.
+    """
+    from result_promotion import read_manifest
+
+    rel_paths = list(read_manifest(result_dir)['files'])
+    if not rel_paths:
+        for subdir in RESULT_SUBDIRS:
+            for root, _, files in os.walk(os.path.join(result_dir, subdir)):
+                rel_paths += [os.path.relpath(os.path.join(root, f), result_dir) for f in files]
+    return sorted(p for p in rel_paths if classify(p))
+
+
+def _result_id(conn, result_dir, data_source, task, cope):
+    """Row id of a results directory, inserting or updating it."""
+    now = datetime.now().isoformat(timespec='seconds')
+    conn.execute("INSERT INTO results (result_dir, data_source, task, cope, indexed_at) VALUES (?, ?, ?, ?, ?) "
+                 "ON CONFLICT (result_dir) DO UPDATE SET data_source = excluded.data_source, "
+                 "task = excluded.task, cope = excluded.cope, indexed_at = excluded.indexed_at",
+                 (result_dir, data_source, task, cope, now))
+    return conn.execute("SELECT result_id FROM results WHERE result_dir = ?", (result_dir,)).fetchone()[0]
+
+
+def _drop_file(conn, path):
+    """Remove every row derived from one file."""
+    for table in ('maps', 'clusters', 'peaks', 'files'):
+        conn.execute(f"DELETE FROM {table} WHERE path = ?", (path,))
+
+
+def _insert(conn, table, row):
+    """Insert a dict as one row."""
+    keys = list(row)
+    conn.execute(f"INSERT INTO {table} ({', '.join(keys)}) VALUES ({', '.join('?' * len(keys))})",
+                 [row[k] for k in keys])
+
+
+def index_result_dir(db_file, result_dir, data_source=None, task=None, cope=None):
+    """
+    Index (or update) the results of one task/cope directory.
+
+    Args:
+        db_file (str): Database file
+        result_dir (str): Results directory (…/task-<task>/cope<N>)
+        data_source (str): Data source name
+        task (str): Task name (default: parsed from result_dir)
+        cope (int): Cope number (default: parsed from result_dir)
+
+    Returns:
+        dict: Counts of 'indexed', 'unchanged' and 'removed' files
+    """
+    result_dir = os.path.abspath(result_dir)
+    if task is None:
+        match = re.search(r'task-([^/]+)', result_dir)
+        task = match.group(1) if match else None
+    if cope is None:
+        match = re.search(r'cope(\d+)', os.path.basename(result_dir))
+        cope = int(match.group(1)) if match else None
+
+    counts = {'indexed': 0, 'unchanged': 0, 'removed': 0}
+    rel_paths = result_files(result_dir)
+    conn = connect(db_file)
+    try:
+        with conn:
+            result_id = _result_id(conn, result_dir, data_source, task, cope)
+            known = {row[0]: (row[1], row[2]) for row in conn.execute(
+                "SELECT path, size, mtime_ns FROM files WHERE result_id = ?", (result_id,))}
+
+            current = set()
+            for rel_path in rel_paths:
+                path = os.path.join(result_dir, rel_path)
+                if not os.path.exists(path):
+                    continue
+                current.add(path)
+                st = os.stat(path)
+                if known.get(path) == (st.st_size, st.st_mtime_ns):
+                    counts['unchanged'] += 1
+                    continue
+
+                _drop_file(conn, path)
+                kind = classify(rel_path)
+                base = {'path': path, 'result_id': result_id, 'method': _method(rel_path)}
+                if kind == 'map':
+                    row = summarize_map(path)
+                    if row is not None:
+                        _insert(conn, 'maps', dict(base, **row))
+                else:
+                    name = os.path.basename(path).split('.')[0]
+                    table, columns = ('peaks', PEAK_COLUMNS) if kind == 'peaks' else ('clusters', CLUSTER_COLUMNS)
+                    for row in read_table(path, columns):
+                        _insert(conn, table, dict(base, map_name=name, stat_index=_stat_index(name), **row))
+                conn.execute("INSERT INTO files (path, result_id, size, mtime_ns, kind) VALUES (?, ?, ?, ?, ?)",
+                             (path, result_id, st.st_size, st.st_mtime_ns, kind))
+                counts['indexed'] += 1
+
+            for path in set(known) - current:
+                _drop_file(conn, path)
+                counts['removed'] += 1
+    finally:
+        conn.close()
+
+    logger.info(f"Indexed {result_dir}: {counts['indexed']} updated, {counts['unchanged']} unchanged, "
+                f"{counts['removed']} removed")
+    return counts
+
+
+def index_data_source(db_file, base_dir, data_source='standard'):
+    """
+    Index every task/cope results directory of one data source.
+
+    Returns:
+        int: Number of results directories indexed
+    """
+    results_root = os.path.join(base_dir, DATA_SOURCE_RESULTS[data_source])
+    result_dirs = sorted(glob.glob(os.path.join(results_root, 'task-*', 'cope*')))
+    for result_dir in result_dirs:
+        if os.path.isdir(result_dir):
+            index_result_dir(db_file, result_dir, data_source)
+    return len(result_dirs)
+
+# =============================================================================
+# COMMAND LINE
+# =============================================================================
+
+def main():
+    """Index group-level results of one or all data sources."""
+    parser = argparse.ArgumentParser(description="Index group-level results into one SQLite database")
+    parser.add_argument('--base-dir', required=True, help='Base directory containing the data')
+    parser.add_argument('--data-source', default='all', choices=['all'] + list(DATA_SOURCE_RESULTS),
+                        help='Data source to index (default: all)')
+    parser.add_argument('--db', help=f'Database file (default: <base-dir>/groupLevel_timeEffect/{DB_NAME})')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    db_file = args.db or default_db_path(args.base_dir)
+    sources = list(DATA_SOURCE_RESULTS) if args.data_source == 'all' else [args.data_source]
+    for data_source in sources:
+        n = index_data_source(db_file, args.base_dir, data_source)
+        logger.info(f"{data_source}: {n} results directories indexed into {db_file}")
+    return 0
+
+
+if __name__ == '__main__':
+    exit(main())
@@ -12,6 +12,14 @@
 #   ./launch_1st_voxelWise.sh --phase phase2     # Launch only phase2 scripts
 #   ./launch_1st_voxelWise.sh --phase phase3     # Launch only phase3 scripts
 #   ./launch_1st_voxelWise.sh --dry-run          # Show what would be launched
+#   ./launch_1st_voxelWise.sh --force            # Also launch up-to-date subjects
+#
+# Scripts whose LEDGER_FINGERPRINT matches the subject's entry in the phase's
+# completion ledger (completion_ledger/sub_<ID>.json, written by the job after
+# a successful run) are skipped, so relaunching after adding subjects only
+# submits the new ones. Scripts generated before a subject had a ledger entry
+# carry no fingerprint and are always submitted; the job itself then skips the
+# subject if its ledger entry is up to date.
 #
 # Author: Xiaoqian Xiao (xiao.xiaoqian.320@gmail.com)
 #
@@ -27,6 +35,7 @@ SCRIPTS_BASE_DIR="/gscratch/scrubbed/fanglab/xiaoqian/NARSAD/work_flows/firstLev
 # Default settings
 PHASE=""
 DRY_RUN=false
+FORCE=false
 
 # =============================================================================
 # ARGUMENT PARSING
@@ -42,12 +51,17 @@ while [[ $# -gt 0 ]]; do
             DRY_RUN=true
             shift
             ;;
+        --force)
+            FORCE=true
+            shift
+            ;;
         --help)
             echo "Usage: $0 [OPTIONS]"
             echo ""
             echo "OPTIONS:"
             echo "  --phase PHASE     Specific phase to process (phase2, phase3)"
             echo "  --dry-run         Show what would be launched without submitting"
+            echo "  --force           Launch scripts of subjects the completion ledger marks up to date"
             echo "  --help            Show this help message"
             echo ""
             echo "EXAMPLES:"
@@ -83,6 +97,15 @@ fi
 
 echo "=========================================="
 
+# Whether a script's subject is recorded as complete with the script's fingerprint
+is_up_to_date() {
+    local script="$1"
+    local fingerprint ledger
+    fingerprint=$(sed -n 's/^# LEDGER_FINGERPRINT=//p' "$script" | head -n 1)
+    ledger="$(dirname "$script")/completion_ledger/$(basename "$script" _slurm.sh).json"
+    [[ -n "$fingerprint" && -f "$ledger" ]] && grep -q "\"fingerprint\": \"$fingerprint\"" "$ledger"
+}
+
 # Function to launch scripts from a specific phase directory
 launch_scripts_from_phase() {
     local phase="$1"
@@ -99,13 +122,17 @@ launch_scripts_from_phase() {
     # Find all SLURM scripts in the phase directory
     local scripts_found=0
     local scripts_launched=0
+    local scripts_skipped=0
     
     for script in "$phase_dir"/*.sh; do
         # Check if file exists and is a regular file
         if [[ -f "$script" ]]; then
             scripts_found=$((scripts_found + 1))
             
-            if [[ "$DRY_RUN" == true ]]; then
+            if [[ "$FORCE" != true ]] && is_up_to_date "$script"; then
+                echo "  Up to date, skipping: $(basename "$script")"
+                scripts_skipped=$((scripts_skipped + 1))
+            elif [[ "$DRY_RUN" == true ]]; then
                 echo "  [DRY RUN] Would submit: $(basename "$script")"
             else
                 echo "  Submitting: $(basename "$script")"
@@ -119,9 +146,9 @@ launch_scripts_from_phase() {
         echo "  No SLURM scripts found in: $phase_dir"
     else
         if [[ "$DRY_RUN" == true ]]; then
-            echo "  [DRY RUN] Found $scripts_found scripts (would launch $scripts_found)"
+            echo "  [DRY RUN] Found $scripts_found scripts (would launch $((scripts_found - scripts_skipped)), $scripts_skipped up to date)"
         else
-            echo "  Found $scripts_found scripts, launched $scripts_launched"
+            echo "  Found $scripts_found scripts, launched $scripts_launched, $scripts_skipped up to date"
         fi
     fi
     
@@ -153,5 +180,6 @@ if [[ "$DRY_RUN" == true ]]; then
     echo "To actually launch the jobs, run without --dry-run:"
     cmd="$0"
     [[ -n "$PHASE" ]] && cmd="$cmd --phase $PHASE"
+    [[ "$FORCE" == true ]] && cmd="$cmd --force"
     echo "  $cmd"
 fi
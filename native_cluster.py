@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+"""
+Native GRF cluster inference (alternative to FSL smoothest + cluster).
+
+wf_flameo used to run one SmoothEstimate and one Cluster process per zstat,
+each re-reading the mask and the statistic image. This module does the whole
+stage in-process, for all zstats of a design in one pass:
+
+1. Smoothness is estimated once per design from the standardized residuals
+   (res4d), using the lag-1 spatial autocorrelation in each axis as smoothest
+   does:  sigma_d^2 = -1 / (4 log rho_d),  FWHM_d = sqrt(8 ln 2 sigma_d^2),
+   DLH = (8 sigma_x^2 sigma_y^2 sigma_z^2)^(-1/2),  RESELS = FWHM_x FWHM_y FWHM_z.
+2. Each zstat is thresholded and labelled with 26-connectivity.
+3. Cluster p-values come from Gaussian random field theory (Friston et al.,
+   1994), as in FSL cluster:
+       E[m]   = V DLH (2 pi)^-2 (u^2 - 1) exp(-u^2 / 2)
+       P(n>=k) = exp(-beta k^(2/3)),  beta = (Gamma(5/2) E[m] / (V Phi(-u)))^(2/3)
+       p       = 1 - exp(-E[m] P(n>=k))
+
+Outputs mirror FSL cluster for each zstat{k}:
+    zstat{k}_threshold.nii.gz   z values of significant clusters
+    zstat{k}_index.nii.gz       cluster index (largest cluster = highest index)
+    zstat{k}_localmax.txt       local maxima per cluster
+    zstat{k}_clusters.txt       cluster table (size, p, -log10 p, peak)
+and smoothness.json with DLH, VOLUME and RESELS.
+
+Author: Xiaoqian Xiao (xiao.xiaoqian.320@gmail.com)
+"""
+
+import os
+import json
+import math
+import logging
+import numpy as np
+import nibabel as nib
+from scipy import ndimage
+from scipy.stats import norm
+
+from nifti_cache import load_nifti
+
+logger = logging.getLogger(__name__)
+
+# =============================================================================
+# CONSTANTS
+# =============================================================================
+
+DEFAULT_Z_THRESHOLD = 2.3
+DEFAULT_P_THRESHOLD = 0.05
+CLUSTER_CONNECTIVITY = 26
+LOCALMAX_PER_CLUSTER = 6     # FSL cluster --num default
+
+_CONNECTIVITY_RANK = {6: 1, 18: 2, 26: 3}
+
+# GRF cluster theory needs at least voxel-sized smoothness; FWHM is floored at 1 voxel
+MIN_SIGMASQ = 1.0 / (8 * math.log(2))
+
+# =============================================================================
+# SMOOTHNESS
+# =============================================================================
+
+def estimate_smoothness(residuals, mask):
+    """
+    Estimate smoothness from residual images (smoothest-style).
+
+    Args:
+        residuals (numpy.ndarray): (x, y, z, n) residuals, or a single 3D map
+            (e.g. a zstat), which is demeaned and scaled by its SD over the mask
+        mask (numpy.ndarray): 3D boolean mask
+
+    Returns:
+        dict: {'dlh', 'volume', 'resels', 'fwhm_voxels' [x, y, z]}
+    """
+    residuals = np.asarray(residuals, dtype=np.float64)
+    if residuals.ndim == 3:
+        # A single map has one value per voxel: per-voxel scaling would leave only its
+        # sign, so demean it and scale by the SD over the mask instead
+        values = residuals[mask]
+        sd = values.std()
+        valid = mask & (sd > 0)
+        standardized = np.zeros(residuals.shape + (1,))
+        if sd > 0:
+            standardized[mask, 0] = (values - values.mean()) / sd
+    else:
+        # Standardize each voxel's residuals to unit variance
+        std = np.sqrt(np.sum(residuals ** 2, axis=3))
+        valid = mask & (std > 0)
+        standardized = np.zeros_like(residuals)
+        standardized[valid] = residuals[valid] / std[valid][:, np.newaxis]
+
+    sigmasq = []
+    for axis in range(3):
+        n_ax = mask.shape[axis]
+        head = [slice(None)] * 3
+        tail = [slice(None)] * 3
+        head[axis] = slice(0, n_ax - 1)
+        tail[axis] = slice(1, n_ax)
+        pairs = valid[tuple(head)] & valid[tuple(tail)]
+        a = standardized[tuple(head)][pairs]
+        b = standardized[tuple(tail)][pairs]
+        rho = np.sum(a * b) / np.sqrt(np.sum(a * a) * np.sum(b * b))
+        rho = min(max(rho, 1e-6), 1 - 1e-9)
+        sigmasq.append(-1.0 / (4.0 * math.log(rho)))
+
+    if min(sigmasq) < MIN_SIGMASQ:
+        logger.warning(f"Estimated FWHM below 1 voxel ({[round(math.sqrt(8 * math.log(2) * s), 3) for s in sigmasq]}); "
+                       f"flooring at 1 voxel for GRF inference")
+        sigmasq = [max(s, MIN_SIGMASQ) for s in sigmasq]
+
+    fwhm = [math.sqrt(8 * math.log(2) * s) for s in sigmasq]
+    return {
+        'dlh': (8.0 * sigmasq[0] * sigmasq[1] * sigmasq[2]) ** -0.5,
+        'volume': int(mask.sum()),
+        'resels': fwhm[0] * fwhm[1] * fwhm[2],
+        'fwhm_voxels': fwhm,
+    }
+
+# =============================================================================
+# CLUSTER INFERENCE
+# =============================================================================
+
+def grf_cluster_p(sizes, z_threshold, dlh, volume):
+    """
+    GRF p-values for clusters of the given sizes (in voxels).
+
+    Args:
+        sizes (numpy.ndarray): Cluster sizes
+        z_threshold (float): Cluster-forming z threshold
+        dlh (float): Smoothness (DLH, per voxel)
+        volume (int): Search volume in voxels
+
+    Returns:
+        numpy.ndarray: Cluster-level FWE p-values
+    """
+    sizes = np.asarray(sizes, dtype=np.float64)
+    u = z_threshold
+    expected_clusters = volume * dlh * (2 * math.pi) ** -2 * (u ** 2 - 1) * math.exp(-u ** 2 / 2)
+    if expected_clusters <= 0:
+        return np.ones_like(sizes)
+    tail = norm.sf(u)
+    beta = (math.gamma(2.5) * expected_clusters / (volume * tail)) ** (2.0 / 3.0)
+    p_size = np.exp(-beta * sizes ** (2.0 / 3.0))
+    return 1.0 - np.exp(-expected_clusters * p_size)
+
+
+def find_clusters(zstat, mask, z_threshold=DEFAULT_Z_THRESHOLD, dlh=None, volume=None,
+                  p_threshold=DEFAULT_P_THRESHOLD, connectivity=CLUSTER_CONNECTIVITY,
+                  n_localmax=LOCALMAX_PER_CLUSTER):
+    """
+    Label suprathreshold clusters of a zstat map and keep the significant ones.
+
+    Args:
+        zstat (numpy.ndarray): 3D z map
+        mask (numpy.ndarray): 3D boolean mask
+        z_threshold (float): Cluster-forming threshold
+        dlh, volume: Smoothness from estimate_smoothness
+        p_threshold (float): Cluster-level FWE threshold
+        connectivity (int): 6, 18 or 26
+        n_localmax (int): Local maxima reported per cluster
+
+    Returns:
+        tuple: (index volume, thresholded z volume, cluster table rows, local maxima rows)
+    """
+    structure = ndimage.generate_binary_structure(3, _CONNECTIVITY_RANK[connectivity])
+    supra = mask & (zstat > z_threshold)
+    labels, n_clusters = ndimage.label(supra, structure=structure)
+
+    index = np.zeros(zstat.shape, dtype=np.int32)
+    if n_clusters == 0:
+        return index, np.zeros(zstat.shape, dtype=np.float32), [], []
+
+    sizes = np.bincount(labels.ravel())[1:]
+    p_values = grf_cluster_p(sizes, z_threshold, dlh, volume)
+    keep = np.flatnonzero(p_values < p_threshold) + 1
+
+    # FSL numbering: ascending size, so the largest cluster gets the highest index
+    keep = keep[np.argsort(sizes[keep - 1], kind='stable')]
+    relabel = np.zeros(n_clusters + 1, dtype=np.int32)
+    relabel[keep] = np.arange(1, len(keep) + 1)
+    index = relabel[labels]
+    threshold = np.where(index > 0, zstat, 0).astype(np.float32)
+
+    # Local maxima: voxels equal to the 26-neighbourhood maximum within their cluster
+    z_in = np.where(index > 0, zstat, -np.inf)
+    peaks = (z_in == ndimage.maximum_filter(z_in, footprint=np.ones((3, 3, 3)), mode='constant',
+                                            cval=-np.inf)) & (index > 0)
+
+    table, localmax = [], []
+    for new_idx in range(len(keep), 0, -1):
+        old = keep[new_idx - 1]
+        in_cluster = index == new_idx
+        coords = np.argwhere(peaks & in_cluster)
+        values = zstat[tuple(coords.T)]
+        order = np.argsort(-values, kind='stable')
+        for i in order[:n_localmax]:
+            localmax.append((new_idx, float(values[i]), *coords[i]))
+        peak = coords[order[0]]
+        p = float(p_values[old - 1])
+        table.append((new_idx, int(sizes[old - 1]), p, -math.log10(max(p, 1e-300)),
+                      float(values[order[0]]), *peak))
+
+    return index, threshold, table, localmax
+
+
+def _write_table(path, header, rows):
+    """Write a tab-separated table in FSL cluster's text layout."""
+    with open(path, 'w') as f:
+        f.write('\t'.join(header) + '\t\n')
+        for row in rows:
+            f.write('\t'.join(f'{v:.6g}' if isinstance(v, float) else str(v) for v in row) + '\t\n')
+    return path
+
+# =============================================================================
+# FILE INTERFACE
+# =============================================================================
+
+def run_cluster_inference(zstat_files, mask_file, res4d_file, out_dir, z_threshold=DEFAULT_Z_THRESHOLD,
+                          p_threshold=DEFAULT_P_THRESHOLD, connectivity=CLUSTER_CONNECTIVITY):
+    """
+    Smoothness estimation and GRF cluster inference for all zstats of one design.
+
+    Args:
+        zstat_files (list): zstat images of the design
+        mask_file (str): Analysis mask
+        res4d_file (str): Residuals of the design fit; if None, smoothness is
+                          estimated from each zstat (as SmoothEstimate with zstat_file)
+        out_dir (str): Output directory
+        z_threshold (float): Cluster-forming threshold
+        p_threshold (float): Cluster-level FWE threshold
+        connectivity (int): 6, 18 or 26
+
+    Returns:
+        dict: {'threshold_files', 'index_files', 'localmax_txt_files', 'cluster_tables', 'smoothness'}
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    mask_img = load_nifti(mask_file)
+    mask = np.asanyarray(mask_img.dataobj) > 0
+
+    smoothness = None
+    if res4d_file:
+        smoothness = estimate_smoothness(np.asanyarray(load_nifti(res4d_file).dataobj), mask)
+        logger.info(f"Smoothness from residuals: DLH {smoothness['dlh']:.6g}, VOLUME {smoothness['volume']}, "
+                    f"RESELS {smoothness['resels']:.6g}")
+
+    outputs = {'threshold_files': [], 'index_files': [], 'localmax_txt_files': [], 'cluster_tables': [],
+               'smoothness': os.path.join(out_dir, 'smoothness.json')}
+    per_stat = {}
+    for zstat_file in zstat_files:
+        zstat = np.asanyarray(load_nifti(zstat_file).dataobj, dtype=np.float64)
+        smooth = smoothness or estimate_smoothness(zstat, mask)
+        name = os.path.basename(zstat_file).split('.')[0]
+        per_stat[name] = smooth
+
+        index, threshold, table, localmax = find_clusters(
+            zstat, mask, z_threshold, smooth['dlh'], smooth['volume'], p_threshold, connectivity)
+
+        prefix = os.path.join(out_dir, name)
+        nib.save(nib.Nifti1Image(threshold, mask_img.affine), f'{prefix}_threshold.nii.gz')
+        nib.save(nib.Nifti1Image(index, mask_img.affine), f'{prefix}_index.nii.gz')
+        outputs['threshold_files'].append(f'{prefix}_threshold.nii.gz')
+        outputs['index_files'].append(f'{prefix}_index.nii.gz')
+        outputs['localmax_txt_files'].append(
+            _write_table(f'{prefix}_localmax.txt', ['Cluster Index', 'Value', 'x', 'y', 'z'], localmax))
+        outputs['cluster_tables'].append(
+            _write_table(f'{prefix}_clusters.txt',
+                         ['Cluster Index', 'Voxels', 'P', '-log10(P)', 'Z-MAX', 'Z-MAX X (vox)',
+                          'Z-MAX Y (vox)', 'Z-MAX Z (vox)'], table))
+        logger.info(f"{name}: {len(table)} significant clusters at z > {z_threshold}, p < {p_threshold}")
+
+    with open(outputs['smoothness'], 'w') as f:
+        json.dump({'source': 'res4d' if res4d_file else 'zstat', 'z_threshold': z_threshold,
+                   'p_threshold': p_threshold, 'connectivity': connectivity, 'smoothness': per_stat},
+                  f, indent=2)
+    return outputs
+
+
+def run_cluster_node(zstat_files, mask_file, res4d, z_threshold=2.3, p_threshold=0.05):
+    """
+    Nipype Function-node wrapper around run_cluster_inference.
+
+    Returns:
+        tuple: (threshold_files, index_files, localmax_txt_files)
+    """
+    import os
+    from native_cluster import run_cluster_inference
+
+    # FLAMEO reports res4d as a (single-element) list
+    if isinstance(res4d, (list, tuple)):
+        res4d = res4d[0] if res4d else None
+    outputs = run_cluster_inference(zstat_files, mask_file, res4d, os.path.abspath('cluster_results'),
+                                    z_threshold=z_threshold, p_threshold=p_threshold)
+    return outputs['threshold_files'], outputs['index_files'], outputs['localmax_txt_files']
@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+"""
+Native mixed-effects group estimator (alternative to FSL FLAMEO flame1).
+
+The merged cope and varcope images are reduced to subjects x in-mask voxels
+matrices and every voxel is fitted at once. For subject i in variance group
+g(i) (design.grp) the model is
+
+    Y_i = X_i b + e_i,    e_i ~ N(0, varcope_i + s_g(i))
+
+The between-subject variance s_g of each group is estimated per voxel by
+maximising the restricted (beta-marginalised) likelihood, as FLAME does,
+with a vectorised golden-section search over all voxels of a chunk. Several
+variance groups are estimated by coordinate ascent. Given the variances, b
+is the weighted least-squares estimate and each contrast gives
+
+    cope = c b,   varcope = c (X' W X)^-1 c',   t = cope / sqrt(varcope)
+
+with dof = n - rank(X), converted to z through the t distribution. Voxel
+chunks are fitted in a process pool.
+
+Outputs follow FLAMEO naming, so wf_flameo's smoothness and clustering
+stages are unchanged:
+    pe{i}, cope{k}, varcope{k}, tstat{k}, zstat{k}, tdof_t{k},
+    mean_random_effects_var{g}, res4d
+
+Author: Xiaoqian Xiao (xiao.xiaoqian.320@gmail.com)
+"""
+
+import os
+import logging
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import nibabel as nib
+from scipy import stats
+from scipy.special import ndtri_exp
+
+from native_randomise import load_vest, load_mask, mask_data, save_masked
+from nifti_cache import load_nifti
+
+logger = logging.getLogger(__name__)
+
+# =============================================================================
+# CONSTANTS
+# =============================================================================
+
+VOXEL_CHUNK = 8192        # voxels fitted per worker task
+GOLDEN_ITERATIONS = 40    # bracket shrinks by 0.618 per iteration
+COORDINATE_SWEEPS = 3     # passes over variance groups when there are several
+VARIANCE_EPS = 1e-12
+
+_GOLDEN = (np.sqrt(5) - 1) / 2
+
+# Per-worker state, filled by _init_worker (inherited on fork)
+_STATE = {}
+
+# =============================================================================
+# MODEL FITTING
+# =============================================================================
+
+def _weighted_fit(design, y, variances):
+    """
+    Weighted least squares for every voxel.
+
+    Args:
+        design (numpy.ndarray): (n, p) design matrix
+        y (numpy.ndarray): (n, V) data
+        variances (numpy.ndarray): (n, V) total variances
+
+    Returns:
+        tuple: (beta (V, p), inverse of X'WX (V, p, p), residuals (n, V), log|X'WX| (V,))
+    """
+    n, p = design.shape
+    weights = 1.0 / variances
+    # X'WX for every voxel as one (p*p, n) x (n, V) product
+    outer = (design[:, :, np.newaxis] * design[:, np.newaxis, :]).reshape(n, p * p)
+    xtwx = (outer.T @ weights).T.reshape(-1, p, p)
+    xtwy = (design.T @ (weights * y)).T
+    xtwx_inv = np.linalg.inv(xtwx)
+    beta = np.einsum('vpq,vq->vp', xtwx_inv, xtwy)
+    resid = y - design @ beta.T
+    _, logdet = np.linalg.slogdet(xtwx)
+    return beta, xtwx_inv, resid, logdet
+
+
+def restricted_nll(design, y, varcope, group_variance):
+    """
+    Negative restricted log-likelihood per voxel (up to a constant).
+
+    Args:
+        design (numpy.ndarray): (n, p) design matrix
+        y (numpy.ndarray): (n, V) copes
+        varcope (numpy.ndarray): (n, V) first-level variances
+        group_variance (numpy.ndarray): (n, V) between-subject variance of each subject's group
+
+    Returns:
+        numpy.ndarray: (V,) negative log-likelihood
+    """
+    variances = varcope + group_variance
+    _, _, resid, logdet = _weighted_fit(design, y, variances)
+    return 0.5 * (np.sum(np.log(variances), axis=0) + logdet + np.sum(resid ** 2 / variances, axis=0))
+
+
+def estimate_group_variances(design, y, varcope, groups):
+    """
+    Estimate the between-subject variance of each variance group per voxel.
+
+    Args:
+        design (numpy.ndarray): (n, p) design matrix
+        y (numpy.ndarray): (n, V) copes
+        varcope (numpy.ndarray): (n, V) first-level variances
+        groups (numpy.ndarray): (n,) variance group label per subject
+
+    Returns:
+        dict: group label -> (V,) variance estimate
+    """
+    labels = list(np.unique(groups))
+    n_vox = y.shape[1]
+
+    # Upper bound of the search: twice the total sample variance of the voxel
+    upper = 2.0 * np.maximum(np.var(y, axis=0, ddof=1), VARIANCE_EPS)
+    estimates = {g: np.zeros(n_vox) for g in labels}
+
+    def expand(current):
+        out = np.empty_like(y)
+        for g in labels:
+            out[groups == g] = current[g]
+        return out
+
+    sweeps = COORDINATE_SWEEPS if len(labels) > 1 else 1
+    for _ in range(sweeps):
+        for g in labels:
+            lo = np.zeros(n_vox)
+            hi = upper.copy()
+
+            def nll_at(values):
+                trial = dict(estimates)
+                trial[g] = values
+                return restricted_nll(design, y, varcope, expand(trial))
+
+            x1 = hi - _GOLDEN * (hi - lo)
+            x2 = lo + _GOLDEN * (hi - lo)
+            f1, f2 = nll_at(x1), nll_at(x2)
+            for _ in range(GOLDEN_ITERATIONS):
+                left = f1 < f2
+                # Minimum in [lo, x2] where f1 < f2, else in [x1, hi]
+                hi = np.where(left, x2, hi)
+                lo = np.where(left, lo, x1)
+                new_x1 = hi - _GOLDEN * (hi - lo)
+                new_x2 = lo + _GOLDEN * (hi - lo)
+                x1, x2 = np.where(left, new_x1, x2), np.where(left, x1, new_x2)
+                f_new = nll_at(np.where(left, x1, x2))
+                f1, f2 = np.where(left, f_new, f2), np.where(left, f1, f_new)
+
+            best = (lo + hi) / 2
+            # The bracket never reaches zero exactly; keep the boundary if it is better
+            at_zero = nll_at(np.zeros(n_vox)) <= nll_at(best)
+            estimates[g] = np.where(at_zero, 0.0, best)
+
+    return estimates
+
+
+def t_to_z(tstat, dof):
+    """Convert t statistics to z through the tail probability, without underflow."""
+    tstat = np.asarray(tstat, dtype=np.float64)
+    z = np.empty_like(tstat)
+    pos = tstat >= 0
+    z[pos] = -ndtri_exp(stats.t.logsf(tstat[pos], dof))
+    z[~pos] = ndtri_exp(stats.t.logcdf(tstat[~pos], dof))
+    return z
+
+
+def fit_chunk(design, contrasts, groups, y, varcope):
+    """
+    Mixed-effects fit of one voxel chunk.
+
+    Args:
+        design (numpy.ndarray): (n, p) design matrix
+        contrasts (numpy.ndarray): (k, p) contrast rows
+        groups (numpy.ndarray): (n,) variance group labels
+        y (numpy.ndarray): (n, V) copes
+        varcope (numpy.ndarray): (n, V) first-level variances
+
+    Returns:
+        dict: 'pe' (p, V), 'cope'/'varcope'/'tstat' (k, V), 'mrev' (n_groups, V), 'res4d' (n, V)
+    """
+    estimates = estimate_group_variances(design, y, varcope, groups)
+    labels = sorted(estimates)
+    group_variance = np.empty_like(y)
+    for g in labels:
+        group_variance[groups == g] = estimates[g]
+
+    beta, xtwx_inv, resid, _ = _weighted_fit(design, y, varcope + group_variance)
+    cope = contrasts @ beta.T
+    varcope_out = np.einsum('kp,vpq,kq->kv', contrasts, xtwx_inv, contrasts)
+    tstat = cope / np.sqrt(np.maximum(varcope_out, VARIANCE_EPS))
+    return {
+        'pe': beta.T,
+        'cope': cope,
+        'varcope': varcope_out,
+        'tstat': tstat,
+        'mrev': np.vstack([estimates[g] for g in labels]),
+        'res4d': resid,
+    }
+
+
+def _init_worker(state):
+    """Process-pool initializer: keep the shared data in a module global."""
+    _STATE.clear()
+    _STATE.update(state)
+
+
+def _fit_job(bounds):
+    """Worker: fit voxels [start, stop) of the shared data."""
+    start, stop = bounds
+    return fit_chunk(_STATE['design'], _STATE['contrasts'], _STATE['groups'],
+                     _STATE['y'][:, start:stop], _STATE['varcope'][:, start:stop])
+
+
+def fit_mixed_effects(design, contrasts, groups, y, varcope, n_procs=4, chunk_size=VOXEL_CHUNK):
+    """
+    Mixed-effects fit of all voxels, in chunks spread over a process pool.
+
+    Voxels with a non-positive first-level variance are left at zero.
+
+    Returns:
+        dict: As fit_chunk, for every voxel
+    """
+    n_sub, n_vox = y.shape
+    valid = np.all(varcope > 0, axis=0) & np.any(y != 0, axis=0)
+    state = {'design': design, 'contrasts': contrasts, 'groups': groups,
+             'y': y[:, valid], 'varcope': varcope[:, valid]}
+    n_valid = int(valid.sum())
+    bounds = [(i, min(i + chunk_size, n_valid)) for i in range(0, n_valid, chunk_size)]
+
+    if n_procs <= 1 or len(bounds) <= 1:
+        _init_worker(state)
+        results = [_fit_job(b) for b in bounds]
+    else:
+        with ProcessPoolExecutor(max_workers=n_procs, initializer=_init_worker,
+                                 initargs=(state,)) as pool:
+            results = list(pool.map(_fit_job, bounds))
+
+    n_groups = len(np.unique(groups))
+    shapes = {'pe': design.shape[1], 'cope': len(contrasts), 'varcope': len(contrasts),
+              'tstat': len(contrasts), 'mrev': n_groups, 'res4d': n_sub}
+    fit = {}
+    for key, rows in shapes.items():
+        full = np.zeros((rows, n_vox))
+        if results:
+            full[:, valid] = np.concatenate([r[key] for r in results], axis=1)
+        fit[key] = full
+    fit['valid'] = valid
+    return fit
+
+# =============================================================================
+# FILE INTERFACE
+# =============================================================================
+
+def run_native_flame(cope_file, var_cope_file, mask_file, design_file, con_file, grp_file, out_dir,
+                     n_procs=4):
+    """
+    Fit a FLAME1-style mixed-effects model and write FLAMEO-named outputs.
+
+    Args:
+        cope_file (str): Merged 4D cope
+        var_cope_file (str): Merged 4D varcope
+        mask_file (str): Analysis mask
+        design_file (str): design.mat
+        con_file (str): contrast.con
+        grp_file (str): design.grp (variance groups)
+        out_dir (str): Output directory (like FLAMEO's stats/)
+        n_procs (int): Number of worker processes
+
+    Returns:
+        dict: {'zstats': [...], 'tstats': [...], 'copes': [...], 'var_copes': [...],
+               'pes': [...], 'tdof': [...], 'mrefvars': [...], 'res4d': path}
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    mask, mask_img = load_mask(mask_file)
+    y = mask_data(cope_file, mask)
+    varcope = mask_data(var_cope_file, mask)
+    design = load_vest(design_file)
+    contrasts = load_vest(con_file)
+    groups = load_vest(grp_file)[:, 0].astype(int)
+
+    if not (y.shape == varcope.shape and design.shape[0] == y.shape[0] == len(groups)):
+        raise ValueError(f"Inconsistent inputs: cope {y.shape}, varcope {varcope.shape}, "
+                         f"design {design.shape}, groups {len(groups)}")
+
+    dof = y.shape[0] - np.linalg.matrix_rank(design)
+    logger.info(f"Native FLAME1: {y.shape[0]} subjects, {y.shape[1]} voxels, {len(contrasts)} contrasts, "
+                f"{len(np.unique(groups))} variance groups, dof {dof}")
+    fit = fit_mixed_effects(design, contrasts, groups, y, varcope, n_procs=n_procs)
+
+    def out(name):
+        return os.path.join(out_dir, f'{name}.nii.gz')
+
+    outputs = {'zstats': [], 'tstats': [], 'copes': [], 'var_copes': [], 'pes': [], 'tdof': [], 'mrefvars': []}
+    for i, pe in enumerate(fit['pe'], start=1):
+        outputs['pes'].append(save_masked(pe, mask, mask_img, out(f'pe{i}')))
+    for k in range(len(contrasts)):
+        zstat = np.where(fit['valid'], t_to_z(fit['tstat'][k], dof), 0.0)
+        outputs['copes'].append(save_masked(fit['cope'][k], mask, mask_img, out(f'cope{k + 1}')))
+        outputs['var_copes'].append(save_masked(fit['varcope'][k], mask, mask_img, out(f'varcope{k + 1}')))
+        outputs['tstats'].append(save_masked(fit['tstat'][k], mask, mask_img, out(f'tstat{k + 1}')))
+        outputs['zstats'].append(save_masked(zstat, mask, mask_img, out(f'zstat{k + 1}')))
+        outputs['tdof'].append(save_masked(np.where(fit['valid'], dof, 0), mask, mask_img, out(f'tdof_t{k + 1}')))
+    for g, mrev in enumerate(fit['mrev'], start=1):
+        outputs['mrefvars'].append(save_masked(mrev, mask, mask_img, out(f'mean_random_effects_var{g}')))
+
+    res4d = np.zeros(mask.shape + (y.shape[0],), dtype=np.float32)
+    res4d[mask] = fit['res4d'].T
+    outputs['res4d'] = out('res4d')
+    nib.save(nib.Nifti1Image(res4d, mask_img.affine), outputs['res4d'])
+
+    logger.info(f"Native FLAME1 finished: max |z| = "
+                f"{max(float(np.abs(load_nifti(f).get_fdata()).max()) for f in outputs['zstats']):.3f}")
+    return outputs
+
+
+def run_flame_node(cope_file, var_cope_file, mask_file, design_file, t_con_file, cov_split_file, n_procs=4):
+    """
+    Nipype Function-node wrapper around run_native_flame.
+
+    Returns:
+        tuple: (zstats, tstats, copes, var_copes, res4d)
+    """
+    import os
+    from native_flame import run_native_flame
+
+    outputs = run_native_flame(cope_file, var_cope_file, mask_file, design_file, t_con_file, cov_split_file,
+                               os.path.abspath('stats'), n_procs=n_procs)
+    return outputs['zstats'], outputs['tstats'], outputs['copes'], outputs['var_copes'], outputs['res4d']
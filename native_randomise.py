@@ -0,0 +1,631 @@
+#!/usr/bin/env python3
+"""
+Native permutation inference for group-level GLMs (alternative to FSL randomise).
+
+The merged 4D cope is reduced to a subjects x in-mask voxels matrix once, and
+the null distribution of each t contrast is built from batches of
+permutations (or sign-flips for one-sample designs). Each batch is evaluated
+with a few dense matrix products over all voxels at once, and batches are
+spread over a process pool.
+
+Permutation scheme (Freedman-Lane, as in randomise):
+    Y* = P Rz Y + Hz Y
+where Z is the nuisance part of the design for the contrast, Hz its hat
+matrix and Rz = I - Hz. For a batch of permutation matrices P_b,
+    c b*    = (c X+ P_b) (Rz Y) + c X+ Hz Y
+    RSS*    = ||Rz Y||^2 - ||Q' P_b Rz Y||^2      (Q: orthonormal basis of X)
+so every permutation needs only two small-by-(n x V) products.
+
+With tfce=True (as in wf_randomise) each permuted t map is TFCE-enhanced
+inside the workers (tfce.py, FSL defaults) before taking the maximum.
+
+With adaptive stopping, permutations are run in rounds and a contrast stops
+early once Clopper-Pearson intervals on the voxels' corrected p-values (their
+exceedance counts in the max null) show that even its largest statistic
+cannot reach FWE significance, or that every voxel is either decided at
+alpha or known to the requested precision. The number of permutations
+actually run is recorded in randomise_permutations.json.
+
+Outputs follow randomise naming, so run_group_level_workflow picks them up:
+    randomise_tstat{k}.nii.gz
+    randomise_{tfce,vox}_p_tstat{k}.nii.gz       (1 - uncorrected p)
+    randomise_{tfce,vox}_corrp_tstat{k}.nii.gz   (1 - FWE-corrected p, max-statistic)
+
+run_native_randomise_batch runs all copes of a task against one permutation
+set and can additionally correct across copes:
+    randomise_{tfce,vox}_family_corrp_tstat{k}.nii.gz
+
+Author: Xiaoqian Xiao (xiao.xiaoqian.320@gmail.com)
+"""
+
+import os
+import json
+import math
+import logging
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import nibabel as nib
+from tfce import tfce_masked, TFCE_STEPS
+from nifti_cache import load_nifti
+
+logger = logging.getLogger(__name__)
+
+# =============================================================================
+# CONSTANTS
+# =============================================================================
+
+DEFAULT_NUM_PERM = 5000
+PERM_BATCH_SIZE = 64     # permutations evaluated per matrix product
+RANK_TOL = 1e-8
+
+# Adaptive stopping defaults: decisions at alpha, CI half-width target on the
+# corrected p of voxels near alpha (5000 permutations give ~0.008 at 99% confidence)
+DEFAULT_STOPPING = {
+    'alpha': 0.05,
+    'precision': 0.008,
+    'confidence': 0.99,
+    'min_perm': 500,
+}
+
+# Per-worker state, filled by _init_worker (inherited on fork)
+_STATE = {}
+
+# =============================================================================
+# DESIGN FILES
+# =============================================================================
+
+def load_vest(path):
+    """Read an FSL VEST text matrix (design.mat, contrast.con, design.grp)."""
+    rows = []
+    in_matrix = False
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith('/'):
+                in_matrix = line.startswith('/Matrix')
+                continue
+            if in_matrix:
+                rows.append([float(v) for v in line.split()])
+    return np.atleast_2d(np.asarray(rows, dtype=np.float64))
+
+
+def load_mask(mask_file):
+    """Return (boolean 3D mask, mask image)."""
+    mask_img = load_nifti(mask_file)
+    return np.asanyarray(mask_img.dataobj) > 0, mask_img
+
+
+def mask_data(in_file, mask):
+    """Load a 4D image as a subjects x in-mask voxels matrix."""
+    data = np.asanyarray(load_nifti(in_file).dataobj, dtype=np.float64)
+    if data.ndim == 3:
+        data = data[..., np.newaxis]
+    return data[mask].T.copy()
+
+
+def load_masked_data(in_file, mask_file):
+    """
+    Load a 4D image as a subjects x in-mask voxels matrix.
+
+    Returns:
+        tuple: (data (n_subjects, n_voxels), mask boolean 3D array, mask image)
+    """
+    mask, mask_img = load_mask(mask_file)
+    return mask_data(in_file, mask), mask, mask_img
+
+
+def save_masked(values, mask, mask_img, out_file):
+    """Write in-mask values as a 3D image on the mask grid."""
+    volume = np.zeros(mask.shape, dtype=np.float32)
+    volume[mask] = values
+    nib.save(nib.Nifti1Image(volume, mask_img.affine), out_file)
+    return out_file
+
+# =============================================================================
+# PERMUTATIONS
+# =============================================================================
+
+def is_one_sample(design):
+    """True if the design is a single constant column (group mean only)."""
+    return design.shape[1] == 1 and np.allclose(design[:, 0], design[0, 0])
+
+
+def generate_permutations(n_subjects, num_perm, sign_flip, seed=0):
+    """
+    Draw permutation orders and sign vectors; the first entry is the identity.
+
+    Designs with few enough distinct rearrangements are enumerated exhaustively.
+
+    Args:
+        n_subjects (int): Number of subjects
+        num_perm (int): Requested number of permutations (including identity)
+        sign_flip (bool): Sign-flip (one-sample) instead of permuting rows
+        seed (int): Random seed
+
+    Returns:
+        tuple: (orders (n_perm, n) int array, signs (n_perm, n) float array)
+    """
+    identity = np.arange(n_subjects)
+    ones = np.ones(n_subjects)
+
+    if sign_flip:
+        if 2 ** n_subjects <= num_perm:
+            signs = np.asarray(list(itertools.product([1.0, -1.0], repeat=n_subjects)))
+        else:
+            rng = np.random.default_rng(seed)
+            signs = rng.choice([1.0, -1.0], size=(num_perm, n_subjects))
+            signs[0] = ones
+        orders = np.tile(identity, (len(signs), 1))
+    else:
+        if math.factorial(n_subjects) <= num_perm:
+            orders = np.asarray(list(itertools.permutations(identity)))
+        else:
+            rng = np.random.default_rng(seed)
+            orders = np.asarray([rng.permutation(n_subjects) for _ in range(num_perm)])
+            orders[0] = identity
+        signs = np.ones(orders.shape)
+
+    return orders, signs
+
+
+def _permutation_matrices(orders, signs):
+    """Build (B, n, n) matrices P with (P Y)[i] = signs[i] * Y[orders[i]]."""
+    n_batch, n = orders.shape
+    mats = np.zeros((n_batch, n, n))
+    rows = np.arange(n)
+    for b in range(n_batch):
+        mats[b, rows, orders[b]] = signs[b]
+    return mats
+
+# =============================================================================
+# CONTRAST SETUP
+# =============================================================================
+
+def _orthonormal_basis(matrix):
+    """Orthonormal basis of the column space of matrix (may have zero columns)."""
+    if matrix.size == 0:
+        return np.zeros((matrix.shape[0], 0))
+    u, s, _ = np.linalg.svd(matrix, full_matrices=False)
+    rank = int(np.sum(s > RANK_TOL * max(1.0, s.max())))
+    return u[:, :rank]
+
+
+def prepare_contrast(data, design, contrast):
+    """
+    Precompute everything a worker needs to evaluate permutations of one contrast.
+
+    Args:
+        data (numpy.ndarray): (n_subjects, n_voxels) data
+        design (numpy.ndarray): (n_subjects, n_evs) design matrix
+        contrast (numpy.ndarray): (n_evs,) contrast vector
+
+    Returns:
+        dict: Worker state for the contrast
+    """
+    contrast = np.asarray(contrast, dtype=np.float64).reshape(1, -1)
+    n_subjects = design.shape[0]
+
+    pinv_x = np.linalg.pinv(design)
+    q_basis = _orthonormal_basis(design)
+    dof = n_subjects - q_basis.shape[1]
+    if dof <= 0:
+        raise ValueError(f"Design has no residual degrees of freedom ({n_subjects} subjects)")
+
+    # Nuisance space: part of the design not tested by the contrast
+    nuisance = design @ (np.eye(design.shape[1]) - np.linalg.pinv(contrast) @ contrast)
+    z_basis = _orthonormal_basis(nuisance)
+    fitted_z = z_basis @ (z_basis.T @ data)
+    resid_z = data - fitted_z
+
+    weights = (contrast @ pinv_x).ravel()
+    var_factor = float((contrast @ np.linalg.pinv(design.T @ design) @ contrast.T).item())
+
+    return {
+        'resid_z': resid_z,
+        'ss_resid_z': np.sum(resid_z ** 2, axis=0),
+        'offset': weights @ fitted_z,
+        'weights': weights,
+        'q_basis': q_basis,
+        'dof': dof,
+        'var_factor': var_factor,
+    }
+
+
+def compute_t_batch(state, orders, signs):
+    """
+    Evaluate the t statistic for a batch of permutations.
+
+    Args:
+        state (dict): Output of prepare_contrast
+        orders (numpy.ndarray): (B, n) permutation orders
+        signs (numpy.ndarray): (B, n) sign vectors
+
+    Returns:
+        numpy.ndarray: (B, n_voxels) t statistics
+    """
+    perms = _permutation_matrices(orders, signs)
+    resid_z = state['resid_z']
+
+    # Numerator: (c X+ P_b) Rz Y + c X+ Hz Y, all permutations in one product
+    numer = (np.einsum('j,bji->bi', state['weights'], perms) @ resid_z) + state['offset']
+
+    # Residual sum of squares: ||Rz Y||^2 - ||Q' P_b Rz Y||^2
+    qp = np.einsum('jk,bjl->bkl', state['q_basis'], perms)
+    n_batch, rank, n = qp.shape
+    fitted = (qp.reshape(n_batch * rank, n) @ resid_z).reshape(n_batch, rank, -1)
+    rss = state['ss_resid_z'] - np.sum(fitted ** 2, axis=1)
+
+    denom = np.sqrt(np.clip(rss, 0, None) * state['var_factor'] / state['dof'])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tstat = np.where(denom > 0, numer / denom, 0.0)
+    return tstat
+
+
+def transform_statistic(state, tstat):
+    """
+    Map raw t statistics to the statistic used for inference.
+
+    With TFCE enabled (state['tfce_mask']), every row is TFCE-enhanced on the
+    mask grid using the step size derived from the unpermuted map, as
+    randomise does; otherwise the t statistics are used as is.
+    """
+    mask = state.get('tfce_mask')
+    if mask is None:
+        return tstat
+    return np.stack([tfce_masked(row, mask, dh=state['tfce_dh']) for row in tstat])
+
+# =============================================================================
+# PARALLEL NULL DISTRIBUTION
+# =============================================================================
+
+def _init_worker(state):
+    """Install the contrast state in a worker process."""
+    _STATE.clear()
+    _STATE.update(state)
+
+
+def _null_batch(args):
+    """Worker: max statistic per permutation and voxelwise exceedance counts."""
+    orders, signs = args
+    stat = transform_statistic(_STATE, compute_t_batch(_STATE, orders, signs))
+    exceed = np.sum(stat >= _STATE['observed'] - 1e-10, axis=0)
+    return stat.max(axis=1), exceed
+
+
+def clopper_pearson(k, n, confidence):
+    """
+    Exact binomial confidence interval for k successes out of n.
+
+    Args:
+        k (int or numpy.ndarray): Successes (scalar or array)
+        n (int): Trials
+        confidence (float): Confidence level
+
+    Returns:
+        tuple: (lower, upper) as floats for scalar k, arrays otherwise
+    """
+    from scipy.stats import beta
+
+    tail = (1 - confidence) / 2
+    k_arr = np.asarray(k, dtype=float)
+    with np.errstate(invalid='ignore'):
+        lower = np.where(k_arr > 0, beta.ppf(tail, np.maximum(k_arr, 1), n - k_arr + 1), 0.0)
+        upper = np.where(k_arr < n, beta.ppf(1 - tail, k_arr + 1, np.maximum(n - k_arr, 1)), 1.0)
+    if k_arr.ndim == 0:
+        return float(lower), float(upper)
+    return lower, upper
+
+
+def check_stopping(max_null, observed, stopping):
+    """
+    Sequential stopping rule on the voxels' FWE-corrected p-values.
+
+    The corrected p of a voxel is its exceedance count in the max-statistic
+    null, so each voxel gets an exact interval on it. Permuting continues
+    while some voxel's interval still contains alpha and is wider than the
+    target precision.
+
+    Args:
+        max_null (numpy.ndarray): Max statistics of the permutations run so far
+        observed (numpy.ndarray): Observed (in-mask) statistics of the contrast
+        stopping (dict): alpha, precision, confidence and min_perm settings
+
+    Returns:
+        str: 'null' if no voxel can reach significance, 'decided' if every
+             voxel's interval excludes alpha, 'precision' if the undecided
+             voxels' corrected p are known to the target precision, else None
+    """
+    n_run = len(max_null)
+    if n_run < stopping['min_perm']:
+        return None
+
+    # Exceedance count of every voxel in the max null (distinct counts suffice)
+    null_sorted = np.sort(max_null)
+    counts = n_run - np.searchsorted(null_sorted, np.asarray(observed) - 1e-10, side='left')
+    counts = np.unique(counts)
+
+    # Smallest corrected p of the contrast
+    lower, _ = clopper_pearson(int(counts[0]), n_run, stopping['confidence'])
+    if lower > stopping['alpha']:
+        return 'null'
+
+    # Voxels whose interval still contains alpha must be known to the precision
+    lower, upper = clopper_pearson(counts, n_run, stopping['confidence'])
+    undecided = (lower <= stopping['alpha']) & (upper >= stopping['alpha'])
+    if not undecided.any():
+        return 'decided'
+    if np.all((upper - lower)[undecided] / 2 <= stopping['precision']):
+        return 'precision'
+    return None
+
+
+def permutation_null(state, orders, signs, n_procs=4, batch_size=PERM_BATCH_SIZE, stopping=None):
+    """
+    Build the max-statistic null distribution and uncorrected exceedance counts.
+
+    Args:
+        state (dict): Contrast state including 'observed' statistic
+        orders (numpy.ndarray): (n_perm, n) permutation orders (first = identity)
+        signs (numpy.ndarray): (n_perm, n) sign vectors
+        n_procs (int): Number of worker processes
+        batch_size (int): Permutations per matrix product
+        stopping (dict): Adaptive stopping settings (see DEFAULT_STOPPING), or
+                         None to always run every permutation
+
+    Returns:
+        tuple: (max statistics (n_run,), exceedance counts (n_voxels,), run info dict)
+    """
+    batches = [(orders[i:i + batch_size], signs[i:i + batch_size])
+               for i in range(0, len(orders), batch_size)]
+    # Without stopping everything is one round; otherwise two batches per worker per round
+    round_size = len(batches) if stopping is None else max(1, n_procs) * 2
+    info = {'requested': len(orders), 'run': 0, 'stopped_early': False, 'reason': 'completed'}
+
+    pool = None
+    if n_procs <= 1:
+        _init_worker(state)
+    else:
+        pool = ProcessPoolExecutor(max_workers=n_procs, initializer=_init_worker, initargs=(state,))
+
+    results = []
+    try:
+        for start in range(0, len(batches), round_size):
+            chunk = batches[start:start + round_size]
+            results.extend(pool.map(_null_batch, chunk) if pool else map(_null_batch, chunk))
+            if stopping is None or start + round_size >= len(batches):
+                continue
+            reason = check_stopping(np.concatenate([r[0] for r in results]), state['observed'], stopping)
+            if reason:
+                info.update(stopped_early=True, reason=reason)
+                break
+    finally:
+        if pool:
+            pool.shutdown()
+
+    max_null = np.concatenate([r[0] for r in results])
+    exceed = np.sum([r[1] for r in results], axis=0)
+    info['run'] = len(max_null)
+    return max_null, exceed, info
+
+# =============================================================================
+# ENTRY POINTS
+# =============================================================================
+
+def _stop_rule(n_subjects, num_perm, sign_flip, adaptive, stopping):
+    """Resolve the stopping settings; exhaustive enumerations always run to completion."""
+    # Exhaustive enumerations are ordered, so stopping part-way would bias the null
+    exhaustive = (2 ** n_subjects if sign_flip else math.factorial(n_subjects)) <= num_perm
+    return dict(DEFAULT_STOPPING, **(stopping or {})) if adaptive and not exhaustive else None
+
+
+def infer_contrasts(data, design, contrasts, mask, mask_img, orders, signs, out_dir,
+                    n_procs=4, base_name='randomise', tfce=True, stop_rule=None):
+    """
+    Permutation inference for every contrast of one loaded dataset.
+
+    Args:
+        data (numpy.ndarray): (n_subjects, n_voxels) in-mask data
+        design (numpy.ndarray): Design matrix
+        contrasts (numpy.ndarray): Contrast rows
+        mask, mask_img: Mask array and image (from load_mask)
+        orders, signs (numpy.ndarray): Shared permutation set (generate_permutations)
+        out_dir (str): Output directory
+        n_procs (int): Number of worker processes
+        base_name (str): Output file prefix
+        tfce (bool): TFCE-enhance statistics
+        stop_rule (dict): Adaptive stopping settings, or None
+
+    Returns:
+        tuple: (outputs dict of file lists, per-contrast run info dict,
+                list of (observed statistic, max null) per contrast)
+    """
+    if design.shape[0] != data.shape[0]:
+        raise ValueError(f"Design has {design.shape[0]} rows but the data have {data.shape[0]} volumes")
+
+    stat_prefix = 'tfce' if tfce else 'vox'
+    outputs = {'tstat_files': [], 't_p_files': [], 't_corrected_p_files': []}
+    run_info = {}
+    nulls = []
+    for k, contrast in enumerate(contrasts, start=1):
+        state = prepare_contrast(data, design, contrast)
+        tstat = compute_t_batch(state, orders[:1], signs[:1])[0]
+        if tfce:
+            state['tfce_mask'] = mask
+            state['tfce_dh'] = max(float(tstat.max()), 0.0) / TFCE_STEPS or None
+        state['observed'] = transform_statistic(state, tstat[np.newaxis])[0]
+
+        max_null, exceed, info = permutation_null(state, orders, signs, n_procs, stopping=stop_rule)
+        n_total = len(max_null)
+        p_uncorr = exceed / n_total
+        p_corr = np.sum(max_null[:, np.newaxis] >= state['observed'][np.newaxis] - 1e-10, axis=0) / n_total
+
+        prefix = os.path.join(out_dir, base_name)
+        outputs['tstat_files'].append(save_masked(tstat, mask, mask_img, f'{prefix}_tstat{k}.nii.gz'))
+        outputs['t_p_files'].append(
+            save_masked(1 - p_uncorr, mask, mask_img, f'{prefix}_{stat_prefix}_p_tstat{k}.nii.gz'))
+        outputs['t_corrected_p_files'].append(
+            save_masked(1 - p_corr, mask, mask_img, f'{prefix}_{stat_prefix}_corrp_tstat{k}.nii.gz'))
+        info['min_corrected_p'] = float(p_corr.min())
+        run_info[f'tstat{k}'] = info
+        nulls.append((state['observed'], max_null))
+        logger.info(f"Contrast {k}: max t = {tstat.max():.3f}, min FWE p = {p_corr.min():.4f} "
+                    f"({info['run']}/{info['requested']} permutations, {info['reason']})")
+
+    return outputs, run_info, nulls
+
+
+def _write_perm_log(out_dir, base_name, perm_log):
+    """Write the permutation-count JSON next to the outputs."""
+    log_file = os.path.join(out_dir, f'{base_name}_permutations.json')
+    with open(log_file, 'w') as f:
+        json.dump(perm_log, f, indent=2)
+    return log_file
+
+
+def run_native_randomise(in_file, mask_file, design_file, con_file, out_dir,
+                         num_perm=DEFAULT_NUM_PERM, n_procs=4, seed=0, base_name='randomise',
+                         tfce=True, adaptive=False, stopping=None):
+    """
+    Run permutation inference for every t contrast of a design.
+
+    Args:
+        in_file (str): Merged 4D cope
+        mask_file (str): Analysis mask
+        design_file (str): design.mat
+        con_file (str): contrast.con
+        out_dir (str): Output directory
+        num_perm (int): Number of permutations (including the unpermuted data)
+        n_procs (int): Number of worker processes
+        seed (int): Random seed for the permutation set
+        base_name (str): Output file prefix
+        tfce (bool): TFCE-enhance statistics (randomise -T); voxelwise otherwise
+        adaptive (bool): Stop permuting early per contrast (see check_stopping)
+        stopping (dict): Overrides for DEFAULT_STOPPING
+
+    Returns:
+        dict: {'tstat_files': [...], 't_p_files': [...], 't_corrected_p_files': [...],
+               'perm_log': path to the permutation-count JSON}
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    data, mask, mask_img = load_masked_data(in_file, mask_file)
+    design = load_vest(design_file)
+    contrasts = load_vest(con_file)
+
+    if design.shape[0] != data.shape[0]:
+        raise ValueError(f"Design has {design.shape[0]} rows but {in_file} has {data.shape[0]} volumes")
+
+    sign_flip = is_one_sample(design)
+    orders, signs = generate_permutations(data.shape[0], num_perm, sign_flip, seed)
+    logger.info(f"Native randomise: {data.shape[0]} subjects, {data.shape[1]} voxels, "
+                f"{len(contrasts)} contrasts, {len(orders)} "
+                f"{'sign-flips' if sign_flip else 'permutations'}")
+
+    stop_rule = _stop_rule(data.shape[0], num_perm, sign_flip, adaptive, stopping)
+    outputs, run_info, _ = infer_contrasts(data, design, contrasts, mask, mask_img, orders, signs, out_dir,
+                                           n_procs=n_procs, base_name=base_name, tfce=tfce, stop_rule=stop_rule)
+
+    outputs['perm_log'] = _write_perm_log(out_dir, base_name, {
+        'engine': 'native', 'statistic': 'tfce' if tfce else 'vox', 'seed': seed,
+        'scheme': 'sign-flip' if sign_flip else 'permutation',
+        'stopping': stop_rule, 'contrasts': run_info,
+    })
+    return outputs
+
+
+def run_native_randomise_batch(jobs, mask_file, design_file, con_file, num_perm=DEFAULT_NUM_PERM,
+                               n_procs=4, seed=0, base_name='randomise', tfce=True, family_wise=True,
+                               adaptive=False, stopping=None):
+    """
+    Run permutation inference for several copes that share one design.
+
+    The mask, design and permutation set are loaded/drawn once and reused for
+    every cope, so all copes are tested against the same permutations. With
+    family_wise=True each cope also gets p-values corrected across all copes
+    and contrasts (max statistic over the whole family per permutation),
+    written as {base_name}_{tfce,vox}_family_corrp_tstat{k}.
+
+    Args:
+        jobs (list): (label, merged 4D cope, output directory) per cope
+        mask_file (str): Analysis mask
+        design_file (str): design.mat shared by all copes
+        con_file (str): contrast.con shared by all copes
+        num_perm, n_procs, seed, base_name, tfce: As in run_native_randomise
+        family_wise (bool): Also write p-values corrected across copes
+        adaptive (bool): Adaptive stopping (not applied when family_wise, which
+                         needs the full permutation set for every cope; a
+                         warning is logged)
+        stopping (dict): Overrides for DEFAULT_STOPPING
+
+    Returns:
+        dict: Per-label outputs as returned by run_native_randomise, plus
+              'family_corrected_p_files' when family_wise
+    """
+    mask, mask_img = load_mask(mask_file)
+    design = load_vest(design_file)
+    contrasts = load_vest(con_file)
+    n_subjects = design.shape[0]
+
+    sign_flip = is_one_sample(design)
+    orders, signs = generate_permutations(n_subjects, num_perm, sign_flip, seed)
+    family_wise = family_wise and len(jobs) > 1
+    if family_wise and adaptive:
+        logger.warning("Adaptive stopping is disabled: the family-wise correction across copes "
+                       "needs every permutation of every cope (use family_wise=False)")
+    stop_rule = None if family_wise else _stop_rule(n_subjects, num_perm, sign_flip, adaptive, stopping)
+    stat_prefix = 'tfce' if tfce else 'vox'
+    logger.info(f"Native randomise batch: {len(jobs)} copes, {n_subjects} subjects, "
+                f"{len(contrasts)} contrasts, {len(orders)} {'sign-flips' if sign_flip else 'permutations'}")
+
+    results = {}
+    family = {}
+    for label, in_file, out_dir in jobs:
+        logger.info(f"Cope {label}: {in_file}")
+        os.makedirs(out_dir, exist_ok=True)
+        data = mask_data(in_file, mask)
+        outputs, run_info, nulls = infer_contrasts(data, design, contrasts, mask, mask_img, orders, signs,
+                                                   out_dir, n_procs=n_procs, base_name=base_name,
+                                                   tfce=tfce, stop_rule=stop_rule)
+        del data
+        outputs['perm_log'] = _write_perm_log(out_dir, base_name, {
+            'engine': 'native', 'statistic': stat_prefix, 'seed': seed,
+            'scheme': 'sign-flip' if sign_flip else 'permutation',
+            'stopping': stop_rule, 'batch': [job[0] for job in jobs],
+            'family_wise': family_wise, 'contrasts': run_info,
+        })
+        results[label] = outputs
+        family[label] = nulls
+
+    if family_wise:
+        # Max over every cope and contrast for each (shared) permutation
+        family_max = np.max([max_null for nulls in family.values() for _, max_null in nulls], axis=0)
+        for label, _, out_dir in jobs:
+            results[label]['family_corrected_p_files'] = []
+            for k, (observed, _) in enumerate(family[label], start=1):
+                p_family = np.sum(family_max[:, np.newaxis] >= observed[np.newaxis] - 1e-10,
+                                  axis=0) / len(family_max)
+                out_file = os.path.join(out_dir, f'{base_name}_{stat_prefix}_family_corrp_tstat{k}.nii.gz')
+                results[label]['family_corrected_p_files'].append(
+                    save_masked(1 - p_family, mask, mask_img, out_file))
+        logger.info(f"Family-wise correction across {len(jobs)} copes x {len(contrasts)} contrasts")
+
+    return results
+
+
+def run_randomise_node(in_file, mask, design_mat, tcon, num_perm=5000, n_procs=4, seed=0, tfce=True,
+                       adaptive=False):
+    """
+    Nipype Function-node wrapper around run_native_randomise.
+
+    Returns:
+        tuple: (tstat_files, t_corrected_p_files, perm_log)
+    """
+    import os
+    from native_randomise import run_native_randomise
+
+    outputs = run_native_randomise(in_file, mask, design_mat, tcon, os.path.abspath('.'),
+                                   num_perm=num_perm, n_procs=n_procs, seed=seed, tfce=tfce,
+                                   adaptive=adaptive)
+    return outputs['tstat_files'], outputs['t_corrected_p_files'], outputs['perm_log']
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+"""
+Read-through cache of decompressed NIfTI files on node-local scratch.
+
+The group and ROI modules read the same .nii.gz files many times (the group
+mask, merged 4D copes read by the native randomise/FLAME engines, ROI
+extraction and PSC, ROI masks), and every read gunzips the whole file
+again. load_nifti keeps one decompressed .nii copy per source file under
+NIFTI_CACHE_DIR, keyed by path, size and modification time, and opens it
+memory-mapped, so later reads only touch the pages they need.
+
+The cache is capped at NIFTI_CACHE_MAX_GB; least recently used copies are
+evicted first (a hit refreshes the copy's modification time). Copies are
+written under a temporary name and renamed into place, so concurrent jobs
+sharing a node never see a partial file.
+
+Environment:
+    NIFTI_CACHE         cache directory (default: $TMPDIR/nifti_cache); 'off' disables caching
+    NIFTI_CACHE_MAX_GB  size cap in GB (default: 20)
+
+Author: Xiaoqian Xiao (xiao.xiaoqian.320@gmail.com)
+"""
+
+import os
+import math
+import gzip
+import shutil
+import hashlib
+import logging
+import tempfile
+import nibabel as nib
+
+logger = logging.getLogger(__name__)
+
+# =============================================================================
+# CONSTANTS
+# =============================================================================
+
+NIFTI_CACHE_DIR = os.getenv('NIFTI_CACHE',
+                            os.path.join(os.getenv('TMPDIR', tempfile.gettempdir()), 'nifti_cache'))
+NIFTI_CACHE_MAX_BYTES = int(float(os.getenv('NIFTI_CACHE_MAX_GB', '20')) * 1024 ** 3)
+DECOMPRESS_BLOCK_SIZE = 16 * 1024 * 1024  # 16 MB copy buffer
+
+# =============================================================================
+# CACHE
+# =============================================================================
+
+def cache_enabled(cache_dir=None):
+    """True unless caching is switched off (NIFTI_CACHE=off)."""
+    return (cache_dir or NIFTI_CACHE_DIR).lower() not in ('off', 'none', '0', '')
+
+
+def cache_key(path):
+    """Key of a source file: its absolute path, size and modification time."""
+    st = os.stat(path)
+    h = hashlib.sha1(os.path.abspath(path).encode())
+    h.update(f'{st.st_size}:{st.st_mtime_ns}'.encode())
+    return h.hexdigest()
+
+
+def _cache_entries(cache_dir):
+    """(mtime, size, path) of every cached copy."""
+    entries = []
+    for name in os.listdir(cache_dir):
+        if not name.endswith('.nii'):
+            continue
+        path = os.path.join(cache_dir, name)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            continue  # evicted by another process
+        entries.append((st.st_mtime, st.st_size, path))
+    return entries
+
+
+def evict(cache_dir=None, max_bytes=None, keep=None):
+    """
+    Remove least recently used copies until the cache fits its size cap.
+
+    Args:
+        cache_dir (str): Cache directory (default: NIFTI_CACHE_DIR)
+        max_bytes (int): Size cap (default: NIFTI_CACHE_MAX_BYTES)
+        keep (str): Copy that must not be evicted (the one just added)
+
+    Returns:
+        int: Bytes freed
+    """
+    cache_dir = cache_dir or NIFTI_CACHE_DIR
+    max_bytes = NIFTI_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    entries = sorted(_cache_entries(cache_dir))
+    total = sum(size for _, size, _ in entries)
+    freed = 0
+    for _, size, path in entries:
+        if total <= max_bytes:
+            break
+        if path == keep:
+            continue
+        try:
+            # Readers that already mapped the copy keep their view of it
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        freed += size
+    if freed:
+        logger.info(f"Evicted {freed / 1024 ** 2:.1f} MB from NIfTI cache {cache_dir}")
+    return freed
+
+
+def uncompressed_size(path):
+    """Size of a .nii.gz file once decompressed, from its header (None if it cannot be read)."""
+    try:
+        header = nib.load(path).header
+        # nibabel reports offset 0 for loaded single-file images; the data follows the header
+        offset = int(header.get_data_offset()) or int(getattr(header, 'single_vox_offset', 0))
+        return offset + math.prod(header.get_data_shape()) * int(header['bitpix']) // 8
+    except (nib.filebasedimages.ImageFileError, OSError, ValueError, KeyError):
+        return None
+
+
+def cached_path(path, cache_dir=None, max_bytes=None):
+    """
+    Path of a decompressed copy of a .nii.gz file, creating it on a miss.
+
+    Uncompressed files, files larger than the cache cap, and calls with the
+    cache disabled return the original path. The size is taken from the
+    header, so files over the cap are never decompressed.
+
+    Args:
+        path (str): Source NIfTI file
+        cache_dir (str): Cache directory (default: NIFTI_CACHE_DIR)
+        max_bytes (int): Size cap (default: NIFTI_CACHE_MAX_BYTES)
+
+    Returns:
+        str: Path to read from
+    """
+    path = str(path)
+    cache_dir = cache_dir or NIFTI_CACHE_DIR
+    max_bytes = NIFTI_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    if not path.endswith('.gz') or not cache_enabled(cache_dir):
+        return path
+
+    cache_file = os.path.join(cache_dir, f'{cache_key(path)}.nii')
+    if os.path.exists(cache_file):
+        try:
+            os.utime(cache_file)  # mark as recently used
+            return cache_file
+        except FileNotFoundError:
+            pass  # evicted in between; decompress again
+
+    size = uncompressed_size(path)
+    if size is not None and size > max_bytes:
+        logger.debug(f"{path} exceeds the NIfTI cache cap; reading it directly")
+        return path
+
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_file = f'{cache_file}.{os.getpid()}.partial'
+    try:
+        with gzip.open(path, 'rb') as src, open(tmp_file, 'wb') as dst:
+            shutil.copyfileobj(src, dst, DECOMPRESS_BLOCK_SIZE)
+        if os.path.getsize(tmp_file) > max_bytes:
+            logger.debug(f"{path} exceeds the NIfTI cache cap; reading it directly")
+            return path
+        os.replace(tmp_file, cache_file)
+    finally:
+        # Never leave a partial file behind (over the cap, corrupt input, full disk)
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+    logger.debug(f"Cached {path} -> {cache_file}")
+    evict(cache_dir, max_bytes, keep=cache_file)
+    return cache_file
+
+
+def load_nifti(path, mmap=True, cache_dir=None):
+    """
+    Load a NIfTI image through the decompressed cache.
+
+    The single loader used by the in-process group and ROI readers
+    (pre_group_merge, resampling, native_randomise, native_flame,
+    native_cluster, tfce, roi_engine, roi_stats, cope_store, group_results_db).
+
+    Args:
+        path (str): NIfTI file (.nii or .nii.gz)
+        mmap (bool): Memory-map the (decompressed) data
+        cache_dir (str): Cache directory (default: NIFTI_CACHE_DIR)
+
+    Returns:
+        nibabel.Nifti1Image: Image backed by the cached copy when available
+    """
+    return nib.load(cached_path(path, cache_dir), mmap=mmap)
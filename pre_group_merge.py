@@ -0,0 +1,636 @@
+#!/usr/bin/env python3
+"""
+Single-pass merging of first-level copes/varcopes for pre-group analysis.
+
+The per-contrast pre-group workflow (wf_data_prepare) re-reads every subject's
+cope and varcope for each contrast. The functions here stream each subject's
+first-level outputs once and fill preallocated per-contrast 4D outputs volume
+by volume, so memory use is bounded by a single 3D volume regardless of how
+many subjects or contrasts are merged.
+
+Subset data sources (placebo, guess) can instead be derived from the standard
+run by selecting their subjects' volumes from the standard merged outputs or
+cope store, without collecting or merging first-level files again.
+
+When subjects are added or excluded, update_merged_contrasts rewrites each
+merged output in the new group_info order, copying the volumes of unchanged
+subjects from the previous merged file and reading first-level files only for
+new or changed subjects. A subject-order manifest (merge_manifest.json in the
+task results directory) records, per contrast, the volume order and the
+first-level inputs each volume came from.
+
+Author: Xiaoqian Xiao (xiao.xiaoqian.320@gmail.com)
+"""
+
+import os
+import json
+import gzip
+import shutil
+import logging
+from datetime import datetime
+import numpy as np
+import nibabel as nib
+from resampling import GRID_ATOL, DEFAULT_ENGINE, resample_to_reference
+from nifti_cache import load_nifti
+
+logger = logging.getLogger(__name__)
+
+# =============================================================================
+# CONSTANTS
+# =============================================================================
+
+FILE_TYPES = ('cope', 'varcope')
+MERGED_DTYPE = np.float32
+COPY_BUFFER_SIZE = 16 * 1024 * 1024  # 16 MB chunks when compressing
+MANIFEST_NAME = 'merge_manifest.json'
+NIFTI_DATA_OFFSET = 352
+
+# Largest total size of the uncompressed outputs preallocated at once; contrasts
+# beyond it are merged in further groups (each group reads every subject again)
+MERGE_GROUP_BYTES = int(os.getenv('MERGE_GROUP_BYTES', 16 * 1024 ** 3))
+
+# =============================================================================
+# PREALLOCATED 4D OUTPUTS
+# =============================================================================
+
+def allocate_merged_nifti(out_file, ref_img, n_volumes):
+    """
+    Preallocate an uncompressed 4D NIfTI on disk and memory-map its data block.
+
+    Args:
+        out_file (str): Path of the uncompressed (.nii) file to create
+        ref_img (nibabel image): Image providing the 3D grid (affine and shape)
+        n_volumes (int): Number of volumes along the 4th dimension
+
+    Returns:
+        numpy.memmap: Writable (x, y, z, n_volumes) array backed by out_file
+    """
+    shape = tuple(ref_img.shape[:3]) + (n_volumes,)
+
+    header = nib.Nifti1Header()
+    header.set_data_shape(shape)
+    header.set_data_dtype(MERGED_DTYPE)
+    header.set_qform(ref_img.affine, code=1)
+    header.set_sform(ref_img.affine, code=1)
+    header.set_xyzt_units(*ref_img.header.get_xyzt_units())
+    header.set_data_offset(NIFTI_DATA_OFFSET)
+
+    with open(out_file, 'wb') as f:
+        header.write_to(f)
+        # Pad to the data offset, then extend the file to its full size
+        f.write(b'\x00' * (NIFTI_DATA_OFFSET - f.tell()))
+        f.truncate(merged_nbytes(ref_img, n_volumes))
+
+    return np.memmap(out_file, dtype=header.get_data_dtype(), mode='r+',
+                     offset=NIFTI_DATA_OFFSET, shape=shape, order='F')
+
+
+def compress_nifti(in_file, out_file):
+    """
+    Gzip an uncompressed NIfTI into out_file with bounded memory.
+
+    The compressed file is written under a temporary name and renamed into
+    place, so readers never see a partially written merged file.
+
+    Args:
+        in_file (str): Uncompressed .nii file
+        out_file (str): Destination .nii.gz file
+
+    Returns:
+        str: Path to the compressed file
+    """
+    tmp_file = out_file + '.partial'
+    with open(in_file, 'rb') as src, gzip.open(tmp_file, 'wb', compresslevel=6) as dst:
+        shutil.copyfileobj(src, dst, COPY_BUFFER_SIZE)
+    os.replace(tmp_file, out_file)
+    return out_file
+
+
+def decompress_nifti(in_file, out_file):
+    """
+    Gunzip a NIfTI into out_file with bounded memory, so it can be memory-mapped.
+
+    Args:
+        in_file (str): Compressed .nii.gz file
+        out_file (str): Destination .nii file
+
+    Returns:
+        str: Path to the uncompressed file
+    """
+    tmp_file = out_file + '.partial'
+    with gzip.open(in_file, 'rb') as src, open(tmp_file, 'wb') as dst:
+        shutil.copyfileobj(src, dst, COPY_BUFFER_SIZE)
+    os.replace(tmp_file, out_file)
+    return out_file
+
+
+def load_on_grid(in_file, ref_img, reference_file, resample_dir, engine=DEFAULT_ENGINE,
+                 cache_dir=None):
+    """
+    Load an image, resampling it to the reference grid only if it does not match.
+
+    Args:
+        in_file (str): Image to load
+        ref_img (nibabel image): Loaded reference image
+        reference_file (str): Path of the reference image
+        resample_dir (str): Scratch directory for resampled images
+        engine (str): Resampling engine, 'native' or 'fsl'
+        cache_dir (str): Weight cache directory for the native engine
+
+    Returns:
+        nibabel image: Image on the reference grid
+    """
+    img = load_nifti(in_file)
+    if tuple(img.shape[:3]) == tuple(ref_img.shape[:3]) and \
+            np.allclose(img.affine, ref_img.affine, atol=GRID_ATOL):
+        return img
+
+    logger.info(f"{os.path.basename(in_file)} is off the reference grid, resampling")
+    resampled_file = resample_to_reference(in_file, reference_file, resample_dir, engine, cache_dir)
+    return load_nifti(resampled_file)
+
+# =============================================================================
+# SINGLE-PASS MERGE
+# =============================================================================
+
+def merged_nbytes(ref_img, n_volumes):
+    """Size in bytes of one uncompressed merged 4D output."""
+    return NIFTI_DATA_OFFSET + int(np.prod(ref_img.shape[:3])) * n_volumes * np.dtype(MERGED_DTYPE).itemsize
+
+
+def plan_contrast_groups(contrasts, contrast_bytes, out_dir, max_group_bytes=MERGE_GROUP_BYTES):
+    """
+    Split contrasts into groups whose preallocated outputs fit the budget and the disk.
+
+    The peak disk use of a group is its uncompressed outputs plus one compressed
+    file being written (at most the size of an uncompressed one).
+
+    Args:
+        contrasts (list): Contrast numbers
+        contrast_bytes (int): Uncompressed bytes of one contrast (cope + varcope)
+        out_dir (str): Directory the outputs are written to
+        max_group_bytes (int): Budget for the outputs of one group
+
+    Returns:
+        list: Lists of contrasts, in order
+
+    Raises:
+        OSError: If there is not enough free space for even one contrast
+    """
+    file_bytes = contrast_bytes // len(FILE_TYPES)
+    free = shutil.disk_usage(out_dir).free
+    fits_disk = (free - file_bytes) // contrast_bytes
+    if fits_disk < 1:
+        raise OSError(f"Not enough free space in {out_dir} to merge one contrast: "
+                      f"{(contrast_bytes + file_bytes) / 1024 ** 3:.1f} GB needed, "
+                      f"{free / 1024 ** 3:.1f} GB free")
+    group_size = int(max(1, min(max_group_bytes // contrast_bytes, fits_disk)))
+    return [contrasts[i:i + group_size] for i in range(0, len(contrasts), group_size)]
+
+
+def merge_all_contrasts(subject_files, subjects, contrasts, task_results_dir, reference_file,
+                        resample_engine=DEFAULT_ENGINE, weight_cache_dir=None,
+                        max_group_bytes=MERGE_GROUP_BYTES):
+    """
+    Merge every contrast's copes and varcopes in a single pass over subjects.
+
+    Each subject's first-level files are read exactly once per group of
+    contrasts. Volumes are written straight into preallocated per-contrast
+    outputs, in subject order, so the merged files line up with the design
+    generated from the same group_info. Inputs that are not on the reference
+    grid are resampled on the fly.
+
+    The uncompressed outputs of a group are preallocated together, so groups
+    are sized to stay within max_group_bytes and the free space of the results
+    filesystem (checked before each group); with the default budget all
+    contrasts of a task usually fit in one group.
+
+    Args:
+        subject_files (dict): {subject: {contrast: {'cope': path, 'varcope': path}}}
+        subjects (list): Subject IDs in design (group_info) order
+        contrasts (list): Contrast numbers to merge
+        task_results_dir (str): Task results directory (contains copeN/ subdirectories)
+        reference_file (str): Image defining the output grid (e.g. GROUP_MASK)
+        resample_engine (str): Engine for off-grid inputs, 'native' or 'fsl'
+        weight_cache_dir (str): Weight cache directory for the native engine
+        max_group_bytes (int): Budget for the uncompressed outputs preallocated at once
+
+    Returns:
+        dict: {contrast: {'cope': merged_cope_path, 'varcope': merged_varcope_path}}
+
+    Raises:
+        OSError: If the results filesystem cannot hold the outputs of one contrast
+    """
+    ref_img = load_nifti(reference_file)
+    n_subjects = len(subjects)
+    resample_dir = os.path.join(task_results_dir, '_resampled')
+    contrast_bytes = len(FILE_TYPES) * merged_nbytes(ref_img, n_subjects)
+
+    merged = {}
+    remaining = list(contrasts)
+    while remaining:
+        # Re-plan before each group: free space may have changed while merging the last one
+        group = plan_contrast_groups(remaining, contrast_bytes, task_results_dir, max_group_bytes)[0]
+        remaining = remaining[len(group):]
+        if len(group) < len(contrasts):
+            logger.info(f"Merging contrasts {group} ({len(group) * contrast_bytes / 1024 ** 3:.1f} GB "
+                        f"uncompressed); {len(remaining)} contrasts left")
+        merged.update(_merge_contrast_group(subject_files, subjects, group, task_results_dir, ref_img,
+                                            reference_file, resample_dir, resample_engine, weight_cache_dir))
+
+    if os.path.isdir(resample_dir):
+        shutil.rmtree(resample_dir)
+
+    logger.info(f"Single-pass merge complete for {len(contrasts)} contrasts")
+    return merged
+
+
+def _merge_contrast_group(subject_files, subjects, contrasts, task_results_dir, ref_img, reference_file,
+                          resample_dir, resample_engine, weight_cache_dir):
+    """Merge one group of contrasts in a single pass over subjects (see merge_all_contrasts)."""
+    n_subjects = len(subjects)
+
+    # Preallocate one uncompressed 4D file per (contrast, file type)
+    writers = {}
+    for contrast in contrasts:
+        contrast_dir = os.path.join(task_results_dir, f'cope{contrast}')
+        os.makedirs(contrast_dir, exist_ok=True)
+        for file_type in FILE_TYPES:
+            raw_file = os.path.join(contrast_dir, f'merged_{file_type}.nii')
+            writers[(contrast, file_type)] = (raw_file, allocate_merged_nifti(raw_file, ref_img, n_subjects))
+    logger.info(f"Preallocated {len(writers)} merged outputs for {n_subjects} subjects")
+
+    # Stream subjects once, writing one volume per contrast and file type
+    for vol_idx, sub in enumerate(subjects):
+        for contrast in contrasts:
+            for file_type in FILE_TYPES:
+                in_file = subject_files[sub][contrast][file_type]
+                img = load_on_grid(in_file, ref_img, reference_file, resample_dir,
+                                   resample_engine, weight_cache_dir)
+                writers[(contrast, file_type)][1][..., vol_idx] = \
+                    np.asanyarray(img.dataobj, dtype=MERGED_DTYPE).reshape(ref_img.shape[:3])
+        logger.info(f"Merged subject {sub} ({vol_idx + 1}/{n_subjects}) into {len(contrasts)} contrasts")
+
+    # Flush and compress into the names downstream group jobs expect
+    merged = {}
+    for key in list(writers):
+        raw_file, data = writers.pop(key)
+        data.flush()
+        del data
+        out_file = compress_nifti(raw_file, raw_file + '.gz')
+        os.remove(raw_file)
+        contrast, file_type = key
+        merged.setdefault(contrast, {})[file_type] = out_file
+    return merged
+
+# =============================================================================
+# SUBSET EXTRACTION
+# =============================================================================
+
+def subset_indices(standard_subjects, subjects):
+    """
+    Return the positions of `subjects` within the standard subject order.
+
+    Args:
+        standard_subjects (list): Subject IDs in standard merged (design) order
+        subjects (list): Subset subject IDs, in the subset's design order
+
+    Returns:
+        list: Volume indices into the standard merged outputs
+
+    Raises:
+        ValueError: If a subset subject is not part of the standard run
+    """
+    lookup = {str(sub): i for i, sub in enumerate(standard_subjects)}
+    missing = [sub for sub in subjects if str(sub) not in lookup]
+    if missing:
+        raise ValueError(f"Subjects {missing} are not in the standard merged outputs; "
+                         f"run the standard pre-group pass for them first")
+    return [lookup[str(sub)] for sub in subjects]
+
+
+def write_volume_subset(in_file, out_file, indices):
+    """
+    Write the selected volumes of a 4D image, in the given order.
+
+    Args:
+        in_file (str): Standard merged 4D image
+        out_file (str): Subset merged image (.nii.gz)
+        indices (list): Volume indices to keep
+
+    Returns:
+        str: Path to the subset image
+    """
+    img = load_nifti(in_file)
+    data = np.asanyarray(img.dataobj, dtype=MERGED_DTYPE)[..., indices]
+    out_img = nib.Nifti1Image(data, img.affine, img.header)
+    out_img.set_data_dtype(MERGED_DTYPE)
+
+    tmp_file = out_file.replace('.nii.gz', '.partial.nii.gz')
+    nib.save(out_img, tmp_file)
+    os.replace(tmp_file, out_file)
+    return out_file
+
+
+def derive_subset_merges(standard_task_dir, subset_task_dir, subjects, contrasts,
+                         standard_subjects=None, store_file=None):
+    """
+    Derive a subset's merged copes/varcopes from the standard run.
+
+    Volumes are read from the standard cope store when one is given and it
+    still matches the standard merged files, otherwise from the standard
+    copeN/merged_{cope,varcope}.nii.gz files. The standard subject order comes
+    from the store or from each contrast's design_info.json.
+
+    Args:
+        standard_task_dir (str): Standard task results directory
+        subset_task_dir (str): Subset task results directory (e.g. .../Placebo/task-phase2)
+        subjects (list): Subset subject IDs in the subset's design order
+        contrasts (list): Contrast numbers to derive
+        standard_subjects (list): Standard subject order, if already known
+        store_file (str): Standard cope store (optional)
+
+    Returns:
+        list: Contrasts that were derived
+    """
+    from design_cache import read_design_info
+
+    derived = []
+    if store_file and os.path.exists(store_file):
+        from cope_store import CopeStore
+        with CopeStore(store_file) as store:
+            current = store.is_current([c for c in contrasts if c in store.contrasts])
+        if not current:
+            logger.warning(f"{store_file} does not match the standard merged files; reading those instead")
+            store_file = None
+
+    if store_file:
+        from cope_store import CopeStore
+        with CopeStore(store_file) as store:
+            subset_indices(store.subjects, subjects)
+            for contrast in contrasts:
+                if contrast not in store.contrasts:
+                    logger.warning(f"Contrast {contrast} not in {store_file}, skipping")
+                    continue
+                contrast_dir = os.path.join(subset_task_dir, f'cope{contrast}')
+                os.makedirs(contrast_dir, exist_ok=True)
+                for file_type in FILE_TYPES:
+                    values = store.get(file_type, contrasts=[contrast], subjects=subjects)[:, 0, :].T
+                    out_file = os.path.join(contrast_dir, f'merged_{file_type}.nii.gz')
+                    tmp_file = out_file.replace('.nii.gz', '.partial.nii.gz')
+                    store.to_nifti(values, tmp_file)
+                    os.replace(tmp_file, out_file)
+                derived.append(contrast)
+        logger.info(f"Derived {len(derived)} subset contrasts from cope store {store_file}")
+        return derived
+
+    for contrast in contrasts:
+        standard_dir = os.path.join(standard_task_dir, f'cope{contrast}')
+        order = standard_subjects
+        if order is None:
+            info = read_design_info(os.path.join(standard_dir, 'design_files'))
+            if info is None:
+                logger.warning(f"No standard design_info.json for cope{contrast}, "
+                               f"cannot determine subject order; skipping")
+                continue
+            order = info['subjects']
+        indices = subset_indices(order, subjects)
+
+        contrast_dir = os.path.join(subset_task_dir, f'cope{contrast}')
+        os.makedirs(contrast_dir, exist_ok=True)
+        for file_type in FILE_TYPES:
+            in_file = os.path.join(standard_dir, f'merged_{file_type}.nii.gz')
+            if not os.path.exists(in_file):
+                raise FileNotFoundError(f"Standard merged file not found: {in_file}")
+            write_volume_subset(in_file, os.path.join(contrast_dir, f'merged_{file_type}.nii.gz'), indices)
+        derived.append(contrast)
+        logger.info(f"Derived cope{contrast} subset ({len(indices)}/{len(order)} subjects)")
+
+    return derived
+
+# =============================================================================
+# INCREMENTAL UPDATE
+# =============================================================================
+
+def file_signature(path):
+    """Path, size and modification time identifying one version of a file."""
+    st = os.stat(path)
+    return [os.path.abspath(path), st.st_size, st.st_mtime_ns]
+
+
+def read_merge_manifest(task_results_dir):
+    """Return the subject-order manifest of a task results directory (empty if missing)."""
+    manifest_file = os.path.join(task_results_dir, MANIFEST_NAME)
+    if not os.path.exists(manifest_file):
+        return {'contrasts': {}}
+    with open(manifest_file) as f:
+        return json.load(f)
+
+
+def write_merge_manifest(task_results_dir, manifest):
+    """Write the subject-order manifest atomically."""
+    manifest['updated'] = datetime.now().isoformat(timespec='seconds')
+    manifest_file = os.path.join(task_results_dir, MANIFEST_NAME)
+    tmp_file = manifest_file + '.partial'
+    with open(tmp_file, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_file, manifest_file)
+    return manifest_file
+
+
+def _manifest_entry(subject_files, subjects, contrast, contrast_dir):
+    """Manifest entry describing a contrast's merged outputs as they are now on disk."""
+    return {
+        'subjects': [str(sub) for sub in subjects],
+        'inputs': {str(sub): {file_type: file_signature(subject_files[sub][contrast][file_type])
+                              for file_type in FILE_TYPES}
+                   for sub in subjects},
+        'merged': {file_type: file_signature(os.path.join(contrast_dir, f'merged_{file_type}.nii.gz'))
+                   for file_type in FILE_TYPES},
+    }
+
+
+def record_merge_manifest(task_results_dir, subject_files, subjects, contrasts):
+    """
+    Record the subject order of freshly merged contrasts (e.g. after merge_all_contrasts).
+
+    Args:
+        task_results_dir (str): Task results directory
+        subject_files (dict): {subject: {contrast: {'cope': path, 'varcope': path}}}
+        subjects (list): Subject IDs in merged (design) order
+        contrasts (list): Contrasts that were merged
+
+    Returns:
+        str: Manifest path
+    """
+    manifest = read_merge_manifest(task_results_dir)
+    for contrast in contrasts:
+        contrast_dir = os.path.join(task_results_dir, f'cope{contrast}')
+        manifest['contrasts'][str(contrast)] = _manifest_entry(subject_files, subjects, contrast, contrast_dir)
+    return write_merge_manifest(task_results_dir, manifest)
+
+
+def _previous_merge(manifest, contrast, contrast_dir, ref_img):
+    """
+    Subject order and input signatures of a contrast's existing merged outputs.
+
+    The manifest entry is only trusted while the merged files are the ones it
+    describes; merged outputs from before the manifest (or rewritten by the
+    per-contrast workflow) fall back to the order in the linked design_info.json,
+    with unknown input signatures (None).
+
+    Returns:
+        tuple: (subject order, {subject: input signatures} or None, modification
+               time of the older merged file in ns) or None if there is no
+               usable previous merge
+    """
+    from design_cache import read_design_info
+
+    merged_files = [os.path.join(contrast_dir, f'merged_{file_type}.nii.gz') for file_type in FILE_TYPES]
+    if not all(os.path.exists(path) for path in merged_files):
+        return None
+
+    entry = manifest['contrasts'].get(str(contrast))
+    if entry and all(entry['merged'].get(file_type) == file_signature(path)
+                     for file_type, path in zip(FILE_TYPES, merged_files)):
+        order, inputs = entry['subjects'], entry['inputs']
+    else:
+        info = read_design_info(os.path.join(contrast_dir, 'design_files'))
+        if info is None:
+            return None
+        order, inputs = [str(sub) for sub in info['subjects']], None
+
+    for path in merged_files:
+        shape = load_nifti(path).shape
+        if len(shape) != 4 or shape[3] != len(order) or tuple(shape[:3]) != tuple(ref_img.shape[:3]):
+            logger.warning(f"{path} has shape {shape}, not {len(order)} volumes on the reference grid; "
+                           f"merging cope{contrast} from scratch")
+            return None
+    return order, inputs, min(os.stat(path).st_mtime_ns for path in merged_files)
+
+
+def _rewrite_merged(merged_file, subjects, reused, subject_paths, ref_img, reference_file,
+                    resample_dir, resample_engine, weight_cache_dir):
+    """
+    Rewrite one merged 4D output in a new subject order.
+
+    Args:
+        merged_file (str): merged_{cope,varcope}.nii.gz to rewrite
+        subjects (list): Subject IDs in the new order
+        reused (dict): {subject: volume index in the current merged_file}
+        subject_paths (dict): {subject: first-level file} for subjects not in reused
+    """
+    raw_file = merged_file[:-len('.gz')]
+    previous_raw = None
+    previous = None
+    if reused:
+        previous_img = load_nifti(merged_file)
+        if previous_img.get_filename() == merged_file:
+            # Not cached (cache off or over its cap): decompress once instead of once per volume
+            previous_raw = os.path.join(os.path.dirname(merged_file),
+                                        'previous_' + os.path.basename(raw_file))
+            previous_img = nib.load(decompress_nifti(merged_file, previous_raw), mmap=True)
+        previous = previous_img.dataobj
+
+    data = allocate_merged_nifti(raw_file, ref_img, len(subjects))
+    for vol_idx, sub in enumerate(subjects):
+        if sub in reused:
+            volume = previous[..., reused[sub]]
+        else:
+            img = load_on_grid(subject_paths[sub], ref_img, reference_file, resample_dir,
+                               resample_engine, weight_cache_dir)
+            volume = img.dataobj
+        data[..., vol_idx] = np.asanyarray(volume, dtype=MERGED_DTYPE).reshape(ref_img.shape[:3])
+    data.flush()
+    del data, previous
+
+    compress_nifti(raw_file, merged_file)
+    os.remove(raw_file)
+    if previous_raw:
+        os.remove(previous_raw)
+    return merged_file
+
+
+def update_merged_contrasts(subject_files, subjects, contrasts, task_results_dir, reference_file,
+                            resample_engine=DEFAULT_ENGINE, weight_cache_dir=None):
+    """
+    Bring each contrast's merged outputs up to date with the current subject list.
+
+    Volumes of subjects that are already merged and whose first-level files
+    are unchanged are copied from the previous merged output; added subjects
+    (and subjects whose cope/varcope changed) are read from their first-level
+    files; excluded subjects are dropped. Volumes are written in `subjects`
+    (group_info) order, so the result lines up with the design compiled from
+    the same group_info. Contrasts that are already up to date are left alone,
+    and the manifest is updated after every contrast.
+
+    Args:
+        subject_files (dict): {subject: {contrast: {'cope': path, 'varcope': path}}}
+        subjects (list): Subject IDs in design (group_info) order
+        contrasts (list): Contrast numbers to update
+        task_results_dir (str): Task results directory (contains copeN/ subdirectories)
+        reference_file (str): Image defining the output grid (e.g. GROUP_MASK)
+        resample_engine (str): Engine for off-grid inputs, 'native' or 'fsl'
+        weight_cache_dir (str): Weight cache directory for the native engine
+
+    Returns:
+        dict: {contrast: {'cope': merged_cope_path, 'varcope': merged_varcope_path}}
+    """
+    ref_img = load_nifti(reference_file)
+    resample_dir = os.path.join(task_results_dir, '_resampled')
+    manifest = read_merge_manifest(task_results_dir)
+    subjects = [str(sub) for sub in subjects]
+    subject_files = {str(sub): files for sub, files in subject_files.items()}
+
+    merged = {}
+    for contrast in contrasts:
+        contrast_dir = os.path.join(task_results_dir, f'cope{contrast}')
+        os.makedirs(contrast_dir, exist_ok=True)
+        merged[contrast] = {file_type: os.path.join(contrast_dir, f'merged_{file_type}.nii.gz')
+                            for file_type in FILE_TYPES}
+
+        previous = _previous_merge(manifest, contrast, contrast_dir, ref_img)
+        reused = {}
+        if previous:
+            order, inputs, merged_mtime = previous
+            lookup = {sub: i for i, sub in enumerate(order)}
+            for sub in subjects:
+                if sub not in lookup:
+                    continue
+                current = {file_type: file_signature(subject_files[sub][contrast][file_type])
+                           for file_type in FILE_TYPES}
+                if inputs is not None:
+                    unchanged = inputs.get(sub) == current
+                else:
+                    # Unknown inputs: only trust volumes whose files predate the merged output
+                    unchanged = all(signature[2] <= merged_mtime for signature in current.values())
+                if unchanged:
+                    reused[sub] = lookup[sub]
+            if order == subjects and len(reused) == len(subjects):
+                logger.info(f"cope{contrast} is up to date ({len(subjects)} subjects)")
+                # Every subject was checked above, so its current signatures can be recorded
+                if str(contrast) not in manifest['contrasts'] or inputs is None:
+                    manifest['contrasts'][str(contrast)] = _manifest_entry(
+                        subject_files, subjects, contrast, contrast_dir)
+                    write_merge_manifest(task_results_dir, manifest)
+                continue
+            dropped = [sub for sub in order if sub not in set(subjects)]
+        else:
+            dropped = []
+
+        fresh = [sub for sub in subjects if sub not in reused]
+        for file_type in FILE_TYPES:
+            _rewrite_merged(merged[contrast][file_type], subjects, reused,
+                            {sub: subject_files[sub][contrast][file_type] for sub in fresh},
+                            ref_img, reference_file, resample_dir, resample_engine, weight_cache_dir)
+
+        manifest['contrasts'][str(contrast)] = _manifest_entry(subject_files, subjects, contrast, contrast_dir)
+        write_merge_manifest(task_results_dir, manifest)
+        logger.info(f"Updated cope{contrast}: {len(reused)} volumes kept, {len(fresh)} read from "
+                    f"first-level outputs, {len(dropped)} dropped")
+
+    if os.path.isdir(resample_dir):
+        shutil.rmtree(resample_dir)
+
+    logger.info(f"Incremental merge complete for {len(contrasts)} contrasts")
+    return merged
@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+"""
+Grid-aware resampling helpers for pre-group analysis.
+
+First-level copes are normally already in MNI152NLin2009cAsym at 2mm, the same
+grid as the group mask, so resampling them again is wasted work. These helpers
+compare each input's affine and shape to the reference grid and resample only
+the subjects that do not match, one subject at a time and in parallel.
+
+Two engines are available. 'fsl' (the default) runs FLIRT per image.
+'native' precomputes sparse trilinear interpolation weights once per (source
+grid, reference grid), caches them on disk, and applies them to every volume
+of every cope and varcope as a single sparse matrix product.
+
+Author: Xiaoqian Xiao (xiao.xiaoqian.320@gmail.com)
+"""
+
+import os
+import hashlib
+import logging
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import nibabel as nib
+from scipy import sparse
+
+from nifti_cache import load_nifti
+
+logger = logging.getLogger(__name__)
+
+# =============================================================================
+# CONSTANTS
+# =============================================================================
+
+# Affine tolerance (mm) when deciding whether two grids are identical
+GRID_ATOL = 1e-3
+
+RESAMPLE_ENGINES = ('native', 'fsl')
+DEFAULT_ENGINE = 'fsl'
+
+# On-disk cache of interpolation weights, keyed by (source grid, reference grid)
+WEIGHT_CACHE_DIR = os.getenv('RESAMPLE_WEIGHT_CACHE',
+                             os.path.join(tempfile.gettempdir(), 'resample_weights'))
+
+# In-process copy of the weights so copes and varcopes share one load
+_weight_cache = {}
+_weight_lock = threading.Lock()
+
+# =============================================================================
+# GRID COMPARISON
+# =============================================================================
+
+def get_grid(in_file):
+    """Return (shape[:3], affine) of a NIfTI file without loading its data."""
+    img = nib.load(in_file)
+    return tuple(img.shape[:3]), img.affine
+
+
+def grid_matches(in_file, reference_file, atol=GRID_ATOL):
+    """
+    Check whether an image is on the same 3D grid as the reference.
+
+    Args:
+        in_file (str): Image to check
+        reference_file (str): Reference image (e.g. GROUP_MASK)
+        atol (float): Absolute tolerance on affine entries (mm)
+
+    Returns:
+        bool: True if shape and affine match within tolerance
+    """
+    in_shape, in_affine = get_grid(in_file)
+    ref_shape, ref_affine = get_grid(reference_file)
+    return in_shape == ref_shape and np.allclose(in_affine, ref_affine, atol=atol)
+
+# =============================================================================
+# NATIVE TRILINEAR WEIGHTS
+# =============================================================================
+
+def grid_pair_key(src_shape, src_affine, ref_shape, ref_affine):
+    """Return a stable hash identifying a (source grid, reference grid) pair."""
+    h = hashlib.sha1()
+    for shape, affine in ((src_shape, src_affine), (ref_shape, ref_affine)):
+        h.update(np.asarray(shape, dtype=np.int64).tobytes())
+        h.update(np.round(np.asarray(affine, dtype=np.float64), 6).tobytes())
+    return h.hexdigest()
+
+
+def compute_trilinear_weights(src_shape, src_affine, ref_shape, ref_affine):
+    """
+    Build the sparse trilinear interpolation matrix from a source to a reference grid.
+
+    Reference voxel centres are mapped into source voxel coordinates through the
+    two affines. Each reference voxel gets weights for its eight neighbouring
+    source voxels; neighbours outside the source field of view are dropped, so
+    samples outside the source image are zero (as with FLIRT).
+
+    Args:
+        src_shape (tuple): Source 3D shape
+        src_affine (numpy.ndarray): Source voxel-to-world affine
+        ref_shape (tuple): Reference 3D shape
+        ref_affine (numpy.ndarray): Reference voxel-to-world affine
+
+    Returns:
+        scipy.sparse.csr_matrix: (n_ref_voxels, n_src_voxels) weights, both
+        flattened in Fortran (NIfTI) order
+    """
+    src_shape = tuple(int(n) for n in src_shape)
+    ref_shape = tuple(int(n) for n in ref_shape)
+    n_ref = int(np.prod(ref_shape))
+
+    # Reference voxel indices -> source voxel coordinates
+    ref_ijk = np.indices(ref_shape, dtype=np.float64).reshape(3, -1, order='F')
+    vox2vox = np.linalg.inv(src_affine) @ ref_affine
+    src_xyz = vox2vox[:3, :3] @ ref_ijk + vox2vox[:3, 3:4]
+
+    base = np.floor(src_xyz).astype(np.int64)
+    frac = src_xyz - base
+    rows_all = np.arange(n_ref, dtype=np.int64)
+
+    rows, cols, vals = [], [], []
+    for dx in (0, 1):
+        for dy in (0, 1):
+            for dz in (0, 1):
+                offset = np.array([[dx], [dy], [dz]])
+                idx = base + offset
+                weight = np.prod(np.where(offset == 1, frac, 1.0 - frac), axis=0)
+                valid = (weight > 0) & np.all((idx >= 0) & (idx < np.array(src_shape)[:, None]), axis=0)
+                rows.append(rows_all[valid])
+                cols.append(np.ravel_multi_index(idx[:, valid], src_shape, order='F'))
+                vals.append(weight[valid].astype(np.float32))
+
+    weights = sparse.coo_matrix(
+        (np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))),
+        shape=(n_ref, int(np.prod(src_shape)))
+    )
+    return weights.tocsr()
+
+
+def get_trilinear_weights(src_shape, src_affine, ref_shape, ref_affine, cache_dir=None):
+    """
+    Return cached interpolation weights, computing and storing them on first use.
+
+    Weights are looked up in memory, then on disk under cache_dir, and only
+    computed if neither has them. The on-disk file is written under a temporary
+    name and renamed into place so concurrent jobs never read a partial file.
+
+    Args:
+        src_shape (tuple): Source 3D shape
+        src_affine (numpy.ndarray): Source voxel-to-world affine
+        ref_shape (tuple): Reference 3D shape
+        ref_affine (numpy.ndarray): Reference voxel-to-world affine
+        cache_dir (str): Weight cache directory (default: WEIGHT_CACHE_DIR)
+
+    Returns:
+        scipy.sparse.csr_matrix: Interpolation weights
+    """
+    cache_dir = cache_dir or WEIGHT_CACHE_DIR
+    key = grid_pair_key(src_shape, src_affine, ref_shape, ref_affine)
+
+    with _weight_lock:
+        if key in _weight_cache:
+            return _weight_cache[key]
+
+        cache_file = os.path.join(cache_dir, f'trilinear_{key}.npz')
+        if os.path.exists(cache_file):
+            logger.info(f"Loading cached resampling weights: {cache_file}")
+            weights = sparse.load_npz(cache_file).tocsr()
+        else:
+            logger.info(f"Computing resampling weights for grid pair {key[:12]}")
+            weights = compute_trilinear_weights(src_shape, src_affine, ref_shape, ref_affine)
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                tmp_file = os.path.join(cache_dir, f'trilinear_{key}.{os.getpid()}.partial.npz')
+                sparse.save_npz(tmp_file, weights)
+                os.replace(tmp_file, cache_file)
+            except OSError as e:
+                logger.warning(f"Could not cache resampling weights in {cache_dir}: {e}")
+
+        _weight_cache[key] = weights
+        return weights
+
+# =============================================================================
+# RESAMPLING
+# =============================================================================
+
+def resample_native(in_file, reference_file, out_dir, cache_dir=None):
+    """
+    Resample a 3D or 4D image onto the reference grid with cached trilinear weights.
+
+    All volumes are resampled together as one sparse matrix product.
+
+    Args:
+        in_file (str): Image to resample
+        reference_file (str): Reference image defining the output grid
+        out_dir (str): Directory for the resampled image
+        cache_dir (str): Weight cache directory (default: WEIGHT_CACHE_DIR)
+
+    Returns:
+        str: Path to the resampled image
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    base = os.path.basename(in_file).replace('.nii.gz', '').replace('.nii', '')
+    out_file = os.path.join(out_dir, f'{base}_resampled.nii.gz')
+
+    img = load_nifti(in_file)
+    ref_img = load_nifti(reference_file)
+    src_shape, ref_shape = tuple(img.shape[:3]), tuple(ref_img.shape[:3])
+    extra_dims = tuple(img.shape[3:])
+
+    weights = get_trilinear_weights(src_shape, img.affine, ref_shape, ref_img.affine, cache_dir)
+
+    data = np.asanyarray(img.dataobj, dtype=np.float32).reshape(
+        (int(np.prod(src_shape)), -1), order='F')
+    resampled = np.asarray(weights @ data, dtype=np.float32).reshape(ref_shape + extra_dims, order='F')
+
+    out_img = nib.Nifti1Image(resampled, ref_img.affine)
+    out_img.header.set_xyzt_units(*img.header.get_xyzt_units())
+    nib.save(out_img, out_file)
+    return out_file
+
+
+def resample_fsl(in_file, reference_file, out_dir):
+    """
+    Resample one image onto the reference grid with FLIRT.
+
+    The images are already in the same space, so the header (qform) transform
+    is applied directly instead of running a registration.
+
+    Args:
+        in_file (str): Image to resample
+        reference_file (str): Reference image defining the output grid
+        out_dir (str): Directory for the resampled image
+
+    Returns:
+        str: Path to the resampled image
+    """
+    from nipype.interfaces.fsl import FLIRT
+
+    os.makedirs(out_dir, exist_ok=True)
+    base = os.path.basename(in_file).replace('.nii.gz', '').replace('.nii', '')
+    out_file = os.path.join(out_dir, f'{base}_resampled.nii.gz')
+
+    flirt = FLIRT(in_file=in_file, reference=reference_file, out_file=out_file,
+                  apply_xfm=True, uses_qform=True, output_type='NIFTI_GZ')
+    flirt.run()
+    return out_file
+
+
+def resample_to_reference(in_file, reference_file, out_dir, engine=DEFAULT_ENGINE, cache_dir=None):
+    """
+    Resample one image onto the reference grid with the selected engine.
+
+    Args:
+        in_file (str): Image to resample
+        reference_file (str): Reference image defining the output grid
+        out_dir (str): Directory for the resampled image
+        engine (str): 'native' (cached trilinear weights) or 'fsl' (FLIRT)
+        cache_dir (str): Weight cache directory for the native engine
+
+    Returns:
+        str: Path to the resampled image
+    """
+    if engine == 'native':
+        return resample_native(in_file, reference_file, out_dir, cache_dir)
+    if engine == 'fsl':
+        return resample_fsl(in_file, reference_file, out_dir)
+    raise ValueError(f"Unknown resampling engine '{engine}', expected one of {RESAMPLE_ENGINES}")
+
+
+def resample_mismatched(in_files, reference_file, out_dir, n_procs=4,
+                        engine=DEFAULT_ENGINE, cache_dir=None):
+    """
+    Resample only the inputs whose grid differs from the reference.
+
+    Matching inputs are passed through untouched. Mismatched inputs are
+    resampled individually and in parallel, and the returned list keeps the
+    original (subject) order.
+
+    Args:
+        in_files (list): Input images, one per subject
+        reference_file (str): Reference image defining the output grid
+        out_dir (str): Directory for resampled images
+        n_procs (int): Number of parallel resampling jobs
+        engine (str): 'native' or 'fsl'
+        cache_dir (str): Weight cache directory for the native engine
+
+    Returns:
+        list: Images on the reference grid, in input order
+    """
+    mismatched = [i for i, f in enumerate(in_files) if not grid_matches(f, reference_file)]
+    if not mismatched:
+        logger.info(f"All {len(in_files)} inputs match the reference grid, skipping resampling")
+        return list(in_files)
+
+    logger.info(f"Resampling {len(mismatched)}/{len(in_files)} inputs to the reference grid")
+    out_files = list(in_files)
+    with ThreadPoolExecutor(max_workers=max(1, n_procs)) as pool:
+        resampled = pool.map(
+            lambda i: resample_to_reference(in_files[i], reference_file, out_dir, engine, cache_dir),
+            mismatched)
+        for i, out_file in zip(mismatched, resampled):
+            out_files[i] = out_file
+    return out_files
+
+
+def resample_inputs_to_grid(in_copes, in_varcopes, reference, n_procs=4,
+                            engine='fsl', cache_dir=None):
+    """
+    Nipype Function-node wrapper: bring copes and varcopes onto the group grid.
+
+    Args:
+        in_copes (list): Cope files, one per subject
+        in_varcopes (list): Varcope files, one per subject
+        reference (str): Group mask defining the output grid
+        n_procs (int): Number of parallel resampling jobs
+        engine (str): 'native' or 'fsl'
+        cache_dir (str): Weight cache directory for the native engine
+
+    Returns:
+        tuple: (copes on the reference grid, varcopes on the reference grid)
+    """
+    import os
+    from resampling import resample_mismatched
+
+    out_dir = os.path.abspath('resampled')
+    # Copes and varcopes share grids, so the native engine reuses one set of weights
+    out_copes = resample_mismatched(in_copes, reference, out_dir, n_procs, engine, cache_dir)
+    out_varcopes = resample_mismatched(in_varcopes, reference, out_dir, n_procs, engine, cache_dir)
+    return out_copes, out_varcopes
@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+"""
+Promotion of workflow outputs into the final results directories.
+
+Group-level outputs used to be copied out of the Nipype working directory with
+shutil.copy2/copytree, which duplicates multi-GB 4D files on the same scratch
+filesystem. The functions here promote files by atomic rename or hardlink and
+only fall back to a real copy when source and destination are on different
+devices. Every promotion is recorded in a JSON manifest with a checksum so the
+results directory can be verified later.
+
+Group workflows also record what their DataSink wrote in a sink manifest
+(<workflow>_sink_manifest.json in the sink's base directory), so promotion
+can take the produced files from it instead of searching the working
+directory.
+
+Author: Xiaoqian Xiao (xiao.xiaoqian.320@gmail.com)
+"""
+
+import os
+import json
+import errno
+import shutil
+import hashlib
+import logging
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# =============================================================================
+# CONSTANTS
+# =============================================================================
+
+MANIFEST_NAME = 'promotion_manifest.json'
+SINK_MANIFEST_SUFFIX = '_sink_manifest.json'
+PROMOTION_MODES = ('link', 'move', 'copy')
+CHECKSUM_BLOCK_SIZE = 16 * 1024 * 1024  # 16 MB reads when hashing
+
+# Errors meaning "cannot rename/link here", so a copy is needed instead
+_FALLBACK_ERRNOS = {errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP}
+
+# =============================================================================
+# CHECKSUMS
+# =============================================================================
+
+def sha256_file(path):
+    """Return the SHA-256 hex digest of a file, read in fixed-size blocks."""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(CHECKSUM_BLOCK_SIZE), b''):
+            h.update(block)
+    return h.hexdigest()
+
+# =============================================================================
+# FILE AND TREE PROMOTION
+# =============================================================================
+
+def _copy_atomic(src, dst):
+    """Copy src to dst under a temporary name, then rename into place."""
+    tmp = dst + '.partial'
+    shutil.copy2(src, tmp)
+    os.replace(tmp, dst)
+
+
+def promote_file(src, dst, mode='link', checksum=True):
+    """
+    Promote one file to its final location without duplicating data when possible.
+
+    Args:
+        src (str): Source file (typically inside the Nipype working directory)
+        dst (str): Destination path in the results directory
+        mode (str): 'link' (hardlink, source kept), 'move' (atomic rename) or 'copy'
+        checksum (bool): Whether to record a SHA-256 checksum
+
+    Returns:
+        dict: Manifest record with destination, source, method, size and checksum
+    """
+    if mode not in PROMOTION_MODES:
+        raise ValueError(f"Unknown promotion mode '{mode}', expected one of {PROMOTION_MODES}")
+    if not os.path.isfile(src):
+        raise FileNotFoundError(f"Cannot promote missing file: {src}")
+
+    os.makedirs(os.path.dirname(os.path.abspath(dst)), exist_ok=True)
+    method = mode
+
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        method = 'existing'
+    elif mode == 'move':
+        try:
+            os.replace(src, dst)
+        except OSError as e:
+            if e.errno not in _FALLBACK_ERRNOS:
+                raise
+            _copy_atomic(src, dst)
+            os.remove(src)
+            method = 'copy'
+    elif mode == 'link':
+        tmp = dst + '.partial'
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        try:
+            os.link(src, tmp)
+            os.replace(tmp, dst)
+        except OSError as e:
+            if e.errno not in _FALLBACK_ERRNOS:
+                raise
+            _copy_atomic(src, dst)
+            method = 'copy'
+    else:
+        _copy_atomic(src, dst)
+
+    logger.debug(f"Promoted ({method}) {src} -> {dst}")
+    return {
+        'path': os.path.abspath(dst),
+        'source': os.path.abspath(src),
+        'method': method,
+        'size': os.path.getsize(dst),
+        'sha256': sha256_file(dst) if checksum else None,
+    }
+
+
+def promote_tree(src_dir, dst_dir, mode='link', checksum=True):
+    """
+    Promote a directory tree, replacing any previous copy of the destination.
+
+    The tree is assembled next to the destination and swapped into place, so a
+    failed promotion leaves the previous results untouched.
+
+    Args:
+        src_dir (str): Source directory
+        dst_dir (str): Destination directory
+        mode (str): 'link', 'move' or 'copy' (see promote_file)
+        checksum (bool): Whether to record SHA-256 checksums
+
+    Returns:
+        list: Manifest records for every promoted file
+    """
+    if not os.path.isdir(src_dir):
+        raise FileNotFoundError(f"Cannot promote missing directory: {src_dir}")
+
+    staging_dir = dst_dir.rstrip(os.sep) + '.partial'
+    if os.path.exists(staging_dir):
+        shutil.rmtree(staging_dir)
+
+    records = []
+    for root, _, files in os.walk(src_dir):
+        rel_root = os.path.relpath(root, src_dir)
+        for filename in sorted(files):
+            src = os.path.join(root, filename)
+            staged = os.path.normpath(os.path.join(staging_dir, rel_root, filename))
+            record = promote_file(src, staged, mode=mode, checksum=checksum)
+            record['path'] = os.path.abspath(os.path.join(dst_dir, os.path.relpath(staged, staging_dir)))
+            records.append(record)
+    os.makedirs(staging_dir, exist_ok=True)
+
+    if os.path.exists(dst_dir):
+        shutil.rmtree(dst_dir)
+    os.replace(staging_dir, dst_dir)
+
+    logger.info(f"Promoted {len(records)} files from {src_dir} to {dst_dir}")
+    return records
+
+# =============================================================================
+# MANIFEST
+# =============================================================================
+
+def write_manifest(result_dir, records):
+    """
+    Merge promotion records into the manifest of a results directory.
+
+    Records are keyed by their path relative to result_dir, so re-promoting a
+    file replaces its previous entry.
+
+    Args:
+        result_dir (str): Results directory holding the manifest
+        records (list): Records returned by promote_file/promote_tree
+
+    Returns:
+        str: Path to the manifest file
+    """
+    manifest_file = os.path.join(result_dir, MANIFEST_NAME)
+    manifest = read_manifest(result_dir)
+
+    for record in records:
+        rel_path = os.path.relpath(record['path'], result_dir)
+        entry = dict(record, path=rel_path, promoted_at=datetime.now().isoformat(timespec='seconds'))
+        manifest['files'][rel_path] = entry
+
+    tmp_file = manifest_file + '.partial'
+    with open(tmp_file, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_file, manifest_file)
+    return manifest_file
+
+
+def read_manifest(result_dir):
+    """Return the manifest of a results directory, or an empty one if missing."""
+    manifest_file = os.path.join(result_dir, MANIFEST_NAME)
+    if not os.path.exists(manifest_file):
+        return {'files': {}}
+    with open(manifest_file) as f:
+        return json.load(f)
+
+
+def verify_manifest(result_dir):
+    """
+    Check every file listed in a results manifest against its recorded checksum.
+
+    Args:
+        result_dir (str): Results directory holding the manifest
+
+    Returns:
+        list: Relative paths that are missing or whose checksum differs
+    """
+    bad = []
+    for rel_path, entry in read_manifest(result_dir)['files'].items():
+        path = os.path.join(result_dir, rel_path)
+        if not os.path.exists(path):
+            bad.append(rel_path)
+        elif entry.get('sha256') and sha256_file(path) != entry['sha256']:
+            bad.append(rel_path)
+    return bad
+
+# =============================================================================
+# SINK MANIFEST
+# =============================================================================
+
+def sink_manifest_path(base_directory, workflow_name):
+    """Path of the sink manifest of a workflow."""
+    return os.path.join(base_directory, f'{workflow_name}{SINK_MANIFEST_SUFFIX}')
+
+
+def write_sink_manifest(out_files, base_directory, workflow_name):
+    """
+    Record every file a DataSink wrote (Nipype Function node).
+
+    Args:
+        out_files (list): DataSink out_file output
+        base_directory (str): DataSink base directory
+        workflow_name (str): Workflow name (names the manifest)
+
+    Returns:
+        str: Path to the sink manifest
+    """
+    import os
+    import json
+    from datetime import datetime
+    from result_promotion import sink_manifest_path
+
+    if isinstance(out_files, str):
+        out_files = [out_files]
+    paths = []
+    for out_file in out_files or []:
+        if os.path.isdir(out_file):
+            paths += [os.path.join(root, f) for root, _, files in os.walk(out_file) for f in files]
+        elif os.path.isfile(out_file):
+            paths.append(out_file)
+
+    base_directory = os.path.abspath(base_directory)
+    manifest = {
+        'workflow': workflow_name,
+        'base_directory': base_directory,
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'files': {os.path.relpath(os.path.abspath(p), base_directory): {'size': os.path.getsize(p)}
+                  for p in sorted(paths)},
+    }
+    manifest_file = sink_manifest_path(base_directory, workflow_name)
+    tmp_file = manifest_file + '.partial'
+    with open(tmp_file, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_file, manifest_file)
+    return manifest_file
+
+
+def read_sink_manifest(base_directory, workflow_name):
+    """Return the sink manifest of a workflow, or None if it was not written."""
+    manifest_file = sink_manifest_path(base_directory, workflow_name)
+    if not os.path.exists(manifest_file):
+        return None
+    with open(manifest_file) as f:
+        return json.load(f)
+
+
+def promote_sink_outputs(manifest, result_dir, subdirs, mode='link', checksum=True):
+    """
+    Promote the files of a sink manifest into a results directory.
+
+    Files keep their path relative to the sink's base directory; only files
+    under one of subdirs (e.g. 'stats', 'cluster_results') are promoted.
+
+    Args:
+        manifest (dict): Sink manifest (read_sink_manifest)
+        result_dir (str): Results directory
+        subdirs (tuple): Top-level sink folders to promote
+        mode (str): 'link', 'move' or 'copy' (see promote_file)
+        checksum (bool): Whether to record SHA-256 checksums
+
+    Returns:
+        list: Manifest records for every promoted file
+    """
+    records = []
+    for rel_path, entry in sorted(manifest['files'].items()):
+        if rel_path.split(os.sep)[0] not in subdirs:
+            continue
+        src = os.path.join(manifest['base_directory'], rel_path)
+        if not os.path.isfile(src) or os.path.getsize(src) != entry['size']:
+            raise FileNotFoundError(f"Sink output missing or changed since the workflow ran: {src}")
+        records.append(promote_file(src, os.path.join(result_dir, rel_path), mode=mode, checksum=checksum))
+    logger.info(f"Promoted {len(records)} sink outputs of {manifest['workflow']} to {result_dir}")
+    return records
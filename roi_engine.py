@@ -0,0 +1,462 @@
+#!/usr/bin/env python3
+"""
+One-pass multi-ROI extraction for group-level ROI analyses.
+
+wf_roi_extract used to run one fslstats process per ROI mask (and a second
+one for the baseline file), each re-reading the full 4D cope, and then
+re-parse the per-ROI text files. Here the ROI masks in roi_dir are compiled
+once into a sparse (ROIs x voxels) weight matrix whose rows average over each
+mask (as fslstats -k <mask> -m does). Each 4D image is then read once, a few
+volumes at a time, and every ROI mean for every subject comes out of a single
+sparse matrix product:
+
+    means (n_rois x n_volumes) = W (n_rois x n_voxels) @ Y (n_voxels x n_volumes)
+
+beta_all_rois.csv and psc_all_rois.csv are written directly, in the layout
+combine_roi_values produced (one row per subject, one column per ROI).
+
+When the task's cope store (cope_store.py) is given and still matches the
+merged files, the ROI means are computed from its in-mask voxels instead of
+decompressing the merged 4D images.
+
+Voxelwise PSC images for all ROIs (run_roi_psc) are computed in the same
+single pass: cope and baseline volumes are streamed in float32 and only the
+voxels of the union of ROIs are kept, so the working memory per ROI scales
+with the ROI size and not with the field of view.
+
+The ROI masks are compiled once per (roi_dir, reference grid) into an index of
+flat voxel positions, voxel counts and names, stored in a single .npz under
+ROI_INDEX_CACHE_DIR. The cache is reused while every mask keeps its size and
+modification time; if only the times changed, the masks are re-hashed and the
+cache is kept when the contents are unchanged.
+
+Author: Xiaoqian Xiao (xiao.xiaoqian.320@gmail.com)
+"""
+
+import os
+import glob
+import hashlib
+import logging
+import tempfile
+import numpy as np
+import nibabel as nib
+import pandas as pd
+from scipy import sparse
+
+from nifti_cache import load_nifti
+
+logger = logging.getLogger(__name__)
+
+# =============================================================================
+# CONSTANTS
+# =============================================================================
+
+VOLUME_CHUNK = 16    # 4D volumes read per chunk
+GRID_ATOL = 1e-3     # affine tolerance when matching ROI and data grids
+PSC_EPSILON = 1e-6   # added to |baseline| in the PSC denominator
+PSC_LAYOUTS = ('multi', 'per_roi')
+
+ROI_INDEX_CACHE_DIR = os.getenv('ROI_INDEX_CACHE',
+                                os.path.join(tempfile.gettempdir(), 'roi_index'))
+
+# =============================================================================
+# ROI MATRIX
+# =============================================================================
+
+def roi_name(roi_file):
+    """ROI name as used for CSV columns (file name without .nii/.nii.gz)."""
+    name = os.path.basename(roi_file)
+    for ext in ('.nii.gz', '.nii'):
+        if name.endswith(ext):
+            return name[:-len(ext)]
+    return name
+
+
+def list_roi_files(roi_dir):
+    """Sorted ROI mask files in a directory."""
+    roi_files = sorted(glob.glob(os.path.join(roi_dir, '*.nii.gz')))
+    if not roi_files:
+        raise ValueError(f"No ROI files found in {roi_dir}")
+    return roi_files
+
+
+def _file_stats(roi_files):
+    """(size, mtime_ns) of every ROI file."""
+    stats = [os.stat(f) for f in roi_files]
+    return np.asarray([st.st_size for st in stats], dtype=np.int64), \
+        np.asarray([st.st_mtime_ns for st in stats], dtype=np.int64)
+
+
+def roi_index_key(roi_dir, shape, affine):
+    """Stable hash identifying an (ROI directory, reference grid) pair."""
+    h = hashlib.sha1(os.path.abspath(roi_dir).encode())
+    h.update(np.asarray(shape[:3], dtype=np.int64).tobytes())
+    h.update(np.round(np.asarray(affine, dtype=np.float64), 6).tobytes())
+    return h.hexdigest()
+
+
+def compile_roi_index(roi_files, shape, affine):
+    """
+    Binarize ROI masks once into compact flat voxel index arrays.
+
+    Args:
+        roi_files (list): ROI mask images (voxels > 0 belong to the ROI)
+        shape (tuple): 3D grid shape of the data
+        affine (numpy.ndarray): Grid affine of the data
+
+    Returns:
+        dict: names, files, offsets/voxels (concatenated Fortran-order indices),
+              counts, sizes, mtimes, hashes, shape and affine
+    """
+    from result_promotion import sha256_file
+
+    voxel_lists = []
+    for roi_file in roi_files:
+        img = load_nifti(roi_file)
+        if tuple(img.shape[:3]) != tuple(shape[:3]) or not np.allclose(img.affine, affine, atol=GRID_ATOL):
+            raise ValueError(f"ROI {roi_file} grid {img.shape[:3]} does not match the data grid {tuple(shape[:3])}")
+        voxels = np.flatnonzero(np.asanyarray(img.dataobj).reshape(-1, order='F') > 0)
+        if voxels.size == 0:
+            logger.warning(f"ROI {roi_file} is empty; its values will be NaN")
+        voxel_lists.append(voxels)
+
+    counts = np.asarray([v.size for v in voxel_lists], dtype=np.int64)
+    sizes, mtimes = _file_stats(roi_files)
+    logger.info(f"Compiled ROI index: {len(roi_files)} ROIs, {int(counts.sum())} voxels")
+    return {
+        'names': np.asarray([roi_name(f) for f in roi_files]),
+        'files': np.asarray([os.path.abspath(f) for f in roi_files]),
+        'offsets': np.concatenate([[0], np.cumsum(counts)]),
+        'voxels': np.concatenate(voxel_lists) if voxel_lists else np.zeros(0, dtype=np.int64),
+        'counts': counts,
+        'sizes': sizes,
+        'mtimes': mtimes,
+        'hashes': np.asarray([sha256_file(f) for f in roi_files]),
+        'shape': np.asarray(shape[:3], dtype=np.int64),
+        'affine': np.asarray(affine, dtype=np.float64),
+    }
+
+
+def _save_index(index, cache_file):
+    """Write an index under a temporary name and rename it into place."""
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    tmp_file = f'{cache_file}.{os.getpid()}.partial.npz'
+    np.savez(tmp_file, **index)
+    os.replace(tmp_file, cache_file)
+
+
+def get_roi_index(roi_dir, shape, affine, cache_dir=None):
+    """
+    Return the ROI index of roi_dir on a grid, from the cache when still valid.
+
+    Args:
+        roi_dir (str): Directory containing ROI mask files
+        shape (tuple): 3D grid shape of the data
+        affine (numpy.ndarray): Grid affine of the data
+        cache_dir (str): Index cache directory (default: ROI_INDEX_CACHE_DIR)
+
+    Returns:
+        dict: Index as returned by compile_roi_index
+    """
+    from result_promotion import sha256_file
+
+    roi_files = [os.path.abspath(f) for f in list_roi_files(roi_dir)]
+    cache_file = os.path.join(cache_dir or ROI_INDEX_CACHE_DIR,
+                              f'roi_index_{roi_index_key(roi_dir, shape, affine)}.npz')
+
+    if os.path.exists(cache_file):
+        with np.load(cache_file) as cached:
+            index = {key: cached[key] for key in cached.files}
+        sizes, mtimes = _file_stats(roi_files)
+        if list(index['files']) == roi_files and np.array_equal(index['sizes'], sizes):
+            if np.array_equal(index['mtimes'], mtimes):
+                return index
+            # Touched but possibly unchanged: compare contents before recompiling
+            if all(sha256_file(f) == h for f, h in zip(roi_files, index['hashes'])):
+                index['mtimes'] = mtimes
+                _save_index(index, cache_file)
+                logger.info(f"ROI masks touched but unchanged; refreshed {cache_file}")
+                return index
+        logger.info(f"ROI masks in {roi_dir} changed; recompiling {cache_file}")
+
+    index = compile_roi_index(roi_files, shape, affine)
+    _save_index(index, cache_file)
+    return index
+
+
+def get_roi_index_for_file(roi_dir, reference_file, cache_dir=None):
+    """Return the ROI index of roi_dir on the grid of reference_file."""
+    img = load_nifti(reference_file)
+    return get_roi_index(roi_dir, img.shape, img.affine, cache_dir)
+
+
+def roi_voxels(index, name):
+    """Flat (Fortran-order) voxel indices of one ROI of an index."""
+    i = list(index['names']).index(name)
+    return index['voxels'][index['offsets'][i]:index['offsets'][i + 1]]
+
+
+def indexed_roi_files(roi_dir, reference_file):
+    """
+    ROI files of roi_dir in index order, compiling or validating the cached index.
+
+    Nipype Function-node replacement for get_roi_files when a reference grid is known.
+    """
+    from roi_engine import get_roi_index_for_file
+
+    return [str(f) for f in get_roi_index_for_file(roi_dir, reference_file)['files']]
+
+
+def build_roi_matrix(index):
+    """
+    Sparse averaging matrix of an ROI index.
+
+    Args:
+        index (dict): Index from get_roi_index
+
+    Returns:
+        scipy.sparse.csr_matrix: (n_rois, n_voxels) matrix with Fortran-order voxel columns
+    """
+    counts = index['counts']
+    rows = np.repeat(np.arange(len(counts)), counts)
+    vals = np.repeat(1.0 / np.maximum(counts, 1), counts)
+    n_voxels = int(np.prod(index['shape']))
+    return sparse.csr_matrix((vals, (rows, index['voxels'])), shape=(len(counts), n_voxels))
+
+# =============================================================================
+# EXTRACTION
+# =============================================================================
+
+def _read_volumes(img, start, stop, dtype=np.float64):
+    """Volumes [start, stop) of a 3D/4D image as a (n_voxels, stop - start) Fortran-order matrix."""
+    if img.ndim > 3:
+        block = np.asanyarray(img.dataobj[..., start:stop], dtype=dtype)
+    else:
+        block = np.asanyarray(img.dataobj, dtype=dtype)[..., np.newaxis]
+    return block.reshape(-1, stop - start, order='F')
+
+
+def roi_means(in_file, roi_matrix, volume_chunk=VOLUME_CHUNK):
+    """
+    Mean of every ROI for every volume of a 3D/4D image, reading it once.
+
+    Args:
+        in_file (str): Image on the ROI matrix grid
+        roi_matrix (scipy.sparse.csr_matrix): Matrix from build_roi_matrix
+        volume_chunk (int): Volumes read per chunk
+
+    Returns:
+        numpy.ndarray: (n_volumes, n_rois) ROI means
+    """
+    img = load_nifti(in_file)
+    n_vols = img.shape[3] if img.ndim > 3 else 1
+    empty = np.asarray(roi_matrix.sum(axis=1)).ravel() == 0
+    out = np.empty((n_vols, roi_matrix.shape[0]))
+
+    for start in range(0, n_vols, volume_chunk):
+        stop = min(start + volume_chunk, n_vols)
+        out[start:stop] = (roi_matrix @ _read_volumes(img, start, stop)).T
+    out[:, empty] = np.nan
+    return out
+
+
+def store_roi_means(store, contrast, roi_matrix, file_type='cope'):
+    """
+    Mean of every ROI for every subject of one contrast, read from a cope store.
+
+    Args:
+        store (cope_store.CopeStore): Open store on the ROI matrix grid
+        contrast (int): Contrast number
+        roi_matrix (scipy.sparse.csr_matrix): Matrix from build_roi_matrix
+        file_type (str): 'cope' or 'varcope'
+
+    Returns:
+        numpy.ndarray: (n_subjects, n_rois) ROI means in store subject order
+
+    Raises:
+        ValueError: If an ROI has voxels outside the store mask
+    """
+    in_mask = roi_matrix.tocsc()[:, store.mask_indices]
+    row_sums = np.asarray(in_mask.sum(axis=1)).ravel()
+    full_sums = np.asarray(roi_matrix.sum(axis=1)).ravel()
+    if not np.allclose(row_sums, full_sums):
+        raise ValueError("ROIs extend outside the cope store mask")
+
+    block = store.get(file_type, contrasts=[contrast])[:, 0, :].astype(np.float64)
+    out = np.asarray((in_mask @ block.T).T)
+    out[:, full_sums == 0] = np.nan
+    return out
+
+
+def _store_extraction(store_file, index, roi_matrix, contrasts):
+    """
+    ROI means of several contrasts from a cope store, or None if it cannot be used.
+
+    The store is skipped when it is missing, was built from merged files that
+    have since been rewritten, lacks a contrast, is on another grid, or does
+    not cover every ROI voxel.
+    """
+    if not os.path.exists(store_file):
+        return None
+    from cope_store import CopeStore
+
+    with CopeStore(store_file) as store:
+        if tuple(store.shape) != tuple(int(n) for n in index['shape']) \
+                or not np.allclose(store.affine, index['affine'], atol=GRID_ATOL):
+            logger.info(f"{store_file} is on another grid; reading the merged files")
+            return None
+        if not store.is_current(contrasts):
+            logger.info(f"{store_file} does not match the merged files of {contrasts}; reading the merged files")
+            return None
+        try:
+            means = [store_roi_means(store, contrast, roi_matrix) for contrast in contrasts]
+        except ValueError as e:
+            logger.info(f"Not using {store_file}: {e}")
+            return None
+    logger.info(f"ROI means of contrasts {contrasts} read from {store_file}")
+    return means
+
+
+def stream_roi_psc(cope_file, baseline_file, index, volume_chunk=VOLUME_CHUNK):
+    """
+    Voxelwise PSC of the union of ROI voxels, streaming both images in float32.
+
+    PSC is (cope - baseline) / (|baseline| + PSC_EPSILON) * 100 where the
+    baseline is non-zero, and 0 elsewhere.
+
+    Args:
+        cope_file (str): 3D/4D cope
+        baseline_file (str): Baseline cope on the same grid and volume count
+        index (dict): ROI index on that grid (get_roi_index)
+        volume_chunk (int): Volumes read per chunk
+
+    Returns:
+        tuple: (union voxel indices, (n_union, n_volumes) float32 PSC)
+    """
+    cope_img, baseline_img = load_nifti(cope_file), load_nifti(baseline_file)
+    if cope_img.shape != baseline_img.shape:
+        raise ValueError(f"Baseline shape {baseline_img.shape} does not match cope shape {cope_img.shape}")
+
+    union = np.unique(index['voxels'])
+    n_vols = cope_img.shape[3] if cope_img.ndim > 3 else 1
+    psc = np.empty((union.size, n_vols), dtype=np.float32)
+    for start in range(0, n_vols, volume_chunk):
+        stop = min(start + volume_chunk, n_vols)
+        cope = _read_volumes(cope_img, start, stop, np.float32)[union]
+        baseline = _read_volumes(baseline_img, start, stop, np.float32)[union]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            psc[:, start:stop] = np.where(baseline != 0,
+                                          (cope - baseline) / (np.abs(baseline) + PSC_EPSILON) * 100, 0)
+    return union, psc
+
+
+def run_roi_psc(cope_file, baseline_file, roi_dir, output_dir='.', layout='multi'):
+    """
+    Convert a cope to PSC inside every ROI of roi_dir in one pass.
+
+    Args:
+        cope_file (str): 3D/4D cope
+        baseline_file (str): Baseline cope on the same grid
+        roi_dir (str): Directory containing ROI mask files
+        output_dir (str): Output directory
+        layout (str): 'multi' writes one image holding PSC in the union of ROIs
+            (<cope>_psc); 'per_roi' writes one image per ROI (<cope>_psc_<roi>)
+
+    Returns:
+        tuple: (PSC file per ROI, ROI files), both in index order
+    """
+    if layout not in PSC_LAYOUTS:
+        raise ValueError(f"Unknown PSC layout: {layout}. Use one of {PSC_LAYOUTS}")
+    os.makedirs(output_dir, exist_ok=True)
+
+    index = get_roi_index_for_file(roi_dir, cope_file)
+    union, psc = stream_roi_psc(cope_file, baseline_file, index)
+    cope_img = load_nifti(cope_file)
+    base = os.path.join(output_dir, roi_name(cope_file) + '_psc')
+
+    # One output buffer on the full grid, filled and cleared per written image
+    volume = np.zeros(cope_img.shape[:3] + (psc.shape[1],), dtype=np.float32, order='F')
+    flat = volume.reshape(-1, psc.shape[1], order='F')
+
+    def save(out_file):
+        img = nib.Nifti1Image(volume if cope_img.ndim > 3 else volume[..., 0], cope_img.affine, cope_img.header)
+        img.set_data_dtype(np.float32)
+        nib.save(img, out_file)
+        return out_file
+
+    names = [str(n) for n in index['names']]
+    if layout == 'multi':
+        flat[union] = psc
+        psc_files = [save(f'{base}.nii.gz')] * len(names)
+    else:
+        psc_files = []
+        for name in names:
+            voxels = roi_voxels(index, name)
+            flat[voxels] = psc[np.searchsorted(union, voxels)]
+            psc_files.append(save(f'{base}_{name}.nii.gz'))
+            flat[voxels] = 0
+
+    logger.info(f"PSC of {len(names)} ROIs ({union.size} voxels, {psc.shape[1]} volumes) "
+                f"written from {cope_file} ({layout})")
+    return psc_files, [str(f) for f in index['files']]
+
+
+def run_roi_extraction(cope_file, roi_dir, baseline_file=None, output_dir='.', store_file=None,
+                       contrast=None, baseline_contrast=None):
+    """
+    Extract beta (and PSC) values of all ROIs for all subjects in one pass.
+
+    Args:
+        cope_file (str): Merged 4D cope (one volume per subject)
+        roi_dir (str): Directory containing ROI mask files
+        baseline_file (str): Merged 4D baseline cope for PSC (optional)
+        output_dir (str): Output directory
+        store_file (str): Task cope store holding the same merged copes (optional)
+        contrast (int): Contrast of cope_file in the store
+        baseline_contrast (int): Contrast of baseline_file in the store
+
+    Returns:
+        tuple: (beta_all_rois.csv path, psc_all_rois.csv path or None)
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    index = get_roi_index_for_file(roi_dir, cope_file)
+    roi_matrix, names = build_roi_matrix(index), [str(n) for n in index['names']]
+
+    from_store = None
+    if store_file and contrast is not None and (not baseline_file or baseline_contrast is not None):
+        wanted = [contrast] + ([baseline_contrast] if baseline_file else [])
+        from_store = _store_extraction(store_file, index, roi_matrix, wanted)
+
+    beta = from_store[0] if from_store else roi_means(cope_file, roi_matrix)
+    beta_df = pd.DataFrame(beta, columns=names)
+    beta_df.index.name = 'subject'
+    beta_csv = os.path.join(output_dir, 'beta_all_rois.csv')
+    beta_df.to_csv(beta_csv)
+
+    psc_csv = None
+    if baseline_file:
+        baseline = from_store[1] if from_store else roi_means(baseline_file, roi_matrix)
+        if baseline.shape != beta.shape:
+            raise ValueError("Baseline file subject count does not match cope file")
+        psc_df = pd.DataFrame(beta / baseline * 100, columns=names)
+        psc_df.index.name = 'subject'
+        psc_csv = os.path.join(output_dir, 'psc_all_rois.csv')
+        psc_df.to_csv(psc_csv)
+
+    logger.info(f"Extracted {len(names)} ROIs x {beta.shape[0]} subjects from {cope_file}")
+    return beta_csv, psc_csv
+
+
+def extract_all_roi_values(cope_file, roi_dir, baseline_file=None, output_dir=None, store_file=None,
+                           contrast=None, baseline_contrast=None):
+    """
+    Nipype Function-node wrapper around run_roi_extraction.
+
+    Returns:
+        tuple: (beta_csv, psc_csv)
+    """
+    import os
+    from roi_engine import run_roi_extraction
+
+    return run_roi_extraction(cope_file, roi_dir, baseline_file, output_dir or os.path.abspath('.'),
+                              store_file=store_file, contrast=contrast, baseline_contrast=baseline_contrast)
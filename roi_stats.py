@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+"""
+Summary-level group statistics for ROI analyses.
+
+The ROI branch of create_group_analysis_workflow used to multiply the full 4D
+cope by every ROI mask and run a whole-brain FLAMEO or randomise per ROI on
+mostly-zero images. Here every ROI is first reduced to one value per subject
+(the ROI mean cope, and the ROI mean varcope for mixed effects) with the
+cached ROI index of roi_engine, and the group design is then fitted to the
+subjects x ROIs matrix for all ROIs at once:
+
+    model='ols'     ordinary least squares (what randomise fits)
+    model='flame1'  mixed effects with ROI-averaged varcopes (native_flame)
+
+Permutation inference (model='ols') uses the Freedman-Lane scheme of
+native_randomise on the OLS t statistic, with all ROIs evaluated in the same
+matrix products. Permutations are enumerated exhaustively when the design
+allows it (for two-group designs, the C(n, k) distinct relabellings); the
+FWE-corrected p is taken over ROIs (max statistic) per contrast. Mixed-effects
+fits report parametric p-values only: permuting the OLS t would pair a flame1
+z with a p-value for another statistic, and relabelling subjects across
+variance groups is not exchangeable. The perm_stat column names the permuted
+statistic ('ols_t', or 'none').
+
+All results go to a single tidy table, one row per (contrast, ROI):
+    roi_group_stats.csv
+
+Author: Xiaoqian Xiao (xiao.xiaoqian.320@gmail.com)
+"""
+
+import os
+import math
+import logging
+import itertools
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+from native_randomise import (load_vest, is_one_sample, generate_permutations, prepare_contrast,
+                              compute_t_batch, PERM_BATCH_SIZE)
+from native_flame import fit_mixed_effects, t_to_z
+from roi_engine import get_roi_index_for_file, build_roi_matrix, roi_means
+
+logger = logging.getLogger(__name__)
+
+# =============================================================================
+# CONSTANTS
+# =============================================================================
+
+DEFAULT_NUM_PERM = 10000
+MODELS = ('ols', 'flame1')
+
+# =============================================================================
+# ROI SUMMARIES
+# =============================================================================
+
+def roi_summary_matrix(cope_file, roi_dir, var_cope_file=None):
+    """
+    Reduce merged copes (and varcopes) to subjects x ROIs matrices.
+
+    Args:
+        cope_file (str): Merged 4D cope (one volume per subject)
+        roi_dir (str): Directory containing ROI mask files
+        var_cope_file (str): Merged 4D varcope (optional)
+
+    Returns:
+        tuple: (ROI names, copes (n_subjects, n_rois), varcopes or None)
+    """
+    index = get_roi_index_for_file(roi_dir, cope_file)
+    roi_matrix = build_roi_matrix(index)
+    copes = roi_means(cope_file, roi_matrix)
+    varcopes = roi_means(var_cope_file, roi_matrix) if var_cope_file else None
+    if varcopes is not None and varcopes.shape != copes.shape:
+        raise ValueError(f"Varcope subjects/ROIs {varcopes.shape} do not match copes {copes.shape}")
+    return [str(n) for n in index['names']], copes, varcopes
+
+# =============================================================================
+# MODEL FITS
+# =============================================================================
+
+def fit_ols(design, contrasts, y):
+    """
+    OLS fit of every ROI column.
+
+    Returns:
+        dict: 'cope', 'varcope', 'tstat' as (n_contrasts, n_rois) arrays and 'dof'
+    """
+    pinv_x = np.linalg.pinv(design)
+    beta = pinv_x @ y
+    dof = y.shape[0] - np.linalg.matrix_rank(design)
+    sigma2 = np.sum((y - design @ beta) ** 2, axis=0) / dof
+    var_factor = np.einsum('kp,pq,kq->k', contrasts, np.linalg.pinv(design.T @ design), contrasts)
+    cope = contrasts @ beta
+    varcope = var_factor[:, np.newaxis] * sigma2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tstat = np.where(varcope > 0, cope / np.sqrt(varcope), 0.0)
+    return {'cope': cope, 'varcope': varcope, 'tstat': tstat, 'dof': dof}
+
+
+def two_group_relabellings(design, num_perm):
+    """
+    Enumerate the distinct group relabellings of a two-group design.
+
+    When the design has only two distinct rows, the t statistic depends only
+    on which subjects are assigned to the first group, so the C(n, k)
+    relabellings make up the complete permutation distribution.
+
+    Args:
+        design (numpy.ndarray): (n_subjects, n_evs) design matrix
+        num_perm (int): Largest number of relabellings to enumerate
+
+    Returns:
+        numpy.ndarray: (C(n, k), n) permutation orders with the identity first,
+                       or None if the design is not a two-group design or has
+                       more than num_perm relabellings
+    """
+    rows, labels = np.unique(np.round(design, 10), axis=0, return_inverse=True)
+    if len(rows) != 2:
+        return None
+    labels = labels.ravel()
+    first = np.flatnonzero(labels == labels[0])
+    second = np.flatnonzero(labels != labels[0])
+    n = len(labels)
+    if math.comb(n, len(first)) > num_perm:
+        return None
+
+    orders = np.empty((math.comb(n, len(first)), n), dtype=int)
+    for i, chosen in enumerate(itertools.combinations(range(n), len(first))):
+        orders[i, first] = chosen
+        orders[i, second] = np.setdiff1d(np.arange(n), chosen)
+    # The relabelling that keeps the groups (the identity) must come first
+    identity = int(np.flatnonzero(np.all(orders == np.arange(n), axis=1))[0])
+    orders[[0, identity]] = orders[[identity, 0]]
+    return orders
+
+
+def permutation_pvalues(y, design, contrast, num_perm=DEFAULT_NUM_PERM, seed=0,
+                        batch_size=PERM_BATCH_SIZE):
+    """
+    Permutation p-values of one contrast for all ROI columns at once.
+
+    Args:
+        y (numpy.ndarray): (n_subjects, n_rois) ROI values
+        design (numpy.ndarray): (n_subjects, n_evs) design matrix
+        contrast (numpy.ndarray): (n_evs,) contrast vector
+        num_perm (int): Permutations (including identity) when not enumerating
+        seed (int): Random seed
+
+    Returns:
+        dict: 'p' and 'p_fwe' (n_rois,) arrays, 'n_perm' and 'exact'
+    """
+    sign_flip = is_one_sample(design)
+    relabellings = None if sign_flip else two_group_relabellings(design, num_perm)
+    if relabellings is not None:
+        orders, signs = relabellings, np.ones(relabellings.shape)
+        n_arrangements = len(relabellings)
+    else:
+        orders, signs = generate_permutations(y.shape[0], num_perm, sign_flip, seed)
+        n_arrangements = 2 ** y.shape[0] if sign_flip else math.factorial(y.shape[0])
+
+    state = prepare_contrast(y, design, contrast)
+    observed = compute_t_batch(state, orders[:1], signs[:1])[0]
+    exceed = np.zeros(y.shape[1])
+    exceed_max = np.zeros(y.shape[1])
+    for start in range(0, len(orders), batch_size):
+        tstat = compute_t_batch(state, orders[start:start + batch_size], signs[start:start + batch_size])
+        exceed += np.sum(tstat >= observed - 1e-10, axis=0)
+        exceed_max += np.sum(tstat.max(axis=1)[:, np.newaxis] >= observed - 1e-10, axis=0)
+
+    return {'p': exceed / len(orders), 'p_fwe': exceed_max / len(orders),
+            'n_perm': len(orders), 'exact': n_arrangements <= num_perm}
+
+
+def roi_group_stats(names, y, design, contrasts, varcopes=None, groups=None, model='ols',
+                    num_perm=DEFAULT_NUM_PERM, seed=0):
+    """
+    Fit the group design to all ROIs and run permutation inference.
+
+    ROIs with missing values (empty masks) are reported with NaN statistics.
+
+    Args:
+        names (list): ROI names
+        y (numpy.ndarray): (n_subjects, n_rois) ROI mean copes
+        design (numpy.ndarray): (n_subjects, n_evs) design matrix
+        contrasts (numpy.ndarray): (n_contrasts, n_evs) contrast rows
+        varcopes (numpy.ndarray): (n_subjects, n_rois) ROI mean varcopes (model='flame1')
+        groups (numpy.ndarray): (n_subjects,) variance groups (model='flame1', default: one group)
+        model (str): 'ols' or 'flame1'
+        num_perm (int): Number of permutations (0 disables permutation inference;
+                        model='flame1' is never permuted)
+        seed (int): Random seed
+
+    Returns:
+        pandas.DataFrame: One row per (contrast, ROI); p_perm/p_perm_fwe are NaN
+                          unless perm_stat is 'ols_t'
+    """
+    if model not in MODELS:
+        raise ValueError(f"Unknown model: {model}. Use one of {MODELS}")
+    if model == 'flame1' and varcopes is None:
+        raise ValueError("model='flame1' requires ROI varcopes")
+    if design.shape[0] != y.shape[0]:
+        raise ValueError(f"Design has {design.shape[0]} rows but there are {y.shape[0]} subjects")
+
+    valid = np.all(np.isfinite(y), axis=0)
+    if varcopes is not None:
+        valid &= np.all(np.isfinite(varcopes), axis=0)
+    yv = y[:, valid]
+
+    n_contrasts, n_rois = len(contrasts), y.shape[1]
+    columns = {key: np.full((n_contrasts, n_rois), np.nan)
+               for key in ('cope', 'varcope', 't', 'z', 'p', 'p_perm', 'p_perm_fwe')}
+
+    if model == 'ols':
+        fit = fit_ols(design, contrasts, yv)
+    else:
+        groups = np.ones(y.shape[0], dtype=int) if groups is None else np.asarray(groups, dtype=int)
+        fit = fit_mixed_effects(design, contrasts, groups, yv, varcopes[:, valid], n_procs=1)
+        fit['dof'] = y.shape[0] - np.linalg.matrix_rank(design)
+    dof = fit['dof']
+
+    columns['cope'][:, valid] = fit['cope']
+    columns['varcope'][:, valid] = fit['varcope']
+    columns['t'][:, valid] = fit['tstat']
+    columns['z'][:, valid] = t_to_z(fit['tstat'], dof)
+    columns['p'][:, valid] = stats.t.sf(fit['tstat'], dof)
+
+    n_perm, exact, perm_stat = 0, False, 'none'
+    if model == 'flame1' and num_perm:
+        logger.info("Permutation inference is not run for model='flame1'; reporting parametric p-values")
+    elif num_perm and yv.shape[1]:
+        perm_stat = 'ols_t'
+        for k, contrast in enumerate(contrasts):
+            perm = permutation_pvalues(yv, design, contrast, num_perm, seed)
+            columns['p_perm'][k, valid] = perm['p']
+            columns['p_perm_fwe'][k, valid] = perm['p_fwe']
+            n_perm, exact = perm['n_perm'], perm['exact']
+
+    rows = []
+    for k in range(n_contrasts):
+        for r, name in enumerate(names):
+            row = {'contrast': k + 1, 'roi': name, 'model': model, 'n_subjects': y.shape[0], 'dof': dof}
+            row.update({key: values[k, r] for key, values in columns.items()})
+            row.update({'perm_stat': perm_stat, 'n_perm': n_perm, 'exact': exact})
+            rows.append(row)
+    return pd.DataFrame(rows)
+
+
+# =============================================================================
+# FILE INTERFACE
+# =============================================================================
+
+def run_roi_group_stats(cope_file, roi_dir, design_file, con_file, out_dir, var_cope_file=None,
+                        grp_file=None, model='ols', num_perm=DEFAULT_NUM_PERM, seed=0):
+    """
+    ROI summary statistics for a merged cope, written as one tidy CSV.
+
+    Args:
+        cope_file (str): Merged 4D cope
+        roi_dir (str): Directory containing ROI mask files
+        design_file (str): design.mat
+        con_file (str): contrast.con
+        out_dir (str): Output directory
+        var_cope_file (str): Merged 4D varcope (required for model='flame1')
+        grp_file (str): design.grp variance groups (optional)
+        model (str): 'ols' or 'flame1'
+        num_perm (int): Number of permutations
+        seed (int): Random seed
+
+    Returns:
+        str: Path to roi_group_stats.csv
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    names, y, varcopes = roi_summary_matrix(cope_file, roi_dir,
+                                            var_cope_file if model == 'flame1' else None)
+    design = load_vest(design_file)
+    contrasts = load_vest(con_file)
+    groups = load_vest(grp_file)[:, 0] if grp_file else None
+
+    logger.info(f"ROI group stats ({model}): {y.shape[0]} subjects, {len(names)} ROIs, "
+                f"{len(contrasts)} contrasts")
+    table = roi_group_stats(names, y, design, contrasts, varcopes, groups, model, num_perm, seed)
+
+    table_file = os.path.join(out_dir, 'roi_group_stats.csv')
+    table.to_csv(table_file, index=False)
+    logger.info(f"ROI group stats written to {table_file}")
+    return table_file
+
+
+def run_roi_stats_node(cope_file, roi_dir, design_file, con_file, var_cope_file=None, grp_file=None,
+                       model='ols', num_perm=10000, seed=0):
+    """
+    Nipype Function-node wrapper around run_roi_group_stats.
+
+    Returns:
+        str: roi_group_stats.csv path
+    """
+    import os
+    from roi_stats import run_roi_group_stats
+
+    return run_roi_group_stats(cope_file, roi_dir, design_file, con_file, os.path.abspath('roi_stats'),
+                               var_cope_file=var_cope_file, grp_file=grp_file, model=model,
+                               num_perm=num_perm, seed=seed)
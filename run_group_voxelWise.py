@@ -18,6 +18,12 @@ Usage:
     # Custom data paths
     python run_group_level.py --task phase2 --contrast 1 --analysis-type flameo --base-dir /path/to/data --custom-paths
 
+    # All copes of a task in one job (shared mask, design and permutation set)
+    python run_group_level.py --task phase2 --all-contrasts --analysis-type randomise --engine native --base-dir /path/to/data
+
+    # Run the workflow on node-local scratch (resumable after preemption)
+    python run_group_level.py --task phase2 --contrast 1 --analysis-type randomise --base-dir /path/to/data --stage-local
+
 Author: Xiaoqian Xiao (xiao.xiaoqian.320@gmail.com)
 """
 
@@ -26,10 +32,17 @@ Author: Xiaoqian Xiao (xiao.xiaoqian.320@gmail.com)
 # =============================================================================
 
 import os
+import re
 import argparse
 import logging
+from contextlib import ExitStack
 from pathlib import Path
 from group_level_workflows import wf_randomise, wf_flameo
+from result_promotion import promote_tree, write_manifest, read_sink_manifest, promote_sink_outputs
+from design_cache import read_design_info
+from group_results_db import index_result_dir, default_db_path
+from scratch_staging import staged_workdir, stage_inputs
+from workdir_retention import RetentionMonitor, RETENTION_LEVELS, DEFAULT_RETENTION
 from nipype import config, logging as nipype_logging
 from templateflow.api import get as tpl_get
 
@@ -99,11 +112,65 @@ DATA_SOURCE_CONFIGS = {
     }
 }
 
+# Workflow sink folders promoted into the results directory
+# (FLAMEO creates 'stats' and 'cluster_results', Randomise creates 'stats' or 'randomise')
+RESULT_SUBDIRS = ('stats', 'cluster_results', 'randomise')
+
+# Inputs copied to node-local scratch with --stage-local
+STAGED_INPUT_KEYS = ('cope_file', 'varcope_file', 'mask_file')
+
 # =============================================================================
 # WORKFLOW EXECUTION FUNCTIONS
 # =============================================================================
 
-def run_group_level_workflow(task, contrast, analysis_type, paths, data_source_config):
+def promote_found_results(workflow_dir, workflow_output_dir, result_dir):
+    """
+    Promote result folders found by searching a workflow directory.
+
+    Fallback for workflow runs without a sink manifest: each of RESULT_SUBDIRS
+    is searched first in the main workflow directory, then in the nested
+    workflow output directory and in common FLAMEO locations.
+
+    Args:
+        workflow_dir (str): Workflow (sink base) directory
+        workflow_output_dir (str): Nested Nipype directory of the workflow
+        result_dir (str): Results directory
+
+    Returns:
+        list: Promotion records
+    """
+    def find_subdir_recursive(base_dir, target_dir):
+        """Recursively search for a subdirectory in the base directory."""
+        for root, dirs, files in os.walk(base_dir):
+            if target_dir in dirs:
+                return os.path.join(root, target_dir)
+        return None
+
+    found_dirs = {}
+    for subdir in RESULT_SUBDIRS:
+        source_path = (find_subdir_recursive(workflow_dir, subdir)
+                       or find_subdir_recursive(workflow_output_dir, subdir))
+        if source_path:
+            found_dirs[subdir] = source_path
+            logger.info(f"Found {subdir} directory at: {source_path}")
+
+    if 'cluster_results' not in found_dirs:
+        for loc in ['clustering', 'flameo', 'datasink']:
+            loc_path = os.path.join(workflow_output_dir, loc)
+            cluster_in_loc = find_subdir_recursive(loc_path, 'cluster_results') if os.path.exists(loc_path) else None
+            if cluster_in_loc:
+                found_dirs['cluster_results'] = cluster_in_loc
+                logger.info(f"Found cluster_results in {loc} subdirectory: {cluster_in_loc}")
+                break
+
+    records = []
+    for subdir, source_path in found_dirs.items():
+        # Hardlinks on the same filesystem, copy only across devices
+        records.extend(promote_tree(source_path, os.path.join(result_dir, subdir), mode='link'))
+    return records
+
+def run_group_level_workflow(task, contrast, analysis_type, paths, data_source_config, engine='fsl',
+                             adaptive_perm=False, cluster_engine='fsl', retention=DEFAULT_RETENTION):
     """
     Run group-level workflow for a specific task and contrast.
     
@@ -113,6 +180,10 @@ def run_group_level_workflow(task, contrast, analysis_type, paths, data_source_c
         analysis_type (str): Analysis type ('randomise' or 'flameo')
         paths (dict): Dictionary containing all necessary file paths
         data_source_config (dict): Configuration for the data source
+        engine (str): Group-level engine ('fsl' or 'native'): randomise or FLAMEO replacement
+        adaptive_perm (bool): Stop permutations early per contrast (native engine only)
+        cluster_engine (str): FLAMEO cluster inference ('fsl' or 'native')
+        retention (str): Working-directory retention level (workdir_retention)
     """
     try:
         # Select workflow function based on analysis type
@@ -126,7 +197,14 @@ def run_group_level_workflow(task, contrast, analysis_type, paths, data_source_c
         # Create workflow with proper directory alignment
         # IMPORTANT: Set output_dir to workflow_dir so DataSink writes to writable location
         # We'll copy results to final results directory after completion
-        wf = wf_func(output_dir=paths['workflow_dir'], name=wf_name)
+        if analysis_type == 'randomise':
+            wf = wf_func(output_dir=paths['workflow_dir'], name=wf_name, engine=engine,
+                         n_procs=PLUGIN_SETTINGS['plugin_args']['n_procs'], adaptive=adaptive_perm)
+            logger.info(f"Randomise engine: {engine}{' (adaptive permutations)' if adaptive_perm else ''}")
+        else:
+            wf = wf_func(output_dir=paths['workflow_dir'], name=wf_name, engine=engine,
+                         n_procs=PLUGIN_SETTINGS['plugin_args']['n_procs'], cluster_engine=cluster_engine)
+            logger.info(f"FLAMEO engine: {engine}, cluster engine: {cluster_engine}")
         wf.base_dir = paths['workflow_dir']
         
         # Set crash directory to workflow directory to avoid permission issues
@@ -216,10 +294,12 @@ def run_group_level_workflow(task, contrast, analysis_type, paths, data_source_c
         logger.info(f"Results directory: {paths['result_dir']}")
         logger.info(f"Workflow directory: {paths['workflow_dir']}")
         
-        # Run the workflow
+        # Run the workflow, pruning node directories to the retention level as nodes finish
         logger.info(f"Starting workflow execution with plugin settings: {PLUGIN_SETTINGS}")
+        monitor = RetentionMonitor(wf, retention)
         try:
-            result = wf.run(**PLUGIN_SETTINGS)
+            result = wf.run(plugin=PLUGIN_SETTINGS['plugin'],
+                            plugin_args=dict(PLUGIN_SETTINGS['plugin_args'], status_callback=monitor))
             logger.info(f"Workflow completed successfully: {wf_name}")
             logger.info(f"Workflow result: {result}")
         except Exception as e:
@@ -229,6 +309,7 @@ def run_group_level_workflow(task, contrast, analysis_type, paths, data_source_c
             crash_files = glob.glob(os.path.join(paths['workflow_dir'], 'crash-*.pklz'))
             if crash_files:
                 logger.error(f"Found crash files: {crash_files}")
+            monitor.finalize(success=False)
             raise
         
         # Check if workflow actually completed by looking at the result
@@ -237,127 +318,191 @@ def run_group_level_workflow(task, contrast, analysis_type, paths, data_source_c
         else:
             logger.info(f"Workflow nodes completed: {list(result.keys()) if hasattr(result, 'keys') else 'No keys'}")
         
-        # Copy results from workflow directory to final results directory
-        workflow_output_dir = os.path.join(paths['workflow_dir'], wf_name)
-        logger.info(f"Looking for workflow output in: {workflow_output_dir}")
+        # Promote the files recorded by the workflow's sink; only runs that
+        # predate the sink manifest need a search of the workflow directory
+        Path(paths['result_dir']).mkdir(parents=True, exist_ok=True)
+        sink_manifest = read_sink_manifest(paths['workflow_dir'], wf_name)
+        if sink_manifest is not None:
+            records = promote_sink_outputs(sink_manifest, paths['result_dir'], RESULT_SUBDIRS, mode='link')
+        else:
+            logger.warning(f"No sink manifest for {wf_name}; searching {paths['workflow_dir']} for results")
+            records = promote_found_results(paths['workflow_dir'], os.path.join(paths['workflow_dir'], wf_name),
+                                            paths['result_dir'])
         
-        # Check what's in the main workflow directory (where actual results are)
-        workflow_dir_contents = os.listdir(paths['workflow_dir'])
-        logger.info(f"Main workflow directory contains: {workflow_dir_contents}")
+        if records:
+            manifest_file = write_manifest(paths['result_dir'], records)
+            logger.info(f"Wrote promotion manifest: {manifest_file}")
         
-        if os.path.exists(workflow_output_dir):
-            logger.info(f"Copying results from workflow directory: {paths['workflow_dir']}")
-            logger.info(f"To final results directory: {paths['result_dir']}")
-            
-            # List what's in the workflow output directory for reference
-            workflow_contents = os.listdir(workflow_output_dir)
-            logger.info(f"Workflow output directory contains: {workflow_contents}")
-            
-            # Simplified check for required result directories
-            logger.info(f"Checking for required result directories in {workflow_output_dir}")
-            
-            # Check if required subdirectories exist (search recursively)
-            result_subdirs = ['stats', 'cluster_results', 'randomise']
-            found_dirs = {}
-            
-            def find_subdir_recursive(base_dir, target_dir):
-                """Recursively search for a subdirectory in the base directory."""
-                for root, dirs, files in os.walk(base_dir):
-                    if target_dir in dirs:
-                        return os.path.join(root, target_dir)
-                return None
-            
-            # Debug: List all directories found in the workflow output
-            logger.info(f"All directories found in workflow output:")
-            for root, dirs, files in os.walk(workflow_output_dir):
-                for dir_name in dirs:
-                    logger.info(f"  Found directory: {os.path.join(root, dir_name)}")
-            
-            # First, search for all required subdirectories in BOTH locations
-            # 1. Main workflow directory (where cluster_results and stats typically exist)
-            # 2. Nested workflow output directory (where some results might be nested)
-            for subdir in result_subdirs:
-                # First try main workflow directory
-                source_path = find_subdir_recursive(paths['workflow_dir'], subdir)
-                if source_path:
-                    found_dirs[subdir] = source_path
-                    logger.info(f"Found {subdir} directory at: {source_path} (in main workflow directory)")
-                else:
-                    # If not found in main directory, try nested workflow output directory
-                    source_path = find_subdir_recursive(workflow_output_dir, subdir)
-                    if source_path:
-                        found_dirs[subdir] = source_path
-                        logger.info(f"Found {subdir} directory at: {source_path} (in nested workflow directory)")
-                    else:
-                        logger.info(f"Subdirectory {subdir} not found in either location, will skip")
-            
-            # Special handling for cluster_results - look in common FLAMEO locations if not found
-            if 'cluster_results' not in found_dirs:
-                logger.info("cluster_results not found at top level, checking common FLAMEO locations...")
-                # Look for cluster_results in common FLAMEO subdirectories
-                common_locations = ['clustering', 'flameo', 'datasink']
-                for loc in common_locations:
-                    loc_path = os.path.join(workflow_output_dir, loc)
-                    if os.path.exists(loc_path):
-                        cluster_in_loc = find_subdir_recursive(loc_path, 'cluster_results')
-                        if cluster_in_loc:
-                            found_dirs['cluster_results'] = cluster_in_loc
-                            logger.info(f"Found cluster_results in {loc} subdirectory: {cluster_in_loc}")
-                            break
-            
-            # Create final results directory if it doesn't exist
-            Path(paths['result_dir']).mkdir(parents=True, exist_ok=True)
-            
-            # Copy only specific result subdirectories from workflow to final results
-            import shutil
-            try:
-                logger.info(f"About to copy specific result directories from {workflow_output_dir} to {paths['result_dir']}")
-                
-                # Define which subdirectories to copy (only the actual results)
-                # Note: FLAMEO creates 'stats' and 'cluster_results', Randomise creates 'randomise'
-                result_subdirs = ['stats', 'cluster_results', 'randomise']
-                
-                # Copy each result subdirectory if it was found
-                for subdir in result_subdirs:
-                    if subdir in found_dirs:
-                        source_path = found_dirs[subdir]
-                        dest_path = os.path.join(paths['result_dir'], subdir)
-                        
-                        try:
-                            # Use copy2 for cross-device safety (like pre-group analysis)
-                            if os.path.exists(dest_path):
-                                shutil.rmtree(dest_path)  # Remove existing directory
-                            shutil.copytree(source_path, dest_path)
-                            logger.info(f"Successfully copied {subdir} from {source_path} to {dest_path}")
-                        except Exception as e:
-                            logger.error(f"Failed to copy {subdir}: {e}")
-                            raise
-                    else:
-                        logger.info(f"Subdirectory {subdir} not found, skipping")
-                
-                logger.info(f"Successfully copied all result directories to: {paths['result_dir']}")
-                
-                # Verify final results directory
-                if os.path.exists(paths['result_dir']):
-                    result_files = os.listdir(paths['result_dir'])
-                    logger.info(f"Final results directory contains: {result_files}")
-                else:
-                    logger.warning(f"Final results directory does not exist after copy")
-                    
-            except Exception as e:
-                logger.error(f"Failed to copy results: {e}")
-                logger.error(f"Exception type: {type(e)}")
-                import traceback
-                logger.error(f"Traceback: {traceback.format_exc()}")
-                raise
-        else:
-            logger.warning(f"Workflow output directory not found: {workflow_output_dir}")
-            logger.info(f"Checking workflow directory contents: {os.listdir(paths['workflow_dir'])}")
+        # Validate against the sink manifest: every recorded output must now be in the results directory
+        if sink_manifest is not None:
+            expected = [p for p in sink_manifest['files'] if p.split(os.sep)[0] in RESULT_SUBDIRS]
+            missing = [p for p in expected if not os.path.exists(os.path.join(paths['result_dir'], p))]
+            if missing:
+                raise RuntimeError(f"{len(missing)} sink outputs missing from {paths['result_dir']}: {missing[:5]}")
+            logger.info(f"Validated {len(expected)} outputs in {paths['result_dir']}")
+        
+        # Results are in place; apply the final retention pass to the node directories
+        monitor.finalize()
         
     except Exception as e:
         logger.error(f"Failed to run workflow {wf_name}: {e}")
         raise
 
+def discover_contrasts(task, base_dir, data_source):
+    """
+    List the copes of a task that have merged pre-group outputs.
+
+    Args:
+        task (str): Task name
+        base_dir (str): Base directory for data
+        data_source (str): Data source type
+
+    Returns:
+        list: Sorted contrast numbers
+    """
+    data_source_config = DATA_SOURCE_CONFIGS.get(data_source, DATA_SOURCE_CONFIGS['standard'])
+    task_dir = os.path.join(base_dir, data_source_config['results_subdir'], f'task-{task}')
+    if not os.path.isdir(task_dir):
+        return []
+
+    contrasts = []
+    for name in os.listdir(task_dir):
+        match = re.fullmatch(r'cope(\d+)', name)
+        if match and os.path.exists(os.path.join(task_dir, name, 'merged_cope.nii.gz')):
+            contrasts.append(int(match.group(1)))
+    return sorted(contrasts)
+
+def run_native_randomise_batch_task(task, contrast_paths, adaptive_perm=False, family_wise=True):
+    """
+    Run native randomise for all copes of a task against one permutation set.
+
+    The mask, design and permutations are set up once; results are written per
+    cope and promoted into each cope's results directory in the same layout as
+    the per-contrast workflow (stats/randomise_*).
+
+    Args:
+        task (str): Task name
+        contrast_paths (dict): Contrast number -> paths dict (get_standard_paths)
+        adaptive_perm (bool): Adaptive permutation stopping (not with family_wise)
+        family_wise (bool): Also correct across all copes of the task
+    """
+    from native_randomise import run_native_randomise_batch
+
+    contrasts = sorted(contrast_paths)
+    first = contrast_paths[contrasts[0]]
+
+    # Every cope must share the design of the first one
+    fingerprints = {}
+    for contrast in contrasts:
+        info = read_design_info(os.path.dirname(contrast_paths[contrast]['design_file']))
+        fingerprints[contrast] = info['fingerprint'] if info else None
+    if len(set(fingerprints.values())) > 1 or None in fingerprints.values():
+        raise ValueError(f"Copes of task-{task} do not share one design: "
+                         f"{ {c: (f[:12] if f else None) for c, f in fingerprints.items()} }")
+
+    jobs = []
+    for contrast in contrasts:
+        stats_dir = os.path.join(contrast_paths[contrast]['workflow_dir'], 'batch_randomise', 'stats')
+        jobs.append((contrast, contrast_paths[contrast]['cope_file'], stats_dir))
+
+    run_native_randomise_batch(jobs, first['mask_file'], first['design_file'], first['con_file'],
+                               n_procs=PLUGIN_SETTINGS['plugin_args']['n_procs'],
+                               family_wise=family_wise, adaptive=adaptive_perm)
+
+    for contrast, _, stats_dir in jobs:
+        result_dir = contrast_paths[contrast]['result_dir']
+        Path(result_dir).mkdir(parents=True, exist_ok=True)
+        records = promote_tree(stats_dir, os.path.join(result_dir, 'stats'), mode='link')
+        manifest_file = write_manifest(result_dir, records)
+        logger.info(f"Promoted cope{contrast} results to {result_dir} (manifest: {manifest_file})")
+
+def stage_group_paths(stack, paths):
+    """
+    Stage a contrast's image inputs and workflow directory on node-local scratch.
+
+    Results are promoted from the local workflow directory straight into
+    result_dir (copied across devices), so only crash files are synced back
+    to the shared workflow directory. Design files stay in place; they are
+    small and the batch path reads design_info.json next to them.
+
+    Args:
+        stack (contextlib.ExitStack): Stack that owns the staged directory
+        paths (dict): Paths dictionary (get_standard_paths / get_custom_paths)
+
+    Returns:
+        dict: Paths with workflow_dir and the image inputs replaced by local ones
+    """
+    local_dir = stack.enter_context(staged_workdir(paths['workflow_dir']))
+    staged = stage_inputs({key: paths[key] for key in STAGED_INPUT_KEYS if paths.get(key)}, local_dir)
+    return dict(paths, workflow_dir=local_dir, **staged)
+
+def run_group_batch(task, contrasts, analysis_type, base_dir, data_source, engine='fsl',
+                    adaptive_perm=False, family_wise=True, cluster_engine='fsl', stage_local=False,
+                    retention=DEFAULT_RETENTION):
+    """
+    Run the group-level analysis for several copes of a task in one job.
+
+    With the native randomise engine all copes share one permutation pass
+    (run_native_randomise_batch_task); otherwise the per-contrast workflows
+    run one after another in this job.
+
+    Args:
+        task (str): Task name
+        contrasts (list): Contrast numbers
+        analysis_type (str): 'randomise' or 'flameo'
+        base_dir (str): Base directory for data
+        data_source (str): Data source type
+        engine (str): Randomise engine ('fsl' or 'native')
+        adaptive_perm (bool): Adaptive permutation stopping (native engine only)
+        family_wise (bool): Correct across copes (native randomise only)
+        cluster_engine (str): FLAMEO cluster inference ('fsl' or 'native')
+        stage_local (bool): Run on node-local scratch (stage_group_paths)
+        retention (str): Working-directory retention level for the per-contrast workflows
+    """
+    contrast_paths = {}
+    data_source_config = None
+    for contrast in contrasts:
+        paths, data_source_config = get_standard_paths(task, contrast, base_dir, data_source)
+        if not validate_paths(paths, analysis_type):
+            raise ValueError(f"Path validation failed for task-{task} cope{contrast}")
+        contrast_paths[contrast] = paths
+    logger.info(f"Batch of {len(contrasts)} copes for task-{task}: {contrasts}")
+
+    if analysis_type == 'randomise' and engine == 'native':
+        with ExitStack() as stack:
+            if stage_local:
+                contrast_paths = {c: stage_group_paths(stack, p) for c, p in contrast_paths.items()}
+            run_native_randomise_batch_task(task, contrast_paths, adaptive_perm=adaptive_perm,
+                                            family_wise=family_wise)
+        return
+
+    for contrast in contrasts:
+        with ExitStack() as stack:
+            paths = stage_group_paths(stack, contrast_paths[contrast]) if stage_local else contrast_paths[contrast]
+            run_group_level_workflow(task, contrast, analysis_type, paths, data_source_config,
+                                     engine=engine, adaptive_perm=adaptive_perm, cluster_engine=cluster_engine,
+                                     retention=retention)
+
+def update_results_db(db_file, result_dirs, data_source, task):
+    """
+    Add freshly promoted results to the group results database.
+
+    Indexing is bookkeeping only: a failure (e.g. a lock held too long by
+    another job) is logged and does not fail the analysis; the database can
+    be brought up to date later with group_results_db.py.
+
+    Args:
+        db_file (str): Database file
+        result_dirs (list): Results directories written by this job
+        data_source (str): Data source type
+        task (str): Task name
+    """
+    for result_dir in result_dirs:
+        try:
+            index_result_dir(db_file, result_dir, data_source, task)
+        except Exception as e:
+            logger.warning(f"Could not index {result_dir} into {db_file}: {e}")
+
 def get_standard_paths(task, contrast, base_dir, data_source):
     """
     Get standard file paths for group-level analysis.
@@ -469,6 +614,20 @@ def validate_paths(paths, analysis_type):
             logger.error(f"  {missing}")
         return False
     
+    # Refuse merged inputs whose volume count does not match the design's subject set
+    info = read_design_info(os.path.dirname(paths['design_file']))
+    if info is not None:
+        import nibabel as nib
+        n_design = len(info['subjects'])
+        for file_key in ('cope_file', 'varcope_file'):
+            if paths.get(file_key) and os.path.exists(paths[file_key]):
+                shape = nib.load(paths[file_key]).shape
+                n_volumes = shape[3] if len(shape) > 3 else 1
+                if n_volumes != n_design:
+                    logger.error(f"{file_key} has {n_volumes} volumes but design "
+                                 f"{info['fingerprint'][:12]} has {n_design} subjects")
+                    return False
+    
     logger.info("All required files found")
     return True
 
@@ -495,12 +654,28 @@ Examples:
   
   # Custom data paths
   python run_group_level.py --task phase2 --contrast 1 --analysis-type flameo --base-dir /path/to/data --custom-paths
+  
+  # In-process permutation engine instead of FSL randomise
+  python run_group_level.py --task phase2 --contrast 1 --analysis-type randomise --base-dir /path/to/data --engine native
+
+  # Native engine with adaptive permutation stopping
+  python run_group_level.py --task phase2 --contrast 1 --analysis-type randomise --base-dir /path/to/data --engine native --adaptive-perm
+
+  # All copes of a task in one job, sharing one permutation set
+  python run_group_level.py --task phase2 --all-contrasts --analysis-type randomise --base-dir /path/to/data --engine native
         """
     )
     
     # Required arguments
     parser.add_argument('--task', required=True, help='Task name (e.g., phase2, phase3)')
-    parser.add_argument('--contrast', required=True, type=int, help='Contrast number')
+    contrast_group = parser.add_mutually_exclusive_group(required=True)
+    contrast_group.add_argument('--contrast', type=int, help='Contrast number')
+    contrast_group.add_argument('--contrasts', type=int, nargs='+',
+                                help='Several contrast numbers, run in one job. Native randomise '
+                                     'shares one permutation set across them; fsl randomise and '
+                                     'flameo run the per-contrast workflows one after another')
+    contrast_group.add_argument('--all-contrasts', action='store_true',
+                                help='Run every cope of the task with merged pre-group outputs in one job')
     parser.add_argument('--base-dir', required=True, help='Base directory containing the data')
     
     # Optional arguments
@@ -508,6 +683,27 @@ Examples:
                        help='Analysis type: randomise (non-parametric) or flameo (parametric)')
     parser.add_argument('--data-source', default='standard', choices=['standard', 'placebo', 'guess'],
                        help='Data source type: standard, placebo, or guess (default: standard)')
+    parser.add_argument('--engine', default='fsl', choices=['fsl', 'native'],
+                       help='Group-level engine: fsl (FSL randomise/FLAMEO) or native '
+                            '(in-process permutations / mixed-effects fit)')
+    parser.add_argument('--adaptive-perm', action='store_true',
+                       help='Stop permuting a contrast once its corrected p-values are settled (native engine only)')
+    parser.add_argument('--cluster-engine', default='fsl', choices=['fsl', 'native'],
+                       help='FLAMEO cluster inference: fsl (SmoothEstimate + Cluster per zstat) or native '
+                            '(one in-process GRF stage using the design residuals)')
+    parser.add_argument('--no-family-wise', action='store_true',
+                       help='Batch runs: skip the correction across copes (native randomise only; '
+                            'required for --adaptive-perm with several contrasts)')
+    parser.add_argument('--stage-local', action='store_true',
+                        help='Run on node-local scratch ($TMPDIR) with a resumable handoff to the '
+                             'shared workflow directory on preemption')
+    parser.add_argument('--retention', default=DEFAULT_RETENTION, choices=RETENTION_LEVELS,
+                        help='Working-directory retention: keep-all, keep-restartable (drop outputs no node '
+                             'reads) or results-only (drop node outputs once consumed and the node '
+                             f'directories after promotion) (default: {DEFAULT_RETENTION})')
+    parser.add_argument('--results-db',
+                       help='Group results database updated after the run '
+                            '(default: <base-dir>/groupLevel_timeEffect/group_results.sqlite)')
     parser.add_argument('--custom-paths', action='store_true',
                        help='Use custom file paths instead of standard structure')
     
@@ -522,13 +718,44 @@ Examples:
     parser.add_argument('--workflow-dir', help='Custom workflow directory')
     
     args = parser.parse_args()
+
+    if args.adaptive_perm and args.engine != 'native':
+        parser.error("--adaptive-perm requires --engine native")
+    batch = args.contrast is None
+    if batch and args.adaptive_perm and args.analysis_type == 'randomise' and not args.no_family_wise:
+        parser.error("--adaptive-perm with --contrasts/--all-contrasts requires --no-family-wise "
+                     "(the correction across copes needs every permutation)")
+    if batch and args.custom_paths:
+        parser.error("--contrasts/--all-contrasts use the standard path structure, not --custom-paths")
     
     try:
+        if batch:
+            contrasts = (discover_contrasts(args.task, args.base_dir, args.data_source)
+                         if args.all_contrasts else sorted(set(args.contrasts)))
+            if not contrasts:
+                logger.error(f"No copes with merged pre-group outputs for task-{args.task}")
+                return 1
+            logger.info("Starting batch group-level analysis")
+            logger.info(f"Task: {args.task}, contrasts: {contrasts}, analysis type: {args.analysis_type}, "
+                        f"data source: {args.data_source}, engine: {args.engine}")
+            run_group_batch(args.task, contrasts, args.analysis_type, args.base_dir, args.data_source,
+                            engine=args.engine, adaptive_perm=args.adaptive_perm,
+                            family_wise=not args.no_family_wise, cluster_engine=args.cluster_engine,
+                            stage_local=args.stage_local, retention=args.retention)
+            results_root = os.path.join(args.base_dir, DATA_SOURCE_CONFIGS[args.data_source]['results_subdir'],
+                                        f'task-{args.task}')
+            update_results_db(args.results_db or default_db_path(args.base_dir),
+                              [os.path.join(results_root, f'cope{c}') for c in contrasts],
+                              args.data_source, args.task)
+            logger.info("Batch group-level analysis completed successfully")
+            return 0
+
         logger.info("Starting unified group-level analysis pipeline")
         logger.info(f"Task: {args.task}")
         logger.info(f"Contrast: {args.contrast}")
         logger.info(f"Analysis type: {args.analysis_type}")
         logger.info(f"Data source: {args.data_source}")
+        logger.info(f"Engine: {args.engine}")
         logger.info(f"Base directory: {args.base_dir}")
         
         # Get file paths
@@ -555,7 +782,13 @@ Examples:
             return 1
         
         # Run the workflow
-        run_group_level_workflow(args.task, args.contrast, args.analysis_type, paths, data_source_config)
+        with ExitStack() as stack:
+            run_paths = stage_group_paths(stack, paths) if args.stage_local else paths
+            run_group_level_workflow(args.task, args.contrast, args.analysis_type, run_paths, data_source_config,
+                                     engine=args.engine, adaptive_perm=args.adaptive_perm,
+                                     cluster_engine=args.cluster_engine, retention=args.retention)
+        update_results_db(args.results_db or default_db_path(args.base_dir), [paths['result_dir']],
+                          'custom' if args.custom_paths else args.data_source, args.task)
         
         logger.info("Group-level analysis pipeline completed successfully")
         return 0
@@ -16,6 +16,7 @@ Usage:
     python run_pre_group_level.py --filter-column guess --filter-value High
     python run_pre_group_level.py --filter-column Drug --filter-value Placebo --include-columns group_id,drug_id
     python run_pre_group_level.py --filter-column Drug --filter-value Placebo --output-dir /custom/path
+    python run_pre_group_level.py --phase phase2 --cope 1 --stage-local
 
 Author: Xiaoqian Xiao (xiao.xiaoqian.320@gmail.com)
 """
@@ -36,6 +37,14 @@ from nipype import Workflow, Node
 from nipype.interfaces.utility import IdentityInterface
 from nipype.interfaces.io import DataSink
 from group_level_workflows import wf_data_prepare
+from pre_group_merge import (merge_all_contrasts, derive_subset_merges, update_merged_contrasts,
+                             record_merge_manifest)
+from resampling import RESAMPLE_ENGINES, DEFAULT_ENGINE
+from result_promotion import promote_file, promote_tree, write_manifest
+from cope_store import build_cope_store, get_store_path, discard_stale_store
+from design_cache import compile_design, link_design, verify_design_subjects, subjects_from_files
+from scratch_staging import staged_workdir, stage_inputs
+from workdir_retention import RetentionMonitor, RETENTION_LEVELS, DEFAULT_RETENTION
 from templateflow.api import get as tpl_get, templates as get_tpl_list
 
 # Configure Nipype crash directory to a writable location
@@ -100,6 +109,8 @@ PROJECT_NAME = 'NARSAD'
 DATA_DIR = os.path.join(ROOT_DIR, PROJECT_NAME, 'MRI')
 DERIVATIVES_DIR = os.path.join(DATA_DIR, 'derivatives')
 SCRUBBED_DIR = os.getenv('SCRUBBED_DIR', '/scrubbed_dir')
+# Cached resampling weights, shared by all contrasts and jobs
+RESAMPLE_WEIGHT_DIR = os.path.join(SCRUBBED_DIR, PROJECT_NAME, 'work_flows/groupLevel_timeEffect/resample_weights')
 CONTAINER_PATH = "/gscratch/scrubbed/fanglab/xiaoqian/images/narsad-fmri_timeEffect_1.0.sif"
 
 # Define standard reference image (MNI152 template from FSL)
@@ -408,6 +419,43 @@ def collect_task_data(task, contrast, subject_list, glayout):
     
     return copes, varcopes
 
+def collect_task_data_all_contrasts(task, contrasts, subject_list, glayout):
+    """
+    Collect cope and varcope files for every contrast of a task in one query per subject.
+    
+    Args:
+        task (str): Task name (e.g., 'phase2', 'phase3')
+        contrasts (list): Contrast numbers to collect
+        subject_list (list): List of subject IDs
+        glayout (BIDSLayout): BIDS layout for first-level data
+    
+    Returns:
+        dict: {subject: {contrast: {'cope': path, 'varcope': path}}}, only
+              containing contrasts where both files were found
+    """
+    wanted = {f'{file_type}{contrast}': (contrast, file_type)
+              for contrast in contrasts for file_type in ('cope', 'varcope')}
+    subject_files = {}
+    
+    for sub in subject_list:
+        subject_files[sub] = {}
+        try:
+            for bids_file in glayout.get(subject=sub, task=task,
+                                         extension=['.nii', '.nii.gz']):
+                desc = bids_file.entities.get('desc')
+                if desc in wanted:
+                    contrast, file_type = wanted[desc]
+                    subject_files[sub].setdefault(contrast, {})[file_type] = bids_file.path
+        except Exception as e:
+            logger.error(f"Error collecting data for sub-{sub}, task-{task}: {e}")
+            continue
+        
+        # Keep only contrasts with both cope and varcope present
+        subject_files[sub] = {c: files for c, files in subject_files[sub].items()
+                              if 'cope' in files and 'varcope' in files}
+    
+    return subject_files
+
 def filter_subjects_for_task(subject_list, task, df_behav):
     """
     Filter subjects for a specific task, excluding those without MRI data.
@@ -439,7 +487,8 @@ def filter_subjects_for_task(subject_list, task, df_behav):
 # =============================================================================
 
 def run_data_preparation_workflow(task, contrast, group_info, copes, varcopes, 
-                                 contrast_results_dir, contrast_workflow_dir, include_columns):
+                                 contrast_results_dir, contrast_workflow_dir, include_columns,
+                                 resample_engine=DEFAULT_ENGINE, design_entry=None, retention=DEFAULT_RETENTION):
     """
     Run data preparation workflow for a specific task and contrast.
     
@@ -452,13 +501,25 @@ def run_data_preparation_workflow(task, contrast, group_info, copes, varcopes,
         contrast_results_dir (str): Results directory for this contrast
         contrast_workflow_dir (str): Workflow directory for this contrast
         include_columns (list): List of columns included in group_info
+        resample_engine (str): Engine for off-grid inputs, 'native' or 'fsl'
+        design_entry (str): Design cache entry from compile_design; if given, the
+                            workflow does not build its own design and the cached
+                            one is linked in after checking the collected subjects
+        retention (str): Working-directory retention level (workdir_retention)
     """
     try:
+        # Refuse inputs that do not match the compiled design
+        if design_entry:
+            verify_design_subjects(os.path.join(design_entry, 'design_files'), subjects_from_files(copes))
+        
         # Create workflow
         prepare_wf = wf_data_prepare(
             output_dir=contrast_results_dir,
             contrast=contrast,
-            name=f"data_prepare_{task}_cope{contrast}"
+            name=f"data_prepare_{task}_cope{contrast}",
+            resample_engine=resample_engine,
+            weight_cache_dir=RESAMPLE_WEIGHT_DIR,
+            compile_design=design_entry is None
         )
         
         # Set workflow parameters
@@ -492,11 +553,20 @@ def run_data_preparation_workflow(task, contrast, group_info, copes, varcopes,
         logger.info(f"Workflow crash directory set to: {workflow_crash_dir}")
         
         logger.info(f"Running data preparation for task-{task}, contrast-{contrast}")
-        prepare_wf.run(plugin='MultiProc', plugin_args={'n_procs': 4})
+        monitor = RetentionMonitor(prepare_wf, retention)
+        try:
+            prepare_wf.run(plugin='MultiProc', plugin_args={'n_procs': 4, 'status_callback': monitor})
+        except Exception:
+            monitor.finalize(success=False)
+            raise
         logger.info(f"Completed data preparation for task-{task}, contrast-{contrast}")
         
-        # Copy results from workflow directory to final results directory
-        logger.info(f"Copying results from workflow directory to final results directory")
+        if design_entry:
+            design_dir = link_design(design_entry, contrast_results_dir)
+            logger.info(f"Linked cached design into {design_dir}")
+        
+        # Promote results from workflow directory to final results directory
+        logger.info(f"Promoting results from workflow directory to final results directory")
         
         # Get the workflow output directory
         workflow_output_dir = os.path.join(contrast_workflow_dir, prepare_wf.name)
@@ -506,59 +576,183 @@ def run_data_preparation_workflow(task, contrast, group_info, copes, varcopes,
             final_results_dir = contrast_results_dir
             Path(final_results_dir).mkdir(parents=True, exist_ok=True)
             
-            # Copy all files from workflow output to final results
-            import shutil
-            import glob
+            # Hardlink (or copy across devices) workflow outputs into the final results
+            records = []
             try:
-                # Copy merged files
+                # Promote merged files
                 for file_pattern in ['merged_cope*.nii.gz', 'merged_varcope*.nii.gz']:
                     for file_path in glob.glob(os.path.join(workflow_output_dir, file_pattern)):
                         filename = os.path.basename(file_path)
                         dest_path = os.path.join(final_results_dir, filename)
-                        shutil.copy2(file_path, dest_path)
-                        logger.info(f"Copied {filename} to {dest_path}")
+                        record = promote_file(file_path, dest_path, mode='link')
+                        records.append(record)
+                        logger.info(f"Promoted ({record['method']}) {filename} to {dest_path}")
                 
-                # Copy design files
+                # Promote design files
                 design_source_dir = os.path.join(workflow_output_dir, 'design_files')
                 if os.path.exists(design_source_dir):
                     design_dest_dir = os.path.join(final_results_dir, 'design_files')
-                    if os.path.exists(design_dest_dir):
-                        shutil.rmtree(design_dest_dir)
-                    shutil.copytree(design_source_dir, design_dest_dir)
-                    logger.info(f"Copied design files to {design_dest_dir}")
+                    records.extend(promote_tree(design_source_dir, design_dest_dir, mode='link'))
+                    logger.info(f"Promoted design files to {design_dest_dir}")
                 
-                logger.info(f"Successfully copied all results to: {final_results_dir}")
+                if records:
+                    write_manifest(final_results_dir, records)
+                logger.info(f"Successfully promoted all results to: {final_results_dir}")
                 
             except Exception as e:
-                logger.error(f"Failed to copy results: {e}")
+                logger.error(f"Failed to promote results: {e}")
                 raise
         else:
             logger.warning(f"Workflow output directory not found: {workflow_output_dir}")
         
+        # Results are in place; apply the final retention pass to the node directories
+        monitor.finalize()
+        
     except Exception as e:
         logger.error(f"Failed to run data preparation workflow for task-{task}, contrast-{contrast}: {e}")
         raise
 
-def cleanup_intermediate_directories(contrast_workflow_dir):
+def run_single_pass_preparation(task, contrasts, group_info, subject_files, task_results_dir,
+                                resample_engine=DEFAULT_ENGINE, design_entry=None, incremental=False):
     """
-    Clean up intermediate workflow directories to save space.
+    Prepare every contrast of a task in a single pass over the subjects.
+    
+    Each subject's copes and varcopes are read once and written volume by volume
+    into preallocated merged_cope/merged_varcope outputs for all contrasts, and
+    the task's design (compiled once) is linked next to each contrast. The
+    subject order of the merged outputs is recorded in the task's merge manifest.
+    
+    With incremental, existing merged outputs are updated instead: unchanged
+    subjects' volumes are copied from them, and only added or changed subjects'
+    first-level files are read (pre_group_merge.update_merged_contrasts).
     
     Args:
-        contrast_workflow_dir (str): Workflow directory to clean
+        task (str): Task name
+        contrasts (list): Contrast numbers to prepare
+        group_info (list): Group information for subjects (subject ID first)
+        subject_files (dict): Output of collect_task_data_all_contrasts
+        task_results_dir (str): Results directory for this task
+        resample_engine (str): Engine for off-grid inputs, 'native' or 'fsl'
+        design_entry (str): Design cache entry from compile_design
+        incremental (bool): Update the existing merged outputs instead of merging from scratch
+    
+    Returns:
+        list: Contrasts that were prepared
     """
-    intermediate_dirs = [
-        'merge_copes', 'merge_varcopes', 
-        'resample_copes', 'resample_varcopes'
-    ]
+    subjects = [info[0] for info in group_info]
+    if design_entry:
+        verify_design_subjects(os.path.join(design_entry, 'design_files'), subjects)
     
-    for dir_name in intermediate_dirs:
-        dir_path = os.path.join(contrast_workflow_dir, dir_name)
-        if os.path.exists(dir_path):
-            try:
-                shutil.rmtree(dir_path)
-                logger.debug(f"Cleaned up intermediate directory: {dir_path}")
-            except Exception as e:
-                logger.warning(f"Failed to clean up {dir_path}: {e}")
+    # Only merge contrasts that are complete for every subject
+    complete_contrasts = []
+    for contrast in contrasts:
+        missing = [sub for sub in subjects if contrast not in subject_files.get(sub, {})]
+        if missing:
+            logger.warning(f"Skipping contrast {contrast}: missing cope/varcope for subjects {missing}")
+        else:
+            complete_contrasts.append(contrast)
+    
+    if not complete_contrasts:
+        logger.warning(f"No complete contrasts for task {task}, nothing to merge")
+        return []
+    
+    if incremental:
+        logger.info(f"Incremental merge for task-{task}: {len(subjects)} subjects, "
+                    f"{len(complete_contrasts)} contrasts")
+        update_merged_contrasts(subject_files, subjects, complete_contrasts, task_results_dir, GROUP_MASK,
+                                resample_engine, RESAMPLE_WEIGHT_DIR)
+    else:
+        logger.info(f"Single-pass merge for task-{task}: {len(subjects)} subjects, "
+                    f"{len(complete_contrasts)} contrasts")
+        merge_all_contrasts(subject_files, subjects, complete_contrasts, task_results_dir, GROUP_MASK,
+                            resample_engine, RESAMPLE_WEIGHT_DIR)
+        record_merge_manifest(task_results_dir, subject_files, subjects, complete_contrasts)
+    
+    # A store built from the previous merged files would now disagree with them
+    discard_stale_store(get_store_path(task_results_dir, task))
+    
+    for contrast in complete_contrasts:
+        contrast_dir = os.path.join(task_results_dir, f'cope{contrast}')
+        if design_entry:
+            link_design(design_entry, contrast_dir)
+        else:
+            from group_level_workflows import create_dummy_design_files
+            create_dummy_design_files(group_info, contrast_dir)
+    
+    logger.info(f"Completed single-pass data preparation for task-{task}")
+    return complete_contrasts
+
+def run_subset_preparation(task, contrasts, group_info, task_results_dir, standard_task_dir, design_entry):
+    """
+    Prepare a subset data source (placebo, guess) from the standard pre-group outputs.
+    
+    The subset's merged copes/varcopes are built by selecting its subjects'
+    volumes from the standard run (cope store if present, merged files
+    otherwise); only the subset's design is compiled.
+    
+    Args:
+        task (str): Task name
+        contrasts (list): Contrast numbers to prepare
+        group_info (list): Subset group information (subject ID first)
+        task_results_dir (str): Subset results directory for this task
+        standard_task_dir (str): Standard results directory for this task
+        design_entry (str): Subset design cache entry from compile_design
+    
+    Returns:
+        list: Contrasts that were prepared
+    """
+    subjects = [info[0] for info in group_info]
+    store_file = get_store_path(standard_task_dir, task)
+    logger.info(f"Deriving task-{task} subset ({len(subjects)} subjects) from {standard_task_dir}")
+    
+    derived = derive_subset_merges(standard_task_dir, task_results_dir, subjects, contrasts,
+                                   store_file=store_file)
+    for contrast in derived:
+        link_design(design_entry, os.path.join(task_results_dir, f'cope{contrast}'))
+    
+    logger.info(f"Completed subset data preparation for task-{task}: {len(derived)} contrasts")
+    return derived
+
+def build_task_store(task, contrasts, group_info, task_results_dir, metadata):
+    """
+    Pack a task's merged copes/varcopes into one chunked subjects x contrasts x voxels store.
+    
+    Only contrasts whose merged files exist are included. Callers pass every
+    contrast of the task (also with --cope), so rebuilding after merging one
+    cope keeps the other copes' merged outputs in the store.
+    
+    Args:
+        task (str): Task name
+        contrasts (list): Contrast numbers to consider
+        group_info (list): Group information for subjects (subject ID first)
+        task_results_dir (str): Results directory for this task
+        metadata (pandas.DataFrame): Behavioral data for the task's subjects
+    
+    Returns:
+        str: Path to the store, or None if no contrast was available
+    """
+    import nibabel as nib
+    
+    subjects = [info[0] for info in group_info]
+    available = []
+    for c in contrasts:
+        merged_files = [os.path.join(task_results_dir, f'cope{c}', f'merged_{t}.nii.gz') for t in ('cope', 'varcope')]
+        if not all(os.path.exists(f) for f in merged_files):
+            continue
+        # Copes merged for another subject list (e.g. an earlier run) stay out of the store
+        shapes = [nib.load(f).shape for f in merged_files]
+        n_volumes = [shape[3] if len(shape) == 4 else 1 for shape in shapes]
+        if any(n != len(subjects) for n in n_volumes):
+            logger.warning(f"cope{c} merged outputs have {n_volumes} volumes, not {len(subjects)}; "
+                           f"leaving it out of the cope store")
+            continue
+        available.append(c)
+    if not available:
+        logger.warning(f"No merged contrasts found for task {task}, not building a cope store")
+        return None
+    
+    logger.info(f"Building cope store for task-{task}: {len(subjects)} subjects, {len(available)} contrasts")
+    return build_cope_store(task_results_dir, task, available, subjects, GROUP_MASK, metadata=metadata)
 
 # =============================================================================
 # MAIN EXECUTION
@@ -607,6 +801,18 @@ Examples:
   
   # Process specific subject
   python run_pre_group_voxelWise.py --subject N101 --phase phase2 --include-columns "subID,group_id,drug_id"
+  
+  # Merge all contrasts of a phase in one pass (one job per phase)
+  python run_pre_group_voxelWise.py --phase phase2 --single-pass --include-columns "subID,group_id,drug_id"
+  
+  # After adding or excluding subjects, update the merged outputs instead of re-merging
+  python run_pre_group_voxelWise.py --phase phase2 --single-pass --incremental
+  
+  # Also build the chunked cope store used by ROI and subset analyses
+  python run_pre_group_voxelWise.py --phase phase2 --single-pass --build-store
+  
+  # Derive the placebo subset from the standard outputs instead of re-merging
+  python run_pre_group_voxelWise.py --phase phase2 --data-source placebo --from-standard
         """
     )
     
@@ -668,6 +874,55 @@ Examples:
         help='Specific cope number to process (e.g., 1, 2, 3)'
     )
     
+    parser.add_argument(
+        '--single-pass',
+        action='store_true',
+        help='Merge all contrasts of each task in one pass over subjects instead of one workflow per contrast'
+    )
+    
+    parser.add_argument(
+        '--incremental',
+        action='store_true',
+        help='With --single-pass, update the existing merged outputs: keep unchanged subjects\' volumes, '
+             'append added subjects, drop excluded ones (order follows group_info, see merge_manifest.json)'
+    )
+    
+    parser.add_argument(
+        '--resample-engine',
+        choices=RESAMPLE_ENGINES,
+        default=DEFAULT_ENGINE,
+        help='Engine for inputs that are off the group mask grid: fsl (FLIRT, default) or native (cached trilinear weights)'
+    )
+    
+    parser.add_argument(
+        '--from-standard',
+        action='store_true',
+        help='For placebo/guess data sources, select subjects from the standard merged outputs '
+             '(or cope store) instead of collecting and merging first-level files again'
+    )
+    
+    parser.add_argument(
+        '--build-store',
+        action='store_true',
+        help='Also pack each task\'s merged copes/varcopes into one chunked HDF5 store (subjects x contrasts x voxels). '
+             'With --cope the store is rebuilt from every merged cope of the task, not only that one'
+    )
+    
+    parser.add_argument(
+        '--retention',
+        default=DEFAULT_RETENTION,
+        choices=RETENTION_LEVELS,
+        help='Working-directory retention: keep-all, keep-restartable (drop outputs no node reads) '
+             'or results-only (drop node directories once results are promoted)'
+    )
+    
+    parser.add_argument(
+        '--stage-local',
+        action='store_true',
+        help='Run each per-contrast workflow on node-local scratch ($TMPDIR) with a resumable '
+             'handoff to the shared workflow directory on preemption'
+    )
+    
     args = parser.parse_args()
     
     # Debug: Log all received arguments
@@ -678,7 +933,14 @@ Examples:
         parser.error("--filter-column requires --filter-value")
     if args.filter_value and not args.filter_column:
         parser.error("--filter-value requires --filter-column")
-    
+    if args.from_standard and args.data_source == 'standard':
+        parser.error("--from-standard requires --data-source placebo or guess")
+    if args.incremental and not args.single_pass:
+        parser.error("--incremental requires --single-pass")
+    if args.stage_local and (args.single_pass or args.from_standard):
+        logger.info("--stage-local only applies to the per-contrast workflows; "
+                    "single-pass and subset modes run without a Nipype workflow")
+
     try:
         # Parse include_columns if provided
         include_columns = None
@@ -752,6 +1014,13 @@ Examples:
                 workflow_dir = base_workflow_dir
                 logger.info(f"Using standard workflow directory: {workflow_dir}")
         
+        # Designs are shared by all contrasts (and cached across data sources) under whole_brain
+        if args.data_source and args.data_source != 'standard':
+            design_cache_root = os.path.join(os.path.dirname(results_dir), 'design_cache')
+        else:
+            design_cache_root = os.path.join(results_dir, 'design_cache')
+        logger.info(f"Design cache: {design_cache_root}")
+        
         # Create workflow directory (use temporary location to avoid read-only issues)
         Path(workflow_dir).mkdir(parents=True, exist_ok=True)
         logger.info(f"Workflow directory: {workflow_dir}")
@@ -858,6 +1127,32 @@ Examples:
             else:
                 logger.info(f"Task {task}: Processing contrasts {task_contrast_range[0]}-{task_contrast_range[-1]} (total: {len(task_contrast_range)})")
             
+            # Compile the design once for this subject set; every contrast links to it
+            design_entry = compile_design(
+                group_info, task, args.data_source, design_cache_root, processing_columns
+            )
+            
+            # Subset mode: index the standard merged outputs instead of re-merging
+            if args.from_standard:
+                standard_task_dir = os.path.join(os.path.dirname(results_dir), f'task-{task}')
+                run_subset_preparation(
+                    task, task_contrast_range, group_info, task_results_dir, standard_task_dir, design_entry
+                )
+                continue
+            
+            # Single-pass mode: read each subject once and merge all contrasts together
+            if args.single_pass:
+                subject_files = collect_task_data_all_contrasts(
+                    task, task_contrast_range, [info[0] for info in group_info], glayout
+                )
+                run_single_pass_preparation(
+                    task, task_contrast_range, group_info, subject_files, task_results_dir,
+                    args.resample_engine, design_entry, args.incremental
+                )
+                if args.build_store:
+                    build_task_store(task, get_contrast_range(task), group_info, task_results_dir, task_group_info_df)
+                continue
+            
             # Process each contrast
             for contrast in task_contrast_range:
                 logger.info(f"Processing contrast {contrast}")
@@ -893,11 +1188,19 @@ Examples:
                                   f"got copes={len(copes)}, varcopes={len(varcopes)}")
                     continue
                 
-                # Run data preparation workflow
-                run_data_preparation_workflow(
-                    task, contrast, group_info, copes, varcopes,
-                    contrast_results_dir, contrast_workflow_dir, final_include_columns
-                )
+                # Run data preparation workflow (merged files are promoted straight to the results)
+                with staged_workdir(contrast_workflow_dir, enabled=args.stage_local) as run_workflow_dir:
+                    if args.stage_local:
+                        copes = stage_inputs(copes, run_workflow_dir)
+                        varcopes = stage_inputs(varcopes, run_workflow_dir)
+                    run_data_preparation_workflow(
+                        task, contrast, group_info, copes, varcopes,
+                        contrast_results_dir, run_workflow_dir, final_include_columns,
+                        args.resample_engine, design_entry, args.retention
+                    )
+            
+            if args.build_store:
+                build_task_store(task, get_contrast_range(task), group_info, task_results_dir, task_group_info_df)
                 
 
         
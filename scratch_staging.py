@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+"""
+Node-local scratch staging for the SLURM entry points.
+
+Nipype writes thousands of small files per workflow (result pickles, hash
+files, reports, crash files); with the workflow base directories on the
+shared scratch filesystem every one of them is a metadata operation on the
+shared servers. staged_workdir runs a workflow in a node-local directory
+instead and only touches the shared working directory at the end:
+
+    with staged_workdir(shared_workflow_dir, outputs=('crash-*.pklz',)) as local_dir:
+        inputs = stage_inputs(inputs, local_dir)
+        wf.base_dir = local_dir
+        wf.run()
+
+- stage_inputs copies the input files into the local directory (under
+  _staged_inputs/, mirroring their absolute paths so BIDS entities and
+  subject IDs in the paths are kept).
+- On success only the declared output patterns are copied back to the
+  shared directory and the local directory is removed.
+- If the job is preempted (SIGTERM, as on the ckpt partitions) or fails,
+  the local working directory (without the staged inputs, which are copied
+  again) is archived into <shared_dir>/.stage_handoff.tar. The archive is
+  written under a temporary name and renamed into place, so a kill during
+  the handoff leaves the previous archive intact. The next run of the same
+  job restores it before starting, and Nipype picks up the cached nodes.
+
+The local directory is derived from the shared directory path, so a resumed
+job sees the same absolute paths as the preempted one; this is what lets
+Nipype reuse its cache. STAGE_LOCAL_ROOT must therefore resolve to the same
+path on every node; set it explicitly if $TMPDIR is job-specific.
+
+Environment:
+    STAGE_LOCAL_ROOT    local staging root (default: $TMPDIR, else /tmp)
+
+Author: Xiaoqian Xiao (xiao.xiaoqian.320@gmail.com)
+"""
+
+import os
+import sys
+import glob
+import shutil
+import signal
+import hashlib
+import logging
+import tarfile
+import tempfile
+from contextlib import contextmanager
+
+from result_promotion import promote_file
+
+logger = logging.getLogger(__name__)
+
+# =============================================================================
+# CONSTANTS
+# =============================================================================
+
+STAGE_LOCAL_ROOT = os.getenv('STAGE_LOCAL_ROOT', os.getenv('TMPDIR', tempfile.gettempdir()))
+HANDOFF_NAME = '.stage_handoff.tar'
+STAGED_INPUTS_DIR = '_staged_inputs'
+HANDOFF_SIGNALS = (signal.SIGTERM,)
+
+# Synced back on success and failure alike, in addition to each caller's outputs
+DEFAULT_OUTPUTS = ('crash-*.pklz', 'crash-*.txt', 'nipype_crashes')
+
+# Stages active in this process, innermost last: (local_dir, shared_dir, outputs)
+_ACTIVE = []
+_OWNER_PID = None
+_PREVIOUS_HANDLERS = {}
+
+# =============================================================================
+# PATHS AND INPUTS
+# =============================================================================
+
+def local_dir_for(shared_dir, local_root=None):
+    """Stable node-local directory standing in for a shared working directory."""
+    shared_dir = os.path.abspath(shared_dir)
+    key = hashlib.sha1(shared_dir.encode()).hexdigest()[:16]
+    return os.path.join(local_root or STAGE_LOCAL_ROOT, 'narsad_stage',
+                        f'{os.path.basename(shared_dir)}_{key}')
+
+
+def handoff_path(shared_dir):
+    """Handoff archive of a shared working directory."""
+    return os.path.join(shared_dir, HANDOFF_NAME)
+
+
+def stage_file(path, local_dir):
+    """
+    Copy one input file into the local directory, reusing an up-to-date copy.
+
+    The copy keeps the source's modification time, so Nipype's timestamp
+    hashes of staged inputs are the same in every run of the job.
+
+    Returns:
+        str: Local path of the file
+    """
+    src = os.path.abspath(path)
+    dst = os.path.join(local_dir, STAGED_INPUTS_DIR, src.lstrip(os.sep))
+    st = os.stat(src)
+    if os.path.exists(dst):
+        dst_st = os.stat(dst)
+        if dst_st.st_size == st.st_size and int(dst_st.st_mtime) == int(st.st_mtime):
+            return dst
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    tmp = f'{dst}.partial'
+    shutil.copy2(src, tmp)
+    os.replace(tmp, dst)
+    return dst
+
+
+def stage_inputs(inputs, local_dir):
+    """
+    Stage every existing file referenced by an input structure.
+
+    Dicts, lists and tuples are walked recursively; strings naming existing
+    files are replaced by their staged copies, all other values are returned
+    unchanged.
+
+    Args:
+        inputs: Input path, or dict/list/tuple of them (e.g. the first-level inputs dict)
+        local_dir (str): Staging directory from staged_workdir
+
+    Returns:
+        Same structure with local paths
+    """
+    if isinstance(inputs, dict):
+        return {key: stage_inputs(value, local_dir) for key, value in inputs.items()}
+    if isinstance(inputs, (list, tuple)):
+        return type(inputs)(stage_inputs(value, local_dir) for value in inputs)
+    if isinstance(inputs, str) and os.path.isfile(inputs):
+        return stage_file(inputs, local_dir)
+    return inputs
+
+# =============================================================================
+# HANDOFF AND SYNC
+# =============================================================================
+
+def _exclude_staged_inputs(tarinfo):
+    """tarfile filter dropping the staged inputs (they are copied again on resume)."""
+    parts = tarinfo.name.split('/')
+    return None if len(parts) > 1 and parts[1] == STAGED_INPUTS_DIR else tarinfo
+
+
+def write_handoff(local_dir, shared_dir):
+    """
+    Archive a local working directory into the shared directory's handoff file.
+
+    Returns:
+        str: Handoff archive path
+    """
+    os.makedirs(shared_dir, exist_ok=True)
+    archive = handoff_path(shared_dir)
+    tmp = f'{archive}.{os.getpid()}.partial'
+    with tarfile.open(tmp, 'w') as tar:
+        tar.add(local_dir, arcname='.', filter=_exclude_staged_inputs)
+    os.replace(tmp, archive)
+    logger.info(f"Handed off {local_dir} to {archive}")
+    return archive
+
+
+def restore_handoff(shared_dir, local_dir):
+    """
+    Restore a previous run's handoff archive into the local directory.
+
+    Returns:
+        bool: Whether an archive was restored
+    """
+    archive = handoff_path(shared_dir)
+    if not os.path.exists(archive):
+        return False
+    os.makedirs(local_dir, exist_ok=True)
+    with tarfile.open(archive) as tar:
+        if hasattr(tarfile, 'data_filter'):
+            tar.extractall(local_dir, filter='data')
+        else:
+            tar.extractall(local_dir)
+    logger.info(f"Restored handoff {archive} into {local_dir}")
+    return True
+
+
+def sync_outputs(local_dir, shared_dir, patterns):
+    """
+    Copy the files matching the declared output patterns back to the shared directory.
+
+    Patterns are globs relative to the local directory ('**' allowed); a
+    matching directory is copied with everything below it. Files are copied
+    atomically to the same relative path.
+
+    Returns:
+        list: Relative paths of the synced files
+    """
+    synced = []
+    for pattern in patterns:
+        for match in sorted(glob.glob(os.path.join(local_dir, pattern), recursive=True)):
+            if os.path.isdir(match):
+                files = [os.path.join(root, name) for root, _, names in os.walk(match) for name in names]
+            else:
+                files = [match]
+            for path in files:
+                rel = os.path.relpath(path, local_dir)
+                if rel.split(os.sep)[0] == STAGED_INPUTS_DIR or rel in synced:
+                    continue
+                promote_file(path, os.path.join(shared_dir, rel), mode='copy', checksum=False)
+                synced.append(rel)
+    if synced:
+        logger.info(f"Synced {len(synced)} output file(s) from {local_dir} to {shared_dir}")
+    return synced
+
+# =============================================================================
+# STAGING CONTEXT
+# =============================================================================
+
+def _hand_off_active():
+    """Hand off every active stage of this process, innermost first."""
+    for local_dir, shared_dir, outputs in reversed(_ACTIVE):
+        try:
+            sync_outputs(local_dir, shared_dir, outputs)
+            write_handoff(local_dir, shared_dir)
+        except Exception as e:
+            logger.error(f"Handoff of {local_dir} to {shared_dir} failed: {e}")
+
+
+def _on_signal(signum, frame):
+    """Preemption handler: hand off, then exit with the conventional status."""
+    if os.getpid() != _OWNER_PID:
+        # Forked workers (Nipype MultiProc) inherit the handler; they just terminate
+        signal.signal(signum, signal.SIG_DFL)
+        os.kill(os.getpid(), signum)
+        return
+    logger.warning(f"Received signal {signum}; handing off staged work directories")
+    _hand_off_active()
+    _ACTIVE.clear()
+    sys.exit(128 + signum)
+
+
+@contextmanager
+def staged_workdir(shared_dir, outputs=(), local_root=None, enabled=True):
+    """
+    Run a block in a node-local stand-in for a shared working directory.
+
+    Args:
+        shared_dir (str): Working directory on the shared filesystem
+        outputs (tuple): Glob patterns (relative to the working directory) to sync back;
+                         DEFAULT_OUTPUTS are always included
+        local_root (str): Staging root (default: STAGE_LOCAL_ROOT)
+        enabled (bool): If False, yield shared_dir unchanged (no staging)
+
+    Yields:
+        str: Directory to use as the working directory
+    """
+    global _OWNER_PID
+    if not enabled:
+        yield shared_dir
+        return
+
+    shared_dir = os.path.abspath(shared_dir)
+    local_dir = local_dir_for(shared_dir, local_root)
+    outputs = tuple(DEFAULT_OUTPUTS) + tuple(outputs)
+    os.makedirs(local_dir, exist_ok=True)
+    restore_handoff(shared_dir, local_dir)
+    logger.info(f"Staging {shared_dir} in {local_dir}")
+
+    if not _ACTIVE:
+        _OWNER_PID = os.getpid()
+        for signum in HANDOFF_SIGNALS:
+            _PREVIOUS_HANDLERS[signum] = signal.signal(signum, _on_signal)
+    stage = (local_dir, shared_dir, outputs)
+    _ACTIVE.append(stage)
+    try:
+        yield local_dir
+    except BaseException:
+        if stage in _ACTIVE:
+            _ACTIVE.remove(stage)
+            try:
+                sync_outputs(local_dir, shared_dir, outputs)
+                write_handoff(local_dir, shared_dir)
+            except Exception as e:
+                logger.error(f"Handoff of {local_dir} to {shared_dir} failed: {e}")
+        raise
+    else:
+        _ACTIVE.remove(stage)
+        sync_outputs(local_dir, shared_dir, outputs)
+        archive = handoff_path(shared_dir)
+        if os.path.exists(archive):
+            os.remove(archive)
+        shutil.rmtree(local_dir, ignore_errors=True)
+        logger.info(f"Staged run of {shared_dir} complete; removed {local_dir}")
+    finally:
+        if stage in _ACTIVE:
+            _ACTIVE.remove(stage)
+        if not _ACTIVE and _PREVIOUS_HANDLERS and os.getpid() == _OWNER_PID:
+            for signum, handler in _PREVIOUS_HANDLERS.items():
+                signal.signal(signum, handler)
+            _PREVIOUS_HANDLERS.clear()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Test script to validate the completion ledger (completion_ledger.py):
+fingerprints, ledger entries and the up-to-date check that decides which
+jobs are skipped.
+"""
+
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+from completion_ledger import compute_fingerprint, write_entry, read_entry, is_up_to_date, entry_path
+
+
+def write_file(path, text):
+    """Write a small text file."""
+    with open(path, 'w') as f:
+        f.write(text)
+    return path
+
+
+def make_job(work_dir):
+    """Inputs, parameters and one output of a completed unit of work."""
+    files = {'bold': write_file(os.path.join(work_dir, 'bold.nii.gz'), 'bold data'),
+             'events': write_file(os.path.join(work_dir, 'events.tsv'), 'onset\tduration\n0\t1\n')}
+    params = {'task': 'phase2', 'contrasts': [1, 2]}
+    output = write_file(os.path.join(work_dir, 'cope1.nii.gz'), 'cope')
+    return files, params, output
+
+
+def test_round_trip():
+    """A recorded job is up to date until an input, the parameters or an output change."""
+    work_dir = tempfile.mkdtemp()
+    try:
+        ledger_dir = os.path.join(work_dir, 'ledger')
+        files, params, output = make_job(work_dir)
+        fingerprint, inputs = compute_fingerprint(files, params)
+        write_entry(ledger_dir, 'sub_N101', fingerprint, inputs, params, [output])
+
+        entry = read_entry(ledger_dir, 'sub_N101')
+        assert entry['key'] == 'sub_N101' and entry['params'] == params
+        assert is_up_to_date(entry, compute_fingerprint(files, params, entry)[0])
+        assert read_entry(ledger_dir, 'sub_N102') is None
+        assert not is_up_to_date(None, fingerprint)
+
+        # Touching an input keeps the fingerprint (content only)
+        st = os.stat(files['bold'])
+        os.utime(files['bold'], ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+        assert compute_fingerprint(files, params, entry)[0] == fingerprint
+
+        # Changed parameters or input content invalidate the entry
+        assert not is_up_to_date(entry, compute_fingerprint(files, dict(params, contrasts=[1]), entry)[0])
+        write_file(files['events'], 'onset\tduration\n5\t1\n')
+        changed = compute_fingerprint(files, params, entry)[0]
+        assert changed != fingerprint and not is_up_to_date(entry, changed)
+        print("✅ Fingerprints follow input content and parameters")
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def test_outputs_checked():
+    """A matching fingerprint is not enough when an output was truncated or removed."""
+    work_dir = tempfile.mkdtemp()
+    try:
+        ledger_dir = os.path.join(work_dir, 'ledger')
+        files, params, output = make_job(work_dir)
+        fingerprint, inputs = compute_fingerprint(files, params)
+        write_entry(ledger_dir, 'sub_N101', fingerprint, inputs, params, [output])
+        entry = read_entry(ledger_dir, 'sub_N101')
+        assert is_up_to_date(entry, fingerprint)
+
+        write_file(output, 'cop')
+        assert not is_up_to_date(entry, fingerprint)
+        os.remove(output)
+        assert not is_up_to_date(entry, fingerprint)
+
+        # Entries without outputs never count as complete
+        write_entry(ledger_dir, 'sub_N102', fingerprint, inputs, params, [])
+        assert not is_up_to_date(read_entry(ledger_dir, 'sub_N102'), fingerprint)
+        print("✅ Missing or changed outputs invalidate ledger entries")
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def test_digest_reuse_and_unreadable_entry():
+    """Unchanged inputs are not read again; corrupt entries are ignored."""
+    work_dir = tempfile.mkdtemp()
+    try:
+        ledger_dir = os.path.join(work_dir, 'ledger')
+        files, params, output = make_job(work_dir)
+        fingerprint, inputs = compute_fingerprint(files, params)
+        write_entry(ledger_dir, 'sub_N101', fingerprint, inputs, params, [output])
+        entry = read_entry(ledger_dir, 'sub_N101')
+
+        with mock.patch('completion_ledger.sha256_file', side_effect=AssertionError('input re-read')):
+            assert compute_fingerprint(files, params, entry)[0] == fingerprint
+
+        write_file(entry_path(ledger_dir, 'sub_N101'), '{"key": ')
+        assert read_entry(ledger_dir, 'sub_N101') is None
+        assert not [name for name in os.listdir(ledger_dir) if name.endswith('.partial')]
+        print("✅ Digests are reused and unreadable entries are ignored")
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == "__main__":
+    test_round_trip()
+    test_outputs_checked()
+    test_digest_reuse_and_unreadable_entry()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Test script to validate native GRF cluster inference (native_cluster.py):
+smoothness estimation, cluster p-values and cluster/local-maximum ordering.
+"""
+
+import math
+import numpy as np
+from scipy import ndimage
+
+from native_cluster import estimate_smoothness, grf_cluster_p, find_clusters
+
+SHAPE = (40, 40, 30)
+
+
+def smooth_noise(sigma, n=None, seed=0):
+    """Gaussian noise smoothed with a Gaussian kernel of sigma voxels (FWHM = 2.355 sigma)."""
+    rng = np.random.default_rng(seed)
+    shape = SHAPE + ((n,) if n else ())
+    noise = rng.normal(size=shape)
+    return ndimage.gaussian_filter(noise, sigma=(sigma,) * 3 + ((0,) if n else ()))
+
+
+def test_smoothness_single_map():
+    """A single 3D map gives the kernel FWHM, like residuals of the same smoothness."""
+    sigma = 2.0
+    expected = math.sqrt(8 * math.log(2)) * sigma
+    mask = np.zeros(SHAPE, dtype=bool)
+    mask[4:-4, 4:-4, 4:-4] = True
+
+    single = estimate_smoothness(smooth_noise(sigma) + 3.0, mask)
+    residuals = estimate_smoothness(smooth_noise(sigma, n=8, seed=1), mask)
+    for fwhm in (single['fwhm_voxels'], residuals['fwhm_voxels']):
+        assert all(abs(f - expected) / expected < 0.15 for f in fwhm), (fwhm, expected)
+    assert single['volume'] == int(mask.sum())
+    print(f"✅ Smoothness: single map FWHM {np.round(single['fwhm_voxels'], 2)}, "
+          f"residuals {np.round(residuals['fwhm_voxels'], 2)}, kernel {expected:.2f}")
+
+
+def test_grf_cluster_p():
+    """Cluster p-values match the GRF formula evaluated by hand."""
+    u, dlh, volume = 3.0, 0.05, 20000
+    # E[m] = V DLH (2 pi)^-2 (u^2 - 1) exp(-u^2 / 2)
+    expected_m = 20000 * 0.05 * (2 * math.pi) ** -2 * 8 * math.exp(-4.5)
+    # Phi(-3) = 0.0013498980316301
+    beta = (math.gamma(2.5) * expected_m / (20000 * 0.0013498980316301)) ** (2 / 3)
+    sizes = np.array([1, 10, 50])
+    expected = [1 - math.exp(-expected_m * math.exp(-beta * k ** (2 / 3))) for k in sizes]
+
+    p = grf_cluster_p(sizes, u, dlh, volume)
+    assert np.allclose(p, expected, rtol=1e-9), (p, expected)
+    assert p[0] > p[1] > p[2]
+    # Below u = 1 the expected Euler characteristic is not positive: nothing is significant
+    assert np.all(grf_cluster_p(sizes, 0.5, dlh, volume) == 1)
+    print(f"✅ GRF cluster p-values {np.round(p, 4)} match the hand computation")
+
+
+def test_cluster_ordering():
+    """The largest cluster gets the highest index; peaks are listed highest first."""
+    zstat = np.zeros((12, 6, 4))
+    mask = np.ones(zstat.shape, dtype=bool)
+    # Cluster A: 3 voxels along y
+    zstat[2, 1:4, 1] = [3.5, 4.0, 3.5]
+    # Cluster B: 8 voxels along x with two local maxima (5.0 and 6.0)
+    zstat[3:11, 5, 3] = [4.0, 5.0, 4.0, 3.0, 3.0, 4.0, 6.0, 4.0]
+
+    index, threshold, table, localmax = find_clusters(zstat, mask, z_threshold=2.3, dlh=0.01,
+                                                      volume=zstat.size, p_threshold=1.0)
+
+    assert set(np.unique(index)) == {0, 1, 2}
+    assert np.all(index[3:11, 5, 3] == 2) and np.all(index[2, 1:4, 1] == 1)
+    assert np.array_equal(threshold != 0, index > 0)
+
+    # Table rows: descending index, with size and peak of each cluster
+    assert [row[0] for row in table] == [2, 1]
+    assert table[0][1] == 8 and table[1][1] == 3
+    assert table[0][4] == 6.0 and tuple(table[0][5:]) == (9, 5, 3)
+    assert table[1][4] == 4.0 and tuple(table[1][5:]) == (2, 2, 1)
+    assert table[0][2] < table[1][2]
+
+    # Local maxima: per cluster, highest value first; shoulders are not maxima
+    assert localmax == [(2, 6.0, 9, 5, 3), (2, 5.0, 4, 5, 3), (1, 4.0, 2, 2, 1)], localmax
+    print("✅ Cluster indices, table and local maxima follow FSL cluster ordering")
+
+
+if __name__ == "__main__":
+    test_smoothness_single_map()
+    test_grf_cluster_p()
+    test_cluster_ordering()
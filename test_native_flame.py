@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Test script to validate the native mixed-effects estimator (native_flame.py)
+on synthetic data, and against FSL FLAMEO flame1 when FSL is installed.
+"""
+
+import os
+import shutil
+import subprocess
+import tempfile
+import numpy as np
+import nibabel as nib
+import pytest
+
+from native_flame import run_native_flame, fit_mixed_effects, restricted_nll
+
+N_PER_GROUP = 15
+SHAPE = (12, 12, 8)
+
+
+def write_vest(path, matrix, header=None):
+    """Write an FSL VEST text matrix."""
+    matrix = np.atleast_2d(matrix)
+    with open(path, 'w') as f:
+        f.write(f"/NumWaves {matrix.shape[1]}\n/NumPoints {matrix.shape[0]}\n")
+        if header:
+            f.write(header)
+        f.write("/Matrix\n")
+        for row in matrix:
+            f.write(' '.join(f'{v:g}' for v in row) + '\n')
+
+
+def make_dataset(out_dir, seed=0):
+    """Two groups with different between-subject variances and a group effect in one corner."""
+    rng = np.random.default_rng(seed)
+    n = 2 * N_PER_GROUP
+    design = np.zeros((n, 2))
+    design[:N_PER_GROUP, 0] = 1
+    design[N_PER_GROUP:, 1] = 1
+    groups = np.r_[np.ones(N_PER_GROUP), 2 * np.ones(N_PER_GROUP)]
+
+    varcope = rng.uniform(0.5, 2.0, SHAPE + (n,))
+    sigma2 = np.where(groups == 1, 1.0, 3.0)
+    effect = np.zeros(SHAPE + (n,))
+    effect[:6, :6, :4, :N_PER_GROUP] = 2.0
+    cope = effect + rng.normal(size=SHAPE + (n,)) * np.sqrt(varcope + sigma2)
+
+    affine = np.diag([2.0, 2.0, 2.0, 1.0])
+    files = {
+        'cope_file': os.path.join(out_dir, 'merged_cope.nii.gz'),
+        'var_cope_file': os.path.join(out_dir, 'merged_varcope.nii.gz'),
+        'mask_file': os.path.join(out_dir, 'mask.nii.gz'),
+        'design_file': os.path.join(out_dir, 'design.mat'),
+        'con_file': os.path.join(out_dir, 'contrast.con'),
+        'grp_file': os.path.join(out_dir, 'design.grp'),
+    }
+    nib.save(nib.Nifti1Image(cope.astype(np.float32), affine), files['cope_file'])
+    nib.save(nib.Nifti1Image(varcope.astype(np.float32), affine), files['var_cope_file'])
+    nib.save(nib.Nifti1Image(np.ones(SHAPE, dtype=np.uint8), affine), files['mask_file'])
+    write_vest(files['design_file'], design)
+    write_vest(files['con_file'], np.array([[1, -1], [-1, 1]]),
+               header="/ContrastName1 g1>g2\n/ContrastName2 g2>g1\n")
+    write_vest(files['grp_file'], groups[:, np.newaxis])
+    return files
+
+
+def test_variance_estimates():
+    """The golden-section estimates match a scalar optimiser voxel by voxel."""
+    from scipy.optimize import minimize_scalar
+
+    rng = np.random.default_rng(1)
+    n, n_vox = 30, 20
+    design = np.ones((n, 1))
+    varcope = rng.uniform(0.5, 2.0, (n, n_vox))
+    y = rng.normal(size=(n, n_vox)) * np.sqrt(varcope + 1.5)
+    fit = fit_mixed_effects(design, np.ones((1, 1)), np.ones(n, dtype=int), y, varcope, n_procs=1)
+
+    for v in range(n_vox):
+        result = minimize_scalar(
+            lambda s: restricted_nll(design, y[:, [v]], varcope[:, [v]], np.full((n, 1), s))[0],
+            bounds=(0, 50), method='bounded', options={'xatol': 1e-8})
+        assert abs(result.x - fit['mrev'][0, v]) < 1e-4, (v, result.x, fit['mrev'][0, v])
+    print("✅ Variance estimates match scalar optimisation")
+
+
+def test_synthetic_recovery():
+    """Group variances and the group effect are recovered on synthetic data."""
+    work_dir = tempfile.mkdtemp()
+    try:
+        files = make_dataset(work_dir)
+        outputs = run_native_flame(**files, out_dir=os.path.join(work_dir, 'native'), n_procs=2)
+
+        mrev = [nib.load(f).get_fdata().mean() for f in outputs['mrefvars']]
+        assert abs(mrev[0] - 1.0) < 0.3 and abs(mrev[1] - 3.0) < 0.6, mrev
+
+        zstat = nib.load(outputs['zstats'][0]).get_fdata()
+        assert zstat[:6, :6, :4].mean() > 2.5, zstat[:6, :6, :4].mean()
+        assert abs(zstat[6:, 6:, 4:].mean()) < 0.5, zstat[6:, 6:, 4:].mean()
+        z2 = nib.load(outputs['zstats'][1]).get_fdata()
+        assert np.allclose(zstat, -z2, atol=1e-5)
+        print(f"✅ Synthetic recovery: group variances {mrev[0]:.2f}/{mrev[1]:.2f}, "
+              f"effect z {zstat[:6, :6, :4].mean():.2f}")
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def test_against_flameo():
+    """zstats agree with FSL FLAMEO flame1 (skipped when FSL is not installed)."""
+    if shutil.which('flameo') is None:
+        pytest.skip("flameo not found; the FLAMEO comparison needs an FSL environment")
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        files = make_dataset(work_dir, seed=2)
+        native = run_native_flame(**files, out_dir=os.path.join(work_dir, 'native'), n_procs=2)
+        fsl_dir = os.path.join(work_dir, 'fsl')
+        subprocess.run(['flameo', f"--cope={files['cope_file']}", f"--vc={files['var_cope_file']}",
+                        f"--mask={files['mask_file']}", f"--ld={fsl_dir}", f"--dm={files['design_file']}",
+                        f"--tc={files['con_file']}", f"--cs={files['grp_file']}", '--runmode=flame1'],
+                       check=True, capture_output=True)
+
+        for k, native_file in enumerate(native['zstats'], start=1):
+            z_native = nib.load(native_file).get_fdata().ravel()
+            z_fsl = nib.load(os.path.join(fsl_dir, f'zstat{k}.nii.gz')).get_fdata().ravel()
+            corr = np.corrcoef(z_native, z_fsl)[0, 1]
+            max_diff = np.abs(z_native - z_fsl).max()
+            assert corr > 0.99 and max_diff < 0.5, (k, corr, max_diff)
+            print(f"✅ zstat{k} vs FLAMEO: r = {corr:.4f}, max |diff| = {max_diff:.3f}")
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == "__main__":
+    test_variance_estimates()
+    test_synthetic_recovery()
+    try:
+        test_against_flameo()
+    except pytest.skip.Exception as e:
+        print(f"⚠️  Skipped: {e}")
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+"""
+Test script to validate native permutation inference (native_randomise.py)
+on synthetic data.
+"""
+
+import os
+import glob
+import json
+import shutil
+import itertools
+import tempfile
+import numpy as np
+import nibabel as nib
+
+from native_randomise import (run_native_randomise, check_stopping, prepare_contrast, compute_t_batch,
+                              DEFAULT_STOPPING)
+
+N_SUBJECTS = 20
+SHAPE = (10, 10, 4)
+
+
+def write_vest(path, matrix, header=None):
+    """Write an FSL VEST text matrix."""
+    matrix = np.atleast_2d(matrix)
+    with open(path, 'w') as f:
+        f.write(f"/NumWaves {matrix.shape[1]}\n/NumPoints {matrix.shape[0]}\n")
+        if header:
+            f.write(header)
+        f.write("/Matrix\n")
+        for row in matrix:
+            f.write(' '.join(f'{v:g}' for v in row) + '\n')
+
+
+def make_one_sample(out_dir, seed=0):
+    """One-sample design with a positive effect graded across voxels; contrast 2 tests the opposite sign."""
+    rng = np.random.default_rng(seed)
+    n_vox = int(np.prod(SHAPE))
+    effect = np.linspace(0.3, 2.0, n_vox).reshape(SHAPE)
+    cope = effect[..., np.newaxis] + rng.normal(size=SHAPE + (N_SUBJECTS,))
+
+    affine = np.diag([2.0, 2.0, 2.0, 1.0])
+    files = {
+        'in_file': os.path.join(out_dir, 'merged_cope.nii.gz'),
+        'mask_file': os.path.join(out_dir, 'mask.nii.gz'),
+        'design_file': os.path.join(out_dir, 'design.mat'),
+        'con_file': os.path.join(out_dir, 'contrast.con'),
+    }
+    nib.save(nib.Nifti1Image(cope.astype(np.float32), affine), files['in_file'])
+    nib.save(nib.Nifti1Image(np.ones(SHAPE, dtype=np.uint8), affine), files['mask_file'])
+    write_vest(files['design_file'], np.ones((N_SUBJECTS, 1)))
+    write_vest(files['con_file'], np.array([[1], [-1]]),
+               header="/ContrastName1 positive\n/ContrastName2 negative\n")
+    return files
+
+
+def ols_t(y, design, contrast):
+    """Direct OLS t statistic of every column of y."""
+    beta = np.linalg.pinv(design) @ y
+    dof = y.shape[0] - np.linalg.matrix_rank(design)
+    sigma2 = np.sum((y - design @ beta) ** 2, axis=0) / dof
+    var_factor = contrast @ np.linalg.pinv(design.T @ design) @ contrast
+    return (contrast @ beta) / np.sqrt(sigma2 * var_factor)
+
+
+def test_t_matches_ols():
+    """Batched t statistics equal a direct OLS fit of the Freedman-Lane permuted data."""
+    rng = np.random.default_rng(4)
+    n = 12
+    design = np.zeros((n, 3))
+    design[:6, 0] = 1
+    design[6:, 1] = 1
+    design[:, 2] = rng.normal(size=n)
+    contrast = np.array([1.0, -1.0, 0.0])
+    y = rng.normal(size=(n, 30)) + design @ np.array([[0.5], [0.0], [0.3]])
+
+    state = prepare_contrast(y, design, contrast)
+    orders = np.vstack([np.arange(n), rng.permutation(n), rng.permutation(n)])
+    signs = np.vstack([np.ones(n), np.ones(n), rng.choice([1.0, -1.0], n)])
+    tstat = compute_t_batch(state, orders, signs)
+
+    # Nuisance part of the design (randomise's partitioning) and its hat matrix
+    nuisance = design @ (np.eye(3) - np.linalg.pinv(contrast[np.newaxis]) @ contrast[np.newaxis])
+    hat_z = nuisance @ np.linalg.pinv(nuisance)
+    resid_z = y - hat_z @ y
+    for b in range(len(orders)):
+        y_perm = signs[b][:, np.newaxis] * resid_z[orders[b]] + hat_z @ y
+        assert np.allclose(tstat[b], ols_t(y_perm, design, contrast), atol=1e-8), b
+    print("✅ Batched t statistics match direct OLS")
+
+
+def test_exhaustive_sign_flips():
+    """Exhaustive one-sample p-values equal a brute-force pass over all sign vectors."""
+    work_dir = tempfile.mkdtemp()
+    try:
+        n = 6
+        rng = np.random.default_rng(5)
+        data = rng.normal(size=(3, 3, 2, n)) + np.linspace(0, 1.5, 18).reshape(3, 3, 2, 1)
+        affine = np.eye(4)
+        files = {
+            'in_file': os.path.join(work_dir, 'merged_cope.nii.gz'),
+            'mask_file': os.path.join(work_dir, 'mask.nii.gz'),
+            'design_file': os.path.join(work_dir, 'design.mat'),
+            'con_file': os.path.join(work_dir, 'contrast.con'),
+        }
+        nib.save(nib.Nifti1Image(data.astype(np.float32), affine), files['in_file'])
+        nib.save(nib.Nifti1Image(np.ones((3, 3, 2), dtype=np.uint8), affine), files['mask_file'])
+        write_vest(files['design_file'], np.ones((n, 1)))
+        write_vest(files['con_file'], np.array([[1]]))
+
+        outputs = run_native_randomise(**files, out_dir=os.path.join(work_dir, 'native'), num_perm=100,
+                                       n_procs=1, tfce=False)
+
+        # Brute force: t = mean / (sd / sqrt(n)) for each of the 2^n sign vectors
+        y = np.asarray(nib.load(files['in_file']).dataobj, dtype=np.float64).reshape(-1, n, order='F').T
+        flips = np.asarray(list(itertools.product([1.0, -1.0], repeat=n)))
+        t_all = np.stack([(s[:, np.newaxis] * y).mean(0) / ((s[:, np.newaxis] * y).std(0, ddof=1) / np.sqrt(n))
+                          for s in flips])
+        observed = t_all[0]
+        p = np.mean(t_all >= observed - 1e-10, axis=0)
+        p_fwe = np.mean(t_all.max(axis=1)[:, np.newaxis] >= observed - 1e-10, axis=0)
+
+        def read(path):
+            return np.asarray(nib.load(path).dataobj, dtype=np.float64).reshape(-1, order='F')
+
+        assert np.allclose(read(outputs['tstat_files'][0]), observed, atol=1e-4)
+        assert np.allclose(1 - read(outputs['t_p_files'][0]), p, atol=1e-6)
+        assert np.allclose(1 - read(outputs['t_corrected_p_files'][0]), p_fwe, atol=1e-6)
+        print(f"✅ Exhaustive sign-flip p-values match brute force ({len(flips)} sign vectors)")
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def test_randomise_naming():
+    """Outputs use the randomise names that wf_randomise and Randomise's output globs expect."""
+    work_dir = tempfile.mkdtemp()
+    try:
+        files = make_one_sample(work_dir)
+        out_dir = os.path.join(work_dir, 'stats')
+        outputs = run_native_randomise(**files, out_dir=out_dir, num_perm=20, n_procs=1)
+
+        # nipype's Randomise lists t_corrected_p_files as <base>_tfce_corrp_tstat*.nii*
+        assert outputs['t_corrected_p_files'] == sorted(glob.glob(os.path.join(out_dir,
+                                                                               'randomise_tfce_corrp_tstat*.nii*')))
+        assert outputs['tstat_files'] == sorted(glob.glob(os.path.join(out_dir, 'randomise_tstat*.nii*')))
+        expected = {f'randomise_{kind}{k}.nii.gz' for k in (1, 2)
+                    for kind in ('tstat', 'tfce_p_tstat', 'tfce_corrp_tstat')}
+        assert set(os.listdir(out_dir)) == expected | {'randomise_permutations.json'}, os.listdir(out_dir)
+
+        corrp = np.asarray(nib.load(outputs['t_corrected_p_files'][0]).dataobj)
+        assert corrp.min() >= 0 and corrp.max() <= 1
+        print("✅ Native randomise outputs follow randomise naming")
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def test_adaptive_stopping():
+    """A contrast with voxels near threshold runs to the cap; a null contrast stops early."""
+    work_dir = tempfile.mkdtemp()
+    try:
+        files = make_one_sample(work_dir)
+        outputs = run_native_randomise(**files, out_dir=os.path.join(work_dir, 'native'), num_perm=2000,
+                                       n_procs=1, tfce=False, adaptive=True)
+        with open(outputs['perm_log']) as f:
+            runs = json.load(f)['contrasts']
+
+        effect = runs['tstat1']
+        assert not effect['stopped_early'] and effect['run'] == 2000, effect
+        assert effect['min_corrected_p'] < 0.01, effect
+
+        null = runs['tstat2']
+        assert null['stopped_early'] and null['reason'] == 'null', null
+        assert null['run'] < 1000, null
+        print(f"✅ Adaptive stopping: effect ran {effect['run']}, null stopped after {null['run']}")
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def test_stopping_rule():
+    """The rule follows the voxels' exceedance counts, not a fixed count at alpha."""
+    rng = np.random.default_rng(3)
+    max_null = rng.normal(3.0, 0.3, 600)
+
+    # Every voxel far from the threshold: decided as soon as min_perm is reached
+    observed = np.r_[np.full(10, 6.0), np.zeros(50)]
+    assert check_stopping(max_null[:400], observed, DEFAULT_STOPPING) is None
+    assert check_stopping(max_null, observed, DEFAULT_STOPPING) == 'decided'
+
+    # Largest statistic well inside the null: cannot reach significance
+    assert check_stopping(max_null, np.full(10, 2.5), DEFAULT_STOPPING) == 'null'
+
+    # A voxel at the threshold keeps permuting until its interval is narrow enough
+    near = np.r_[observed, np.quantile(max_null, 0.95)]
+    assert check_stopping(max_null, near, DEFAULT_STOPPING) is None
+    assert check_stopping(max_null, near, dict(DEFAULT_STOPPING, precision=0.03)) == 'precision'
+    print("✅ Stopping rule follows the voxelwise corrected p")
+
+
+if __name__ == "__main__":
+    test_t_matches_ols()
+    test_exhaustive_sign_flips()
+    test_randomise_naming()
+    test_stopping_rule()
+    test_adaptive_stopping()
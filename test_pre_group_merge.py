@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""
+Test script to validate the pre-group merge (pre_group_merge.py) and the cope
+store (cope_store.py) on synthetic first-level outputs: incremental updates
+and subset derivation must give the same volumes, in the same order, as
+merging from scratch.
+"""
+
+import os
+import json
+import shutil
+import tempfile
+import numpy as np
+import nibabel as nib
+
+from pre_group_merge import (merge_all_contrasts, record_merge_manifest, update_merged_contrasts,
+                             derive_subset_merges, read_merge_manifest, FILE_TYPES, MANIFEST_NAME)
+from cope_store import build_cope_store, get_store_path, CopeStore
+
+SHAPE = (5, 4, 3)
+CONTRASTS = [1, 2]
+TASK = 'phase2'
+
+
+def write_image(path, data):
+    """Save a float32 image on the test grid."""
+    nib.save(nib.Nifti1Image(data.astype(np.float32), np.diag([2.0, 2.0, 2.0, 1.0])), path)
+    return path
+
+
+def make_inputs(root, subjects, seed=0):
+    """First-level cope/varcope files for each subject and contrast, plus the reference mask."""
+    rng = np.random.default_rng(seed)
+    mask = np.ones(SHAPE, dtype=np.float32)
+    mask[0] = 0
+    mask_file = write_image(os.path.join(root, 'mask.nii.gz'), mask)
+
+    subject_files = {}
+    for sub in subjects:
+        subject_files[sub] = {}
+        for contrast in CONTRASTS:
+            sub_dir = os.path.join(root, 'firstLevel', f'sub-{sub}')
+            os.makedirs(sub_dir, exist_ok=True)
+            subject_files[sub][contrast] = {
+                file_type: write_image(os.path.join(sub_dir, f'{file_type}{contrast}.nii.gz'),
+                                       rng.normal(size=SHAPE))
+                for file_type in FILE_TYPES
+            }
+    return subject_files, mask_file
+
+
+def rewrite_input(path, data, after):
+    """Overwrite a first-level file and date it after a given file."""
+    write_image(path, data)
+    mtime = os.stat(after).st_mtime_ns + 10 ** 9
+    os.utime(path, ns=(mtime, mtime))
+
+
+def read_data(path):
+    """Image data as float32."""
+    return np.asanyarray(nib.load(path).dataobj, dtype=np.float32)
+
+
+def expected_volumes(subject_files, subjects, contrast, file_type):
+    """The merged 4D data read straight from the first-level files."""
+    return np.stack([read_data(subject_files[sub][contrast][file_type]) for sub in subjects], axis=-1)
+
+
+def test_incremental_matches_scratch():
+    """Adding, dropping and changing subjects gives the same merged files as a fresh merge."""
+    work_dir = tempfile.mkdtemp()
+    try:
+        subjects = ['N101', 'N102', 'N103', 'N104']
+        subject_files, mask_file = make_inputs(work_dir, subjects + ['N105'])
+        incremental_dir = os.path.join(work_dir, 'incremental')
+        os.makedirs(incremental_dir)
+        merge_all_contrasts(subject_files, subjects, CONTRASTS, incremental_dir, mask_file)
+        record_merge_manifest(incremental_dir, subject_files, subjects, CONTRASTS)
+
+        # N102 is excluded, N105 joins in the middle of group_info and N103's cope1 is re-run
+        updated = ['N101', 'N105', 'N103', 'N104']
+        merged_cope1 = os.path.join(incremental_dir, 'cope1', 'merged_cope.nii.gz')
+        rewrite_input(subject_files['N103'][1]['cope'], np.full(SHAPE, 7.0), after=merged_cope1)
+        merged = update_merged_contrasts(subject_files, updated, CONTRASTS, incremental_dir, mask_file)
+
+        scratch_dir = os.path.join(work_dir, 'scratch')
+        os.makedirs(scratch_dir)
+        scratch = merge_all_contrasts(subject_files, updated, CONTRASTS, scratch_dir, mask_file)
+
+        for contrast in CONTRASTS:
+            for file_type in FILE_TYPES:
+                data = read_data(merged[contrast][file_type])
+                assert data.shape == SHAPE + (len(updated),), data.shape
+                assert np.array_equal(data, read_data(scratch[contrast][file_type])), (contrast, file_type)
+                assert np.array_equal(data, expected_volumes(subject_files, updated, contrast, file_type))
+        assert np.all(read_data(merged[1]['cope'])[..., 2] == 7.0)
+
+        manifest = read_merge_manifest(incremental_dir)
+        assert all(manifest['contrasts'][str(c)]['subjects'] == updated for c in CONTRASTS)
+        print("✅ Incremental update matches a from-scratch merge (volumes and order)")
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def test_legacy_merge_update():
+    """Without a manifest, inputs newer than the merged file are read again."""
+    work_dir = tempfile.mkdtemp()
+    try:
+        subjects = ['N101', 'N102', 'N103']
+        subject_files, mask_file = make_inputs(work_dir, subjects)
+        task_dir = os.path.join(work_dir, 'results')
+        os.makedirs(task_dir)
+        merge_all_contrasts(subject_files, subjects, CONTRASTS, task_dir, mask_file)
+        for contrast in CONTRASTS:
+            design_dir = os.path.join(task_dir, f'cope{contrast}', 'design_files')
+            os.makedirs(design_dir)
+            with open(os.path.join(design_dir, 'design_info.json'), 'w') as f:
+                json.dump({'subjects': subjects}, f)
+
+        merged_varcope2 = os.path.join(task_dir, 'cope2', 'merged_varcope.nii.gz')
+        rewrite_input(subject_files['N102'][2]['varcope'], np.full(SHAPE, 3.0), after=merged_varcope2)
+        assert not os.path.exists(os.path.join(task_dir, MANIFEST_NAME))
+        merged = update_merged_contrasts(subject_files, subjects, CONTRASTS, task_dir, mask_file)
+
+        for contrast in CONTRASTS:
+            for file_type in FILE_TYPES:
+                assert np.array_equal(read_data(merged[contrast][file_type]),
+                                      expected_volumes(subject_files, subjects, contrast, file_type))
+        assert np.all(read_data(merged_varcope2)[..., 1] == 3.0)
+        assert read_merge_manifest(task_dir)['contrasts']['1']['subjects'] == subjects
+        print("✅ Legacy merges re-read inputs changed after the merge")
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def test_subset_from_store():
+    """Subsets derived through the store equal direct indexing of the merged files."""
+    work_dir = tempfile.mkdtemp()
+    try:
+        subjects = ['N101', 'N102', 'N103', 'N104', 'N105']
+        subject_files, mask_file = make_inputs(work_dir, subjects, seed=1)
+        standard_dir = os.path.join(work_dir, 'standard')
+        os.makedirs(standard_dir)
+        merged = merge_all_contrasts(subject_files, subjects, CONTRASTS, standard_dir, mask_file)
+        record_merge_manifest(standard_dir, subject_files, subjects, CONTRASTS)
+        store_file = build_cope_store(standard_dir, TASK, CONTRASTS, subjects, mask_file)
+        assert store_file == get_store_path(standard_dir, TASK)
+
+        subset = ['N104', 'N101', 'N103']
+        indices = [3, 0, 2]
+        mask = read_data(mask_file) > 0
+        for label, use_store in (('store', True), ('files', False)):
+            subset_dir = os.path.join(work_dir, label)
+            derived = derive_subset_merges(standard_dir, subset_dir, subset, CONTRASTS, standard_subjects=subjects,
+                                           store_file=store_file if use_store else None)
+            assert derived == CONTRASTS
+            for contrast in CONTRASTS:
+                for file_type in FILE_TYPES:
+                    data = read_data(os.path.join(subset_dir, f'cope{contrast}', f'merged_{file_type}.nii.gz'))
+                    expected = read_data(merged[contrast][file_type])[..., indices]
+                    assert data.shape == SHAPE + (len(subset),)
+                    assert np.array_equal(data[mask], expected[mask]), (label, contrast, file_type)
+
+        # Rewriting a merged file makes the store stale: subsets come from the files instead
+        with CopeStore(store_file) as store:
+            assert store.is_current()
+        rewrite_input(subject_files['N101'][1]['cope'], np.full(SHAPE, 5.0), after=merged[1]['cope'])
+        update_merged_contrasts(subject_files, subjects, CONTRASTS, standard_dir, mask_file)
+        with CopeStore(store_file) as store:
+            assert not store.is_current() and store.is_current([2])
+        stale_dir = os.path.join(work_dir, 'stale')
+        derive_subset_merges(standard_dir, stale_dir, subset, CONTRASTS, standard_subjects=subjects,
+                             store_file=store_file)
+        assert np.all(read_data(os.path.join(stale_dir, 'cope1', 'merged_cope.nii.gz'))[..., 1] == 5.0)
+        print("✅ Store-derived subsets match direct indexing; stale stores are bypassed")
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == "__main__":
+    test_incremental_matches_scratch()
+    test_legacy_merge_update()
+    test_subset_from_store()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+Test script to validate node-local scratch staging (scratch_staging.py):
+handoff of the local working directory after a failure, its restore in
+the next run, and the output sync on success.
+"""
+
+import os
+import shutil
+import signal
+import tarfile
+import tempfile
+
+from scratch_staging import staged_workdir, stage_inputs, handoff_path, local_dir_for, STAGED_INPUTS_DIR
+
+
+def write_file(path, text):
+    """Write a small text file, creating its directory."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(text)
+    return path
+
+
+def test_handoff_and_restore():
+    """A failed run hands off its working directory; the next run restores it and cleans up."""
+    work_dir = tempfile.mkdtemp()
+    try:
+        shared_dir = os.path.join(work_dir, 'shared', 'sub_N101')
+        local_root = os.path.join(work_dir, 'node')
+        bold = write_file(os.path.join(work_dir, 'bids', 'sub-N101', 'bold.nii.gz'), 'bold')
+        handler = signal.getsignal(signal.SIGTERM)
+
+        try:
+            with staged_workdir(shared_dir, outputs=('results/*',), local_root=local_root) as local_dir:
+                assert local_dir == local_dir_for(shared_dir, local_root)
+                inputs = stage_inputs({'bold': bold, 'runs': [bold], 'tr': 2.0}, local_dir)
+                assert inputs['bold'].startswith(os.path.join(local_dir, STAGED_INPUTS_DIR))
+                assert inputs['runs'] == [inputs['bold']] and inputs['tr'] == 2.0
+                write_file(os.path.join(local_dir, 'wf', 'node', 'result_node.pklz'), 'cached node')
+                write_file(os.path.join(local_dir, 'crash-node.pklz'), 'crash')
+                raise RuntimeError('simulated failure')
+        except RuntimeError:
+            pass
+        else:
+            raise AssertionError("the exception was swallowed")
+
+        archive = handoff_path(shared_dir)
+        with tarfile.open(archive) as tar:
+            names = tar.getnames()
+        assert './wf/node/result_node.pklz' in names
+        assert not any(STAGED_INPUTS_DIR in name for name in names), names
+        assert os.path.exists(os.path.join(shared_dir, 'crash-node.pklz'))
+        assert signal.getsignal(signal.SIGTERM) == handler
+
+        # The next run (possibly on another node with an empty scratch) restores the cached node
+        shutil.rmtree(local_root)
+        with staged_workdir(shared_dir, outputs=('results/*',), local_root=local_root) as local_dir:
+            with open(os.path.join(local_dir, 'wf', 'node', 'result_node.pklz')) as f:
+                assert f.read() == 'cached node'
+            write_file(os.path.join(local_dir, 'results', 'cope1.nii.gz'), 'cope')
+            write_file(os.path.join(local_dir, 'wf', 'node', 'residuals.nii.gz'), 'scratch')
+
+        assert os.path.exists(os.path.join(shared_dir, 'results', 'cope1.nii.gz'))
+        assert not os.path.exists(os.path.join(shared_dir, 'wf'))
+        assert not os.path.exists(archive) and not os.path.exists(local_dir)
+        print("✅ Failed runs hand off their working directory; the next run restores it")
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def test_disabled():
+    """With staging disabled the shared directory is used as is."""
+    work_dir = tempfile.mkdtemp()
+    try:
+        with staged_workdir(work_dir, enabled=False) as local_dir:
+            assert local_dir == work_dir
+        print("✅ Disabled staging yields the shared directory")
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == "__main__":
+    test_handoff_and_restore()
+    test_disabled()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+Test script to validate the working-directory retention policy
+(workdir_retention.py): pruning keeps Nipype bookkeeping and the outputs
+that downstream nodes read.
+"""
+
+import os
+import shutil
+import tempfile
+
+import nipype.pipeline.engine as pe
+import nipype.interfaces.utility as niu
+
+from workdir_retention import prune_node_dir, RetentionMonitor, BOOKKEEPING_PATTERNS
+
+
+def write_file(path, text='x'):
+    """Write a small text file, creating its directory."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(text)
+    return path
+
+
+def make_outputs(prefix):
+    """Function-node body: write a used and an unused output plus a scratch file."""
+    import os
+    for name in ('used', 'unused', 'scratch'):
+        with open(os.path.abspath(f'{prefix}_{name}.txt'), 'w') as f:
+            f.write(name)
+    return os.path.abspath(f'{prefix}_used.txt'), os.path.abspath(f'{prefix}_unused.txt')
+
+
+def read_text(in_file):
+    """Function-node body: read the upstream output."""
+    with open(in_file) as f:
+        return f.read()
+
+
+def test_prune_node_dir():
+    """Bookkeeping, kept files, their pairs and kept directories survive; the rest is removed."""
+    node_dir = tempfile.mkdtemp()
+    try:
+        bookkeeping = [write_file(os.path.join(node_dir, name)) for name in
+                       ('_0x1234abcd.json', '_inputs.pklz', '_node.pklz', 'result_model.pklz', 'command.txt')]
+        report = write_file(os.path.join(node_dir, '_report', 'report.rst'))
+        kept = write_file(os.path.join(node_dir, 'stats', 'cope1.nii.gz'))
+        paired = write_file(os.path.join(node_dir, 'stats', 'cope1.img'))
+        kept_dir_file = write_file(os.path.join(node_dir, 'reg', 'example_func.nii.gz'))
+        removed = [write_file(os.path.join(node_dir, 'stats', 'res4d.nii.gz'), 'residuals'),
+                   write_file(os.path.join(node_dir, 'mapflow', '_model0', 'sigmasquareds.nii.gz'), 'sigma')]
+        assert len(bookkeeping) == len(BOOKKEEPING_PATTERNS)
+
+        reclaimed = prune_node_dir(node_dir, keep=[kept, os.path.join(node_dir, 'reg')])
+        for path in bookkeeping + [report, kept, paired, kept_dir_file]:
+            assert os.path.exists(path), path
+        assert not any(os.path.exists(path) for path in removed)
+        assert reclaimed == len('residuals') + len('sigma'), reclaimed
+        print("✅ prune_node_dir keeps bookkeeping and kept outputs")
+    finally:
+        shutil.rmtree(node_dir)
+
+
+def test_keep_restartable():
+    """keep-restartable removes unconnected outputs and scratch files but keeps connected ones."""
+    work_dir = tempfile.mkdtemp()
+    try:
+        wf = pe.Workflow(name='retention_wf', base_dir=work_dir)
+        # As in the analysis workflows: Nipype's own output removal is off
+        wf.config['execution']['remove_unnecessary_outputs'] = False
+        producer = pe.Node(niu.Function(input_names=['prefix'], output_names=['used', 'unused'],
+                                        function=make_outputs), name='producer')
+        producer.inputs.prefix = 'out'
+        consumer = pe.Node(niu.Function(input_names=['in_file'], output_names=['text'],
+                                        function=read_text), name='consumer')
+        wf.connect(producer, 'used', consumer, 'in_file')
+
+        monitor = RetentionMonitor(wf, 'keep-restartable')
+        wf.run(plugin='Linear', plugin_args={'status_callback': monitor})
+
+        producer_dir = os.path.join(work_dir, 'retention_wf', 'producer')
+        assert os.path.exists(os.path.join(producer_dir, 'out_used.txt'))
+        assert not os.path.exists(os.path.join(producer_dir, 'out_unused.txt'))
+        assert not os.path.exists(os.path.join(producer_dir, 'out_scratch.txt'))
+        assert os.path.exists(os.path.join(producer_dir, 'result_producer.pklz'))
+        assert monitor.reclaimed == len('unused') + len('scratch'), monitor.reclaimed
+
+        # Bookkeeping was kept, so a rerun finds every node in the cache
+        rerun = RetentionMonitor(wf, 'keep-restartable')
+        wf.run(plugin='Linear', plugin_args={'status_callback': rerun})
+        assert rerun.finalize() == 0
+        assert os.path.exists(os.path.join(producer_dir, 'out_used.txt'))
+        print("✅ keep-restartable prunes unconnected outputs and stays restartable")
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == "__main__":
+    test_prune_node_dir()
+    test_keep_restartable()
@@ -17,11 +17,38 @@ def _dof(inlist):
 def _neg(val):
     return -val
 
-def _dict_ds(in_dict, sub, order=['bold', 'mask', 'events', 'regressors', 'tr']):
-    return tuple([in_dict[sub][k] for k in order])
+class SubjectRecord(dict):
+    """
+    One subject's first-level inputs, used as a datasource iterable value.
+
+    Each iterable branch carries only its own subject's paths instead of the
+    whole inputs dictionary, so building, hashing and pickling the expanded
+    nodes stays linear in the number of subjects. The string form is the
+    subject ID, which keeps the branches' _sub_<ID> working directories.
+    """
+
+    def __init__(self, sub, inputs):
+        super().__init__(inputs)
+        self.sub = sub
+
+    def __str__(self):
+        return str(self.sub)
+
+
+def subject_records(in_files):
+    """Per-subject datasource iterables from an inputs dict {sub: {...}} or a list of records."""
+    if isinstance(in_files, dict):
+        return [SubjectRecord(sub, in_files[sub]) for sub in sorted(in_files)]
+    return list(in_files)
+
+def _dict_ds(in_dict=None, sub=None, order=['bold', 'mask', 'events', 'regressors', 'tr']):
+    # sub is either a subject ID (with the full in_dict) or that subject's SubjectRecord
+    record = sub if in_dict is None else in_dict[sub]
+    return tuple([record[k] for k in order])
 
-def _dict_ds_lss(in_dict, sub, order=['bold', 'mask', 'events', 'regressors', 'tr', 'trial_ID']):
-    return tuple([in_dict[sub][k] for k in order])
+def _dict_ds_lss(in_dict=None, sub=None, order=['bold', 'mask', 'events', 'regressors', 'tr', 'trial_ID']):
+    record = sub if in_dict is None else in_dict[sub]
+    return tuple([record[k] for k in order])
 
 def _bids2nipypeinfo(in_file, events_file, regressors_file,
                      regressors_names=None,
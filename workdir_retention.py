@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+"""
+Working-directory retention policy for the Nipype workflows.
+
+Every workflow runs with Nipype's remove_unnecessary_outputs switched off,
+so each node directory keeps every file its interface wrote (FILMGLS residuals,
+resampled inputs, per-subject copies of merged volumes, ...), and the working
+directories grow to many times the size of the results. RetentionMonitor
+applies one of three levels using the workflow's expanded node graph:
+
+    keep-all          nothing is removed (the previous behaviour)
+    keep-restartable  once a node finishes, files that no consumer reads (outputs
+                      of unconnected fields, interface scratch files) are removed;
+                      Nipype bookkeeping is kept, so a rerun is a full cache hit
+    results-only      additionally, a node's outputs are removed as soon as all of
+                      its consumers have finished, and the workflow's node
+                      directories are removed after the results are promoted
+
+Outputs of nodes without consumers are kept until finalize(), since they may be
+results in their own right. results-only is not restartable: after a failed
+run, finalize(success=False) clears the node directories so that the next run
+starts clean instead of finding outputs its cache still points to.
+
+Usage:
+    monitor = RetentionMonitor(wf, 'keep-restartable')
+    wf.run(plugin='MultiProc', plugin_args={'n_procs': 4, 'status_callback': monitor})
+    # ... promote results ...
+    monitor.finalize()
+
+Author: Xiaoqian Xiao (xiao.xiaoqian.320@gmail.com)
+"""
+
+import os
+import shutil
+import fnmatch
+import logging
+from copy import deepcopy
+
+logger = logging.getLogger(__name__)
+
+# =============================================================================
+# CONSTANTS
+# =============================================================================
+
+RETENTION_LEVELS = ('keep-all', 'keep-restartable', 'results-only')
+DEFAULT_RETENTION = 'keep-all'
+
+# Nipype's per-node bookkeeping: hash files, pickled inputs/node/result, reports
+BOOKKEEPING_PATTERNS = ('_0x*.json', '_inputs.pklz', '_node.pklz', 'result_*.pklz', 'command.txt')
+BOOKKEEPING_DIRS = ('_report',)
+
+# =============================================================================
+# NODE GRAPH
+# =============================================================================
+
+def execution_graph(workflow):
+    """
+    Expanded execution graph of a workflow, as Workflow.run builds it.
+
+    Iterables are expanded, so every node corresponds to one node directory;
+    nodes are identified by their itername, which matches the nodes the
+    execution plugin reports to its status_callback.
+
+    Args:
+        workflow (nipype.Workflow): Workflow with base_dir set
+
+    Returns:
+        networkx.DiGraph: Expanded graph (edges carry the 'connect' field lists)
+    """
+    from nipype import config
+    from nipype.pipeline.engine.utils import generate_expanded_graph, merge_dict
+
+    workflow_config = merge_dict(deepcopy(config._sections), workflow.config)
+    graph = generate_expanded_graph(deepcopy(workflow._create_flat_graph()))
+    for node in graph.nodes():
+        node.config = merge_dict(deepcopy(workflow_config), node.config)
+        node.base_dir = workflow.base_dir
+    return graph
+
+
+def connected_fields(graph, node):
+    """Output fields of a node that its consumers read."""
+    fields = set()
+    for consumer in graph.successors(node):
+        for src, _ in graph.get_edge_data(node, consumer).get('connect', []):
+            fields.add(src[0] if isinstance(src, tuple) else src)
+    return fields
+
+
+def _output_paths(value):
+    """Every string path contained in an output value (lists/tuples/dicts allowed)."""
+    if isinstance(value, str):
+        return [value]
+    if isinstance(value, dict):
+        value = list(value.values())
+    if isinstance(value, (list, tuple)):
+        return [path for item in value for path in _output_paths(item)]
+    return []
+
+
+def node_outputs(node, fields=None):
+    """
+    Output paths of a finished node, read from its result file.
+
+    Args:
+        node: Execution graph node
+        fields (set): Output fields to include (default: all)
+
+    Returns:
+        list: Absolute paths, or None if the node has no readable result
+    """
+    from nipype.pipeline.engine.utils import load_resultfile
+
+    result_file = os.path.join(node.output_dir(), f'result_{node.name}.pklz')
+    if not os.path.exists(result_file):
+        return None
+    try:
+        outputs = load_resultfile(result_file).outputs
+    except Exception as e:
+        logger.debug(f"Could not read {result_file}: {e}")
+        return None
+    if outputs is None:
+        return []
+    # MapNode results carry a Bunch of per-iteration lists
+    values = outputs.trait_get() if hasattr(outputs, 'trait_get') else outputs.dictcopy()
+    return [os.path.abspath(path) for name, value in values.items()
+            if fields is None or name in fields
+            for path in _output_paths(value)]
+
+# =============================================================================
+# PRUNING
+# =============================================================================
+
+def _is_kept(path, keep):
+    """Whether a file is one of the kept outputs, lies under a kept directory or pairs with one."""
+    if path in keep:
+        return True
+    folder, name = os.path.split(path)
+    stem = name.split('.', 1)[0]
+    for kept in keep:
+        if path.startswith(kept.rstrip(os.sep) + os.sep):
+            return True
+        kept_folder, kept_name = os.path.split(kept)
+        if kept_folder == folder and kept_name.split('.', 1)[0] == stem:
+            return True
+    return False
+
+
+def prune_node_dir(node_dir, keep=()):
+    """
+    Remove everything in a node directory except bookkeeping and kept outputs.
+
+    Args:
+        node_dir (str): Node output directory (MapNode mapflow/ subdirectories included)
+        keep (iterable): Output paths (files or directories) to keep
+
+    Returns:
+        int: Bytes reclaimed
+    """
+    keep = {os.path.abspath(path) for path in keep}
+    reclaimed = 0
+    for root, dirs, files in os.walk(node_dir):
+        dirs[:] = [d for d in dirs if d not in BOOKKEEPING_DIRS]
+        for name in files:
+            path = os.path.join(root, name)
+            if any(fnmatch.fnmatch(name, pattern) for pattern in BOOKKEEPING_PATTERNS) or _is_kept(path, keep):
+                continue
+            try:
+                size = os.lstat(path).st_size
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            reclaimed += size
+    return reclaimed
+
+
+def directory_size(path):
+    """Total size of the files below a directory."""
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except FileNotFoundError:
+                pass
+    return total
+
+# =============================================================================
+# RETENTION MONITOR
+# =============================================================================
+
+class RetentionMonitor:
+    """
+    Apply a retention level to a workflow's node directories while it runs.
+
+    The monitor is the execution plugin's status_callback (MultiProc and Linear
+    call it in the main process with each node's 'start'/'end'/'exception').
+    Pruning errors are logged and never fail the workflow.
+    """
+
+    def __init__(self, workflow, level=DEFAULT_RETENTION):
+        if level not in RETENTION_LEVELS:
+            raise ValueError(f"Unknown retention level '{level}', expected one of {RETENTION_LEVELS}")
+        self.workflow = workflow
+        self.level = level
+        self.graph = None
+        self.nodes = {}
+        self.finished = set()
+        self.cleared = set()
+        self.reclaimed = 0
+
+    def _ensure_graph(self):
+        if self.graph is None:
+            self.graph = execution_graph(self.workflow)
+            self.nodes = {node.itername: node for node in self.graph.nodes()}
+
+    def _prune(self, node, keep):
+        reclaimed = prune_node_dir(node.output_dir(), keep)
+        self.reclaimed += reclaimed
+        return reclaimed
+
+    def _prune_unconnected(self, node):
+        """keep-restartable pruning of one finished node."""
+        if not list(self.graph.successors(node)):
+            return 0  # terminal node: its outputs may be results
+        keep = node_outputs(node, connected_fields(self.graph, node))
+        return 0 if keep is None else self._prune(node, keep)
+
+    def _prune_consumed(self, node):
+        """results-only pruning of a node whose consumers have all finished."""
+        consumers = list(self.graph.successors(node))
+        if (node.itername in self.cleared or not consumers
+                or any(c.itername not in self.finished for c in consumers)):
+            return 0
+        self.cleared.add(node.itername)
+        return self._prune(node, ())
+
+    def __call__(self, node, status):
+        if self.level == 'keep-all' or status != 'end':
+            return
+        try:
+            self._ensure_graph()
+            graph_node = self.nodes.get(node.itername)
+            if graph_node is None:
+                return
+            self.finished.add(graph_node.itername)
+            self._prune_unconnected(graph_node)
+            if self.level == 'results-only':
+                for producer in self.graph.predecessors(graph_node):
+                    self._prune_consumed(producer)
+        except Exception as e:
+            logger.warning(f"Retention pruning after {node.itername} failed: {e}")
+
+    def finalize(self, success=True):
+        """
+        Final pass once the workflow has finished and its results are promoted.
+
+        keep-restartable sweeps every finished node (nodes found in the cache
+        are not always reported to the callback); results-only removes the
+        workflow's node directories.
+
+        Args:
+            success (bool): Whether the run succeeded
+
+        Returns:
+            int: Total bytes reclaimed by this monitor
+        """
+        if self.level == 'keep-all':
+            return 0
+        try:
+            if self.level == 'results-only':
+                workflow_dir = os.path.join(self.workflow.base_dir, self.workflow.name)
+                if os.path.isdir(workflow_dir):
+                    self.reclaimed += directory_size(workflow_dir)
+                    shutil.rmtree(workflow_dir, ignore_errors=True)
+                if not success:
+                    logger.info(f"Cleared {workflow_dir} after a failed results-only run")
+            else:
+                self._ensure_graph()
+                for node in self.graph.nodes():
+                    self._prune_unconnected(node)
+        except Exception as e:
+            logger.warning(f"Retention finalize for {self.workflow.name} failed: {e}")
+        logger.info(f"Retention '{self.level}' for {self.workflow.name}: "
+                    f"reclaimed {self.reclaimed / 1024 ** 2:.1f} MB")
+        return self.reclaimed